@@ -12,10 +12,38 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import collections
 import itertools
+from monasca.common import alarm_expr_calculator as calculator
 import pyparsing
 
 
+class SubExprMatcher(collections.namedtuple(
+        'SubExprMatcher', ['key', 'name', 'dimensions', 'func', 'operator',
+                           'threshold', 'period', 'periods'])):
+    """A sub expression compiled for matching and evaluating metrics.
+
+    It is immutable: the name and dimension values are lower-cased, the
+    dimensions are a tuple of (key, value) pairs and the numbers are
+    converted once, so using it does no string work.
+    """
+    __slots__ = ()
+
+    def matches(self, name, dimensions):
+        """Check a metric, its name and dimension values lower-cased."""
+        if name != self.name:
+            return False
+        for key, value in self.dimensions:
+            if dimensions.get(key) != value:
+                return False
+        return True
+
+    def compare(self, values):
+        """Get the state of the sub expression for the period values."""
+        return calculator.compare_thresh(values, self.operator,
+                                         self.threshold)
+
+
 class SubExpr(object):
     def __init__(self, tokens):
 
@@ -28,6 +56,7 @@ class SubExpr(object):
         self._period = tokens.period
         self._periods = tokens.periods
         self._id = None
+        self._matcher = None
 
     @property
     def sub_expr_str(self):
@@ -149,6 +178,19 @@ class SubExpr(object):
         elif self._operator.lower() == "gte" or self._operator == ">=":
             return u"GTE"
 
+    @property
+    def matcher(self):
+        """Get the sub expression compiled, it is built once."""
+        if self._matcher is None:
+            dimensions = tuple(sorted(
+                (key, value.lower())
+                for key, value in self.dimensions_as_dict.items()))
+            self._matcher = SubExprMatcher(
+                self.fmtd_sub_expr_str, self.normalized_metric_name,
+                dimensions, self.normalized_func, self.normalized_operator,
+                float(self.threshold), float(self.period), int(self.periods))
+        return self._matcher
+
     @property
     def id(self):
         """Get the id used to identify this sub expression in the repo."""
@@ -292,6 +334,14 @@ class AlarmExprParser(object):
         else:
             return None
 
+    @property
+    def sub_expr_matchers(self):
+        """Get the compiled sub expressions, in sub_expr_list order."""
+        if self.parseResult:
+            return [expr.matcher for expr in self.sub_expr_list]
+        else:
+            return None
+
     @property
     def related_metrics(self):
         """Get a list of all the metrics related with this expression."""
@@ -14,8 +14,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
 from oslo.config import cfg
+import re
 import requests
+from requests import adapters
+import threading
+import time
 import ujson as json
 
 from monasca.openstack.common import log
@@ -23,21 +28,184 @@ from monasca.openstack.common import log
 
 ES_OPTS = [
     cfg.StrOpt('uri',
-               help='Address to kafka server. For example: '
-               'uri=http://192.168.1.191:9200/'),
+               help=('Address to ElasticSearch. Several nodes of a cluster '
+                     'can be given as a comma separated list. For example: '
+                     'uri=http://192.168.1.191:9200,http://192.168.1.192:9200'
+                     )),
     cfg.StrOpt('id_field',
                default='',
                help='The field name for _id.'),
+    cfg.StrOpt('time_id',
+               default='',
+               help=('The field holding the time of a message. When set, '
+                     'each message is stored in the index of its own time '
+                     'rather than in the index of the current time.')),
     cfg.BoolOpt('drop_data',
                 default=False,
                 help=('Specify if received data should be simply dropped. '
                       'This parameter is only for testing purposes.')),
+    cfg.IntOpt('bulk_max_bytes',
+               default=5242880,
+               help=('The maximum size in bytes of a bulk request body. '
+                     'Buffered messages are flushed when it is reached.')),
+    cfg.IntOpt('bulk_max_docs',
+               default=1000,
+               help=('The maximum number of documents to buffer before '
+                     'they are flushed with a bulk request.')),
+    cfg.FloatOpt('bulk_max_linger',
+                 default=1.0,
+                 help=('The maximum time in seconds a document can stay '
+                       'in the buffer before it is flushed.')),
+    cfg.IntOpt('pool_size',
+               default=10,
+               help=('The maximum number of keep-alive connections kept '
+                     'open to each ElasticSearch node.')),
+    cfg.IntOpt('max_retries',
+               default=3,
+               help=('The number of times a failed connection to '
+                     'ElasticSearch is retried.')),
+    cfg.FloatOpt('timeout',
+                 default=60.0,
+                 help='The timeout in seconds of ElasticSearch requests.'),
+    cfg.StrOpt('load_balancer',
+               default='round_robin',
+               help=('How requests are spread over the nodes, the valid '
+                     'values are round_robin and least_outstanding.')),
+    cfg.FloatOpt('dead_timeout',
+                 default=5.0,
+                 help=('The time in seconds a node failing with a connection '
+                       'error is left out before it is tried again. It is '
+                       'doubled on every consecutive failure.')),
+    cfg.FloatOpt('max_dead_timeout',
+                 default=300.0,
+                 help='The maximum time in seconds a node is left out.'),
+    cfg.BoolOpt('sniff',
+                default=False,
+                help=('Specify if the nodes of the cluster should be '
+                      'discovered from the nodes given by uri.')),
+    cfg.IntOpt('sniff_interval',
+               default=300,
+               help='The time in seconds between two node discoveries.'),
+    cfg.StrOpt('scroll_keep_alive',
+               default='1m',
+               help=('How long ElasticSearch keeps the context of a scroll '
+                     'between the reads of two pages, for example 1m.')),
 ]
 
 cfg.CONF.register_opts(ES_OPTS, group="es_conn")
 
 LOG = log.getLogger(__name__)
 
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_node_pools = {}
+_node_pools_lock = threading.Lock()
+
+
+def get_session():
+    """Get the keep-alive session shared by all ElasticSearch connections."""
+    global _session, _session_pid
+    with _session_lock:
+        # a forked worker process must not reuse the sockets of its parent
+        if not _session or _session_pid != os.getpid():
+            adapter = adapters.HTTPAdapter(
+                pool_connections=cfg.CONF.es_conn.pool_size,
+                pool_maxsize=cfg.CONF.es_conn.pool_size,
+                max_retries=cfg.CONF.es_conn.max_retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+    return _session
+
+
+def get_node_pool(nodes):
+    """Get the node pool shared by all connections to the same nodes."""
+    key = tuple(nodes)
+    with _node_pools_lock:
+        if key not in _node_pools:
+            _node_pools[key] = ESNodePool(nodes)
+    return _node_pools[key]
+
+
+class ESNodePool(object):
+    """Choose the ElasticSearch node each request is sent to.
+
+    Nodes are picked in turn, or by the least number of requests in
+    progress when load_balancer is least_outstanding. A node failing with
+    a connection error is marked dead and left out for dead_timeout
+    seconds, doubled on every consecutive failure up to max_dead_timeout.
+    Once that time is up, the next request sent to the node probes it.
+    """
+
+    def __init__(self, nodes):
+        self.load_balancer = cfg.CONF.es_conn.load_balancer
+        self.dead_timeout = cfg.CONF.es_conn.dead_timeout
+        self.max_dead_timeout = cfg.CONF.es_conn.max_dead_timeout
+        self.sniff_interval = cfg.CONF.es_conn.sniff_interval
+        self.last_sniff = None
+
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._outstanding = {}
+        self._failures = {}
+        self._dead_until = {}
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes):
+        with self._lock:
+            self.nodes = list(nodes)
+            for node in self.nodes:
+                self._outstanding.setdefault(node, 0)
+                self._failures.setdefault(node, 0)
+
+    def is_sniff_due(self):
+        return (self.last_sniff is None or
+                time.time() - self.last_sniff >= self.sniff_interval)
+
+    def get_node(self):
+        with self._lock:
+            now = time.time()
+            alive = [node for node in self.nodes
+                     if self._dead_until.get(node, 0) <= now]
+            if not alive:
+                # every node is dead, try the one which comes back first
+                alive = [min(self.nodes,
+                             key=lambda node: self._dead_until[node])]
+
+            self._counter += 1
+            if self.load_balancer == 'least_outstanding':
+                # rotate the candidates so that ties are spread evenly
+                start = self._counter % len(alive)
+                alive = alive[start:] + alive[:start]
+                node = min(alive, key=lambda node: self._outstanding[node])
+            else:
+                node = alive[self._counter % len(alive)]
+            self._outstanding[node] += 1
+            return node
+
+    def release(self, node):
+        with self._lock:
+            self._outstanding[node] -= 1
+
+    def mark_live(self, node):
+        with self._lock:
+            self._failures[node] = 0
+            self._dead_until.pop(node, None)
+
+    def mark_dead(self, node):
+        with self._lock:
+            self._failures[node] += 1
+            timeout = min(self.dead_timeout *
+                          2 ** (self._failures[node] - 1),
+                          self.max_dead_timeout)
+            self._dead_until[node] = time.time() + timeout
+        LOG.warn('ElasticSearch node %s is dead, retrying it in %s seconds.'
+                 % (node, timeout))
+
 
 class ESConnection(object):
 
@@ -48,22 +216,103 @@ class ESConnection(object):
                             'uri, for example: '
                             'uri=192.168.1.191:9200')
 
-        self.uri = cfg.CONF.es_conn.uri
-        if self.uri.strip()[-1] != '/':
-            self.uri += '/'
+        nodes = []
+        for node in cfg.CONF.es_conn.uri.split(','):
+            node = node.strip()
+            if node:
+                nodes.append(node if node[-1] == '/' else node + '/')
+        # the first node is kept as the uri of the connection
+        self.uri = nodes[0]
+        self.sniff = cfg.CONF.es_conn.sniff
+        self._node_pool = get_node_pool(nodes)
 
         self.doc_type = doc_type
         self.index_strategy = index_stratey
         self.index_prefix = index_prefix
 
         self.id_field = cfg.CONF.es_conn.id_field
+        self.time_id = cfg.CONF.es_conn.time_id
         self.drop_data = cfg.CONF.es_conn.drop_data
+        self.timeout = cfg.CONF.es_conn.timeout
+        self._session = get_session()
 
-        self.search_path = '%s%s*/%s/_search' % (self.uri,
-                                                 self.index_prefix,
-                                                 self.doc_type)
+        self.search_path = '%s*/%s/_search' % (self.index_prefix,
+                                               self.doc_type)
         LOG.debug('ElasticSearch Connection initialized successfully!')
 
+    def request(self, method, path, **kwargs):
+        """Send a request to ElasticSearch using the shared session.
+
+        The path is relative to the ElasticSearch nodes, for example
+        data_*/metrics/_search. The request is sent to the next node picked
+        by the node pool and fails over to other nodes on connection errors.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if self.sniff and self._node_pool.is_sniff_due():
+            self.sniff_nodes()
+
+        error = None
+        for i in range(len(self._node_pool.nodes)):
+            node = self._node_pool.get_node()
+            try:
+                res = getattr(self._session, method)(node + path, **kwargs)
+                self._node_pool.mark_live(node)
+                return res
+            except requests.ConnectionError as ex:
+                error = ex
+                self._node_pool.mark_dead(node)
+            finally:
+                self._node_pool.release(node)
+        raise error
+
+    @staticmethod
+    def _parse_node_address(address, scheme):
+        # ElasticSearch 1.x reports addresses like inet[host/10.0.0.1:9200]
+        match = re.search(r'([^/\[\]]+:\d+)\]?$', address or '')
+        if match:
+            return '%s://%s/' % (scheme, match.group(1))
+        return None
+
+    def sniff_nodes(self):
+        """Replace the nodes of the pool by the http nodes of the cluster."""
+        self._node_pool.last_sniff = time.time()
+        nodes = []
+        try:
+            res = self.request('get', '_nodes/_all/http')
+            if res.status_code == 200:
+                scheme = 'https' if self.uri.startswith('https') else 'http'
+                for info in res.json().get('nodes', {}).values():
+                    address = (info.get('http', {}).get('publish_address') or
+                               info.get('http_address'))
+                    node = self._parse_node_address(address, scheme)
+                    if node:
+                        nodes.append(node)
+        except Exception:
+            LOG.exception('Failed to discover the ElasticSearch nodes.')
+        if nodes:
+            LOG.debug('Discovered ElasticSearch nodes: %s' % nodes)
+            self._node_pool.set_nodes(sorted(nodes))
+
+    def index_for(self, timestamp=None):
+        """Get the full name of the index a time belongs to.
+
+        Without a time, or with a strategy which can not map a time to an
+        index, the index of the current time is returned.
+        """
+        index = None
+        if (timestamp is not None and
+                hasattr(self.index_strategy, 'get_index_for')):
+            index = self.index_strategy.get_index_for(timestamp)
+        if index is None:
+            index = self.index_strategy.get_index()
+        return '%s%s' % (self.index_prefix, index)
+
+    def index_for_msg(self, obj):
+        """Get the full name of the index a decoded message belongs to."""
+        if self.time_id:
+            return self.index_for(obj.get(self.time_id))
+        return self.index_for()
+
     def send_messages(self, msg):
         LOG.debug('Prepare to send messages.')
         if self.drop_data:
@@ -71,8 +320,10 @@ class ESConnection(object):
         else:
             # figure out id situation
             _id = ''
-            if self.id_field:
+            obj = {}
+            if self.id_field or self.time_id:
                 obj = json.loads(msg)
+            if self.id_field:
                 _id = obj.get(self.id_field)
                 if not _id:
                     LOG.error('Msg does not have required id field %s' %
@@ -80,27 +331,111 @@ class ESConnection(object):
                     return 400
             # index may change over the time, it has to be called for each
             # request
-            index = self.index_strategy.get_index()
-            path = '%s%s%s/%s/%s' % (self.uri, self.index_prefix,
-                                     index, self.doc_type, _id)
-            res = requests.post(path, data=msg)
+            path = '%s/%s/%s' % (self.index_for_msg(obj), self.doc_type, _id)
+            res = self.request('post', path, data=msg)
             LOG.debug('Msg post target=%s' % path)
             LOG.debug('Msg posted with response code: %s' % res.status_code)
             return res.status_code
 
+    def make_bulk_item(self, msg):
+        """Render a single message as an index action for a bulk request."""
+        # a bulk request is split on new lines, a new line can only be
+        # white space in a json document so it is safe to replace it.
+        msg = msg.replace('\n', ' ')
+        if not self.id_field and not self.time_id:
+            return '{"index":{}}\n%s\n' % msg
+
+        obj = json.loads(msg)
+        meta = {}
+        if self.id_field:
+            meta['_id'] = obj.get(self.id_field)
+            if not meta['_id']:
+                LOG.error('Msg does not have required id field %s' %
+                          self.id_field)
+                return None
+        if self.time_id:
+            meta['_index'] = self.index_for_msg(obj)
+        action = json.dumps({'index': meta})
+        return '%s\n%s\n' % (action, msg)
+
+    def send_bulk_messages(self, msg):
+        """Send a body made of bulk actions to the _bulk endpoint.
+
+        Returns the status code of the request and the list of the items
+        which ElasticSearch failed to index.
+        """
+        LOG.debug('Prepare to send bulk messages.')
+        if self.drop_data:
+            return 204, []
+
+        index = self.index_strategy.get_index()
+        path = '%s%s/%s/_bulk' % (self.index_prefix, index, self.doc_type)
+        res = self.request('post', path, data=msg)
+        LOG.debug('Bulk post target=%s' % path)
+        LOG.debug('Bulk posted with response code: %s' % res.status_code)
+
+        errors = []
+        if res.status_code == 200:
+            obj = res.json()
+            if obj and obj.get('errors'):
+                for item in obj.get('items', []):
+                    for result in item.values():
+                        if result.get('status', 200) >= 300:
+                            errors.append(result)
+        return res.status_code, errors
+
     def get_messages(self, cond, q_string=""):
         LOG.debug('Prepare to get messages.')
         if cond:
             data = json.dumps(cond)
         else:
             data = {}
-        return requests.post(self.search_path + "?" + q_string, data=data)
+        return self.request('post', self.search_path + "?" + q_string,
+                            data=data)
+
+    def scroll_messages(self, cond):
+        """Get all the hits of a query, one page after the other.
+
+        The pages are read with the scroll api, the size of the query is
+        the size of a page. Each page is yielded as the list of its hits as
+        soon as it is read. An exception is raised when a page fails to be
+        read.
+        """
+        keep_alive = cfg.CONF.es_conn.scroll_keep_alive
+        size = cond.get('size') if cond else None
+        res = self.get_messages(cond, 'scroll=%s' % keep_alive)
+        scroll_id = None
+        try:
+            while True:
+                if res.status_code != 200:
+                    raise Exception('Scroll request failed with response '
+                                    'code %s' % res.status_code)
+                obj = res.json()
+                scroll_id = obj.get('_scroll_id')
+                hits = obj.get('hits', {}).get('hits', [])
+                if hits:
+                    yield hits
+                if not hits or not scroll_id or (size and len(hits) < size):
+                    return
+                res = self.request('post',
+                                   '_search/scroll?scroll=%s' % keep_alive,
+                                   data=scroll_id)
+        finally:
+            if scroll_id:
+                self.clear_scroll(scroll_id)
+
+    def clear_scroll(self, scroll_id):
+        """Free the context of a scroll, it times out otherwise."""
+        try:
+            self.request('delete', '_search/scroll', data=scroll_id)
+        except Exception:
+            LOG.exception('Failed to clear the ElasticSearch scroll.')
 
     def get_message_by_id(self, id):
         LOG.debug('Prepare to get messages by id.')
         path = self.search_path + '?q=_id:' + id
         LOG.debug('Search path:' + path)
-        res = requests.get(path)
+        res = self.request('get', path)
         LOG.debug('Msg get with response code: %s' % res.status_code)
         return res
 
@@ -110,10 +445,9 @@ class ESConnection(object):
             return 204
         else:
             index = self.index_strategy.get_index()
-            path = '%s%s%s/%s/' % (self.uri, self.index_prefix,
-                                   index, self.doc_type)
+            path = '%s%s/%s/' % (self.index_prefix, index, self.doc_type)
 
-            res = requests.post(path + id, data=msg)
+            res = self.request('post', path + id, data=msg)
             LOG.debug('Msg post with response code: %s' % res.status_code)
             return res.status_code
 
@@ -123,10 +457,9 @@ class ESConnection(object):
             return 204
         else:
             index = self.index_strategy.get_index()
-            path = '%s%s%s/%s/' % (self.uri, self.index_prefix,
-                                   index, self.doc_type)
+            path = '%s%s/%s/' % (self.index_prefix, index, self.doc_type)
 
-            res = requests.put(path + id, data=msg)
+            res = self.request('put', path + id, data=msg)
             LOG.debug('Msg put with response code: %s' % res.status_code)
             return res.status_code
 
@@ -136,9 +469,89 @@ class ESConnection(object):
             return 204
         else:
             index = self.index_strategy.get_index()
-            path = '%s%s%s/%s/' % (self.uri, self.index_prefix,
-                                   index, self.doc_type)
+            path = '%s%s/%s/' % (self.index_prefix, index, self.doc_type)
 
-            res = requests.delete(path + id)
+            res = self.request('delete', path + id)
             LOG.debug('Msg delete with response code: %s' % res.status_code)
             return res.status_code
+
+
+class ESBulkWriter(object):
+    """Buffer messages and write them to ElasticSearch in bulk requests.
+
+    The buffer is flushed to the _bulk endpoint of the connection when the
+    body reaches bulk_max_bytes, when bulk_max_docs documents are buffered
+    or when the oldest buffered document is older than bulk_max_linger
+    seconds.
+    """
+
+    def __init__(self, es_conn):
+        self._es_conn = es_conn
+        self.max_bytes = cfg.CONF.es_conn.bulk_max_bytes
+        self.max_docs = cfg.CONF.es_conn.bulk_max_docs
+        self.max_linger = cfg.CONF.es_conn.bulk_max_linger
+
+        self._buffer = []
+        self._bytes = 0
+        self._docs = 0
+        self._first_time = None
+
+    def add(self, msg):
+        """Buffer a document and flush the buffer if a limit is reached.
+
+        Returns the result of the flush or None if nothing was flushed.
+        """
+        item = self._es_conn.make_bulk_item(msg)
+        if not item:
+            return None
+        return self.add_bulk(item, 1)
+
+    def add_bulk(self, lines, ndocs):
+        """Buffer ndocs documents already rendered as bulk lines.
+
+        Returns the result of the flush or None if nothing was flushed.
+        """
+        if not self._buffer:
+            self._first_time = time.time()
+        self._buffer.append(lines)
+        self._bytes += len(lines)
+        self._docs += ndocs
+
+        if (self._bytes >= self.max_bytes or self._docs >= self.max_docs or
+                self.is_due()):
+            return self.flush()
+        return None
+
+    def is_due(self):
+        return (self._first_time is not None and
+                time.time() - self._first_time >= self.max_linger)
+
+    def flush_if_due(self):
+        if self.is_due():
+            return self.flush()
+        return None
+
+    def clear(self):
+        """Drop all the buffered messages."""
+        self._buffer = []
+        self._bytes = 0
+        self._docs = 0
+        self._first_time = None
+
+    def flush(self):
+        """Send all the buffered messages with one bulk request."""
+        if not self._buffer:
+            return 204, []
+
+        body = ''.join(self._buffer)
+        docs = self._docs
+        self.clear()
+
+        code, errors = self._es_conn.send_bulk_messages(body)
+        if code >= 300:
+            LOG.error('Bulk request of %s documents failed with response '
+                      'code %s' % (docs, code))
+        elif errors:
+            LOG.error('%s of %s documents failed to be indexed, first '
+                      'error: %s' % (len(errors), docs, errors[0]))
+        return code, errors
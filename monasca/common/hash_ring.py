@@ -0,0 +1,58 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import bisect
+import hashlib
+
+
+class HashRing(object):
+    """Consistent hash ring spreading keys over a set of nodes.
+
+    Every node is placed on the ring several times, a key belongs to the
+    first node found clockwise from the hash of the key. When a node joins
+    or leaves, only the keys next to its places move.
+    """
+
+    def __init__(self, nodes=None, replicas=100):
+        self.replicas = replicas
+        self.nodes = frozenset()
+        self._hashes = []
+        self._owners = []
+        self.set_nodes(nodes or [])
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def set_nodes(self, nodes):
+        """Replace the nodes of the ring, returns True if they changed."""
+        nodes = frozenset(nodes)
+        if nodes == self.nodes:
+            return False
+        points = []
+        for node in nodes:
+            for i in range(self.replicas):
+                points.append((HashRing._hash('%s-%s' % (node, i)), node))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+        self.nodes = nodes
+        return True
+
+    def get_node(self, key):
+        """Get the node a key belongs to, None when the ring is empty."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, HashRing._hash(key))
+        return self._owners[index % len(self._owners)]
@@ -64,7 +64,8 @@ LOG = log.getLogger(__name__)
 
 class KafkaConnection(object):
 
-    def __init__(self, topic):
+    def __init__(self, topic, auto_commit=None, partitions=None,
+                 group=None):
         if not cfg.CONF.kafka_opts.uri:
             raise Exception('Kafka is not configured correctly! '
                             'Use configuration file to specify Kafka '
@@ -73,14 +74,20 @@ class KafkaConnection(object):
 
         self.uri = cfg.CONF.kafka_opts.uri
         self.topic = topic
-        self.group = cfg.CONF.kafka_opts.group
+        self.group = group or cfg.CONF.kafka_opts.group
         self.wait_time = cfg.CONF.kafka_opts.wait_time
         self.async = cfg.CONF.kafka_opts.async
         self.ack_time = cfg.CONF.kafka_opts.ack_time
         self.max_retry = cfg.CONF.kafka_opts.max_retry
-        self.auto_commit = cfg.CONF.kafka_opts.auto_commit
+        # a caller turning auto commit off commits the offsets itself
+        self.manual_commit = auto_commit is False
+        if auto_commit is None:
+            auto_commit = cfg.CONF.kafka_opts.auto_commit
+        self.auto_commit = auto_commit
         self.compact = cfg.CONF.kafka_opts.compact
-        self.partitions = cfg.CONF.kafka_opts.partitions
+        if partitions is None:
+            partitions = cfg.CONF.kafka_opts.partitions
+        self.partitions = partitions
         self.drop_data = cfg.CONF.kafka_opts.drop_data
 
         self._client = None
@@ -129,6 +136,10 @@ class KafkaConnection(object):
                 self._client, self.group, self.topic,
                 auto_commit=self.auto_commit,
                 partitions=self.partitions)
+            if self.manual_commit:
+                # without auto commit the consumer starts from offset 0,
+                # resume from the offsets committed by the group instead.
+                self._consumer.fetch_last_known_offsets(self.partitions)
             LOG.debug('Consumer was created successfully.')
         except Exception:
             self._consumer = None
@@ -148,9 +159,38 @@ class KafkaConnection(object):
                           self.uri)
 
     def commit(self):
-        if self._consumer and self.auto_commit:
+        if self._consumer and (self.auto_commit or self.manual_commit):
             self._consumer.commit()
 
+    def seek_to_end(self):
+        """Skip the messages already in the topic, only get new ones."""
+        if not self._consumer:
+            self._init_consumer()
+        if self._consumer:
+            self._consumer.seek(0, 2)
+
+    def rewind(self):
+        """Restart consuming from the last committed offsets."""
+        self._consumer = None
+
+    def get_partition_ids(self):
+        """Get the ids of the partitions of the topic, None if it failed."""
+        try:
+            if not self._client:
+                self._init_client()
+            self._client.load_metadata_for_topics(self.topic)
+            return sorted(self._client.topic_partitions[self.topic])
+        except Exception:
+            LOG.exception('Kafka (%s) partitions of topic %s can not be read.'
+                          % (self.uri, self.topic))
+            return None
+
+    def set_partitions(self, partitions):
+        """Consume other partitions, from their last committed offsets."""
+        self.commit()
+        self.partitions = partitions
+        self._consumer = None
+
     def close(self):
         if self._client:
             self._consumer = None
@@ -175,6 +215,25 @@ class KafkaConnection(object):
             self._consumer = None
             yield None
 
+    def get_message_batch(self, count, timeout):
+        """Get up to count messages, waiting at most timeout seconds."""
+        if self.partitions == []:
+            # the consumer would read all of them
+            time.sleep(timeout)
+            return []
+        try:
+            if not self._consumer:
+                self._init_consumer()
+            return self._consumer.get_messages(count=count, block=True,
+                                               timeout=timeout)
+        except common.OffsetOutOfRangeError:
+            self._consumer.seek(0, 0)
+            LOG.error('Seems consumer has been down for a long time.')
+        except Exception as ex:
+            LOG.exception(ex)
+            self._consumer = None
+        return []
+
     def send_messages(self, messages):
         LOG.debug('Prepare to send messages.')
         if not messages or self.drop_data:
@@ -0,0 +1,118 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import hashlib
+import json
+from oslo.config import cfg
+import threading
+
+
+OPTS = [
+    cfg.IntOpt('size', default=10000,
+               help=('The number of series identities to keep, the least '
+                     'recently used ones are dropped first.')),
+]
+
+cfg.CONF.register_opts(OPTS, group="series_cache")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def dimensions_hash(dimensions):
+    """Compute the hash identifying a set of dimensions."""
+    key_str = json.dumps(dimensions, sort_keys=True, indent=None,
+                         separators=(',', ':'))
+    return hashlib.md5(key_str).hexdigest()
+
+
+def series_id(name, dimensions):
+    """Compute the id of the series of a metric name and its dimensions."""
+    key_str = json.dumps({'name': name, 'dimensions': dimensions or {}},
+                         sort_keys=True, indent=None, separators=(',', ':'))
+    return hashlib.md5(key_str).hexdigest()
+
+
+def get_series_cache():
+    """Get the series cache shared within the process."""
+    global _cache
+    with _cache_lock:
+        if not _cache:
+            _cache = SeriesCache(cfg.CONF.series_cache.size)
+    return _cache
+
+
+class SeriesCache(object):
+    """Bounded, thread safe LRU of series identities.
+
+    Series repeat every few seconds, so the hashes identifying them are
+    computed once per series instead of once per measurement.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, func, *args):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+                self.hits += 1
+            except KeyError:
+                value = None
+            if value is not None:
+                # most recently used keys are kept at the end
+                self._entries[key] = value
+                return value
+
+        value = func(*args)
+        with self._lock:
+            self.misses += 1
+            if key not in self._entries:
+                if len(self._entries) >= self.size:
+                    self._entries.popitem(last=False)
+                self._entries[key] = value
+        return value
+
+    def get_dimensions_hash(self, dimensions):
+        try:
+            key = (None, tuple(sorted(dimensions.items())))
+            hash(key)
+        except TypeError:
+            # unhashable dimension values can not be cached
+            return dimensions_hash(dimensions)
+        return self._get(key, dimensions_hash, dimensions)
+
+    def get_series_id(self, name, dimensions):
+        try:
+            key = (name, tuple(sorted((dimensions or {}).items())))
+            hash(key)
+        except TypeError:
+            return series_id(name, dimensions)
+        return self._get(key, series_id, name, dimensions)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
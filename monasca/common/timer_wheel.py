@@ -0,0 +1,111 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import math
+import time
+
+
+class TimerWheel(object):
+    """Hierarchical timer wheel firing keys at the times they are due.
+
+    Time is cut in ticks. Level 0 has a slot per tick for the next slots
+    ticks, every slot of level l covers slots ** l ticks. A timer is put
+    in the lowest level which reaches its tick and moves down a level
+    each time the clock reaches the slot it is in, so scheduling and
+    firing are O(1) whatever the number of timers.
+
+    A key has at most one timer, scheduling it again replaces it. The
+    slots are not cleaned when a timer is replaced or cancelled, the
+    stale entries are skipped when their slot is reached.
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=None):
+        self.tick = float(tick)
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for i in range(slots)] for j in range(levels)]
+        # the tick every key is due at
+        self.timers = {}
+        if now is None:
+            now = time.time()
+        self.current = int(now // self.tick)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def _place(self, key, due):
+        delta = max(due - self.current, 0)
+        level = 0
+        unit = 1
+        while delta >= unit * self.slots and level < self.levels - 1:
+            level += 1
+            unit *= self.slots
+        # beyond the wheels, wait in the farthest slot to come back
+        due = min(due, self.current + unit * self.slots - 1)
+        self.wheels[level][(due // unit) % self.slots].add(key)
+
+    def schedule(self, when, key):
+        """Fire key at time when, or at the next tick if it has passed."""
+        due = max(int(math.ceil(when / self.tick)), self.current + 1)
+        self.timers[key] = due
+        self._place(key, due)
+
+    def cancel(self, key):
+        self.timers.pop(key, None)
+
+    def advance(self, now):
+        """Move the clock to now, returns the keys which are due."""
+        target = int(now // self.tick)
+        fired = []
+        while self.current < target and self.timers:
+            self.current += 1
+            unit = 1
+            for level in range(1, self.levels):
+                unit *= self.slots
+                if self.current % unit:
+                    break
+                slot = (self.current // unit) % self.slots
+                keys = self.wheels[level][slot]
+                self.wheels[level][slot] = set()
+                for key in keys:
+                    if key in self.timers:
+                        self._place(key, self.timers[key])
+            slot = self.current % self.slots
+            keys = self.wheels[0][slot]
+            self.wheels[0][slot] = set()
+            for key in keys:
+                due = self.timers.get(key)
+                if due is None:
+                    continue
+                if due <= self.current:
+                    del self.timers[key]
+                    fired.append(key)
+                else:
+                    self._place(key, due)
+        self.current = max(self.current, target)
+        return fired
+
+    def next_due(self):
+        """Get the time advance should be called next, None if no timer.
+
+        It is the next busy slot of level 0 or the time the next slots of
+        the upper levels move down.
+        """
+        if not self.timers:
+            return None
+        end = (self.current // self.slots + 1) * self.slots
+        for tick in range(self.current + 1, end):
+            if self.wheels[0][tick % self.slots]:
+                return tick * self.tick
+        return end * self.tick
@@ -15,8 +15,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import multiprocessing
 from oslo.config import cfg
 from stevedore import driver
+import time
 
 from monasca.common import es_conn
 from monasca.common import kafka_conn
@@ -41,6 +43,20 @@ OPTS = [
                help=('The message processer to load to process the message.'
                      'If the message does not need to be process anyway,'
                      'leave the default')),
+    cfg.IntOpt('batch_size', default=1000,
+               help=('The maximum number of messages consumed as one batch. '
+                     'Each batch is written with bulk requests and its '
+                     'offsets are committed to kafka only once ElasticSearch '
+                     'acknowledged it.')),
+    cfg.IntOpt('batch_timeout', default=1000,
+               help=('The maximum time in milliseconds to wait for a batch '
+                     'to fill up.')),
+    cfg.IntOpt('workers', default=1,
+               help=('The number of worker processes consuming messages. '
+                     'The kafka partitions are divided among the workers, '
+                     'each one with its own kafka consumer, message '
+                     'processor and ElasticSearch writer. 0 starts one '
+                     'worker per partition.')),
 ]
 
 cfg.CONF.register_opts(OPTS, group="es_persister")
@@ -48,12 +64,17 @@ cfg.CONF.register_opts(OPTS, group="es_persister")
 LOG = log.getLogger(__name__)
 
 
-class ESPersister(os_service.Service):
+class ESPersisterWorker(object):
+    """Store the messages of some kafka partitions into ElasticSearch."""
 
-    def __init__(self, threads=1000):
-        super(ESPersister, self).__init__(threads)
+    def __init__(self, partitions=None):
+        self.batch_size = max(1, cfg.CONF.es_persister.batch_size)
+        self.batch_timeout = cfg.CONF.es_persister.batch_timeout / 1000.0
+        self._running = True
+        # offsets are committed once a batch is stored.
         self._kafka_conn = kafka_conn.KafkaConnection(
-            cfg.CONF.es_persister.topic)
+            cfg.CONF.es_persister.topic, auto_commit=False,
+            partitions=partitions)
 
         # load index strategy
         if cfg.CONF.es_persister.index_strategy:
@@ -76,6 +97,7 @@ class ESPersister(os_service.Service):
         # create connection to ElasticSearch
         self._es_conn = es_conn.ESConnection(
             self.doc_type, self.index_strategy, self.index_prefix)
+        self._bulk_writer = es_conn.ESBulkWriter(self._es_conn)
 
         # load message processor
         if cfg.CONF.es_persister.processor:
@@ -88,24 +110,125 @@ class ESPersister(os_service.Service):
         else:
             self.msg_processor = None
 
-    def start(self):
-        while True:
+        # store messages in the index of their own time
+        if (self._es_conn.time_id and
+                hasattr(self.msg_processor, 'set_index_router')):
+            self.msg_processor.set_index_router(self._es_conn.index_for_msg)
+
+    def _add_msg(self, msg):
+        LOG.debug(msg.message.value)
+        if not self.msg_processor:
+            return self._bulk_writer.add(msg.message.value)
+        # processors render each document as an action line and a
+        # source line, both dumped by json without raw new lines.
+        lines = self.msg_processor.process_msg(msg.message.value)
+        if not lines:
+            return None
+        return self._bulk_writer.add_bulk(lines, lines.count('\n') // 2)
+
+    @staticmethod
+    def _is_acked(result):
+        code, errors = result
+        if code >= 300:
+            return False
+        # documents rejected because of their content will never be
+        # indexed, only retry when ElasticSearch was busy or failing.
+        for error in errors:
+            status = error.get('status')
+            if status is None or status == 429 or status >= 500:
+                return False
+        return True
+
+    def consume_batch(self):
+        """Store one batch of messages and commit it once acknowledged."""
+        messages = self._kafka_conn.get_message_batch(self.batch_size,
+                                                      self.batch_timeout)
+        if not messages:
+            return
+
+        try:
+            results = []
+            for msg in messages:
+                if msg and msg.message:
+                    results.append(self._add_msg(msg))
+            results.append(self._bulk_writer.flush())
+            acked = all(self._is_acked(result)
+                        for result in results if result)
+        except Exception:
+            LOG.exception('Error occurred while storing a batch of messages.')
+            acked = False
+
+        if acked:
+            self._kafka_conn.commit()
+        else:
+            # consume the batch again from the last committed offsets
+            LOG.error('Batch of %s messages was not stored, retrying.'
+                      % len(messages))
+            self._bulk_writer.clear()
+            self._kafka_conn.rewind()
+            time.sleep(self._kafka_conn.wait_time)
+
+    def run(self):
+        while self._running:
             try:
-                for msg in self._kafka_conn.get_messages():
-                    if msg and msg.message:
-                        LOG.debug(msg.message.value)
-                        if self.msg_processor:
-                            value = self.msg_processor.process_msg(
-                                msg.message.value)
-                        else:
-                            value = msg.message.value
-                        if value:
-                            self._es_conn.send_messages(value)
-                # if autocommit is set, this will be a no-op call.
-                self._kafka_conn.commit()
+                self.consume_batch()
             except Exception:
                 LOG.exception('Error occurred while handling kafka messages.')
 
     def stop(self):
+        self._running = False
+        try:
+            self._bulk_writer.flush()
+        except Exception:
+            LOG.exception('Error occurred while flushing buffered messages.')
         self._kafka_conn.close()
+
+
+def run_worker(partitions):
+    """Run a worker in a process of its own."""
+    worker = ESPersisterWorker(partitions)
+    try:
+        worker.run()
+    finally:
+        worker.stop()
+
+
+class ESPersister(os_service.Service):
+
+    def __init__(self, threads=1000):
+        super(ESPersister, self).__init__(threads)
+        partitions = list(cfg.CONF.kafka_opts.partitions)
+        workers = cfg.CONF.es_persister.workers or len(partitions)
+        workers = max(1, min(workers, len(partitions)))
+        self.worker_partitions = [partitions[i::workers]
+                                  for i in range(workers)]
+        self._worker = None
+        self._processes = []
+        if workers == 1:
+            self._worker = ESPersisterWorker(partitions)
+
+    def start(self):
+        if self._worker:
+            self._worker.run()
+            return
+
+        # each worker gets its own process so that ingest is not bound to
+        # one core, clients are created after the fork.
+        for partitions in self.worker_partitions:
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(partitions,))
+            process.start()
+            LOG.debug('Started worker %s for partitions %s'
+                      % (process.pid, partitions))
+            self._processes.append(process)
+        for process in self._processes:
+            process.join()
+
+    def stop(self):
+        if self._worker:
+            self._worker.stop()
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
         super(ESPersister, self).stop()
\ No newline at end of file
@@ -38,4 +38,7 @@ class FixedStrategy(object):
         LOG.debug('EmptyStrategy initialized successfully!')
 
     def get_index(self):
-        return self.index_name
\ No newline at end of file
+        return self.index_name
+
+    def get_index_for(self, a_date):
+        return self.index_name
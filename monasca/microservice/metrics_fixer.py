@@ -15,46 +15,68 @@
 # under the License.
 
 
-import hashlib
 import json
 import time
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
+from monasca.common import series_cache
 from monasca.openstack.common import log
 
 LOG = log.getLogger(__name__)
 
+BULK_INDEX_ACTION = '{"index":{}}\n'
+
+
+def _loads(msg):
+    if ujson:
+        # without precise_float ujson may round the last digits
+        return ujson.loads(msg, precise_float=True)
+    return json.loads(msg)
+
 
 class MetricsFixer(object):
     def __init__(self):
         LOG.debug('initializing MetricsFixer!')
         super(MetricsFixer, self).__init__()
+        self._series_cache = series_cache.get_series_cache()
+        self._index_router = None
+
+    def set_index_router(self, router):
+        """Route each message to the index returned by router(message)."""
+        self._index_router = router
 
-    @staticmethod
-    def _add_hash(message):
+    def _add_hash(self, message):
         # If there is no timestamp, we need to fix that up
         if not message.get('timestamp'):
             message['timestamp'] = time.time()
 
         # fixup the dimensions_hash
         if not message.get('dimensions_hash') and message.get('dimensions'):
-            key_str = json.dumps(message['dimensions'],
-                                 sort_keys=True, indent=None,
-                                 separators=(',', ':'))
-            message['dimensions_hash'] = hashlib.md5(key_str).hexdigest()
+            message['dimensions_hash'] = (
+                self._series_cache.get_dimensions_hash(message['dimensions']))
 
-        return json.dumps(message, sort_keys=False, indent=None,
-                          separators=(',', ':'))
+        # ujson rounds floats to 9 decimals, json keeps every digit
+        return json.dumps(message, separators=(',', ':'))
 
     def process_msg(self, msg):
         try:
-            data = json.loads(msg)
+            data = _loads(msg)
             if not isinstance(data, list):
                 data = [data]
-            result = ''
+            result = []
             for item in data:
-                result += '{"index":{}}\n' + MetricsFixer._add_hash(item)
-                result += '\n'
-            return result
+                source = self._add_hash(item)
+                if self._index_router:
+                    result.append('{"index":{"_index":"%s"}}\n' %
+                                  self._index_router(item))
+                else:
+                    result.append(BULK_INDEX_ACTION)
+                result.append(source)
+                result.append('\n')
+            return ''.join(result)
         except Exception:
             LOG.exception('')
             return ''
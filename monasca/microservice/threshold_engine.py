@@ -15,17 +15,27 @@
 # under the License.
 
 
+import multiprocessing
+import Queue
+import socket
+
+from monasca.common import alarm_expr_parser as parser
 from monasca.common import es_conn
+from monasca.common import hash_ring
 from monasca.common import kafka_conn
 from monasca.common import namespace
+from monasca.common import timer_wheel
 from monasca.openstack.common import log
 from monasca.openstack.common import service as os_service
 from oslo.config import cfg
 from stevedore import driver
 import threading
 import time
-
-lock = threading.RLock()
+try:
+    import ujson as json
+except ImportError:
+    import json
+import zlib
 
 THRESHOLD_ENGINE_OPTS = [
     cfg.StrOpt('metrics_topic',
@@ -38,7 +48,55 @@ THRESHOLD_ENGINE_OPTS = [
                default='thresholding_processor',
                help='the thresh processor'),
     cfg.IntOpt('check_alarm_interval',
-               default=60)
+               default=60,
+               help=('The longest time in seconds between two evaluations '
+                     'of an alarm definition. Definitions are evaluated '
+                     'when they get metrics and at their period '
+                     'boundaries, this only matters for longer periods.')),
+    cfg.FloatOpt('evaluation_delay',
+                 default=0.5,
+                 help=('The time in seconds the series which got metrics '
+                       'wait before being evaluated, so a burst of metrics '
+                       'is evaluated once.')),
+    cfg.IntOpt('workers',
+               default=1,
+               help=('The number of workers evaluating alarms. Alarm '
+                     'definitions are sharded across the workers by id, '
+                     'each worker owns the processors of its shard.')),
+    cfg.StrOpt('worker_type',
+               default='thread',
+               help=('Run the workers as thread or as process. Processes '
+                     'let the evaluation use several cores.')),
+    cfg.BoolOpt('partitioned',
+                default=False,
+                help=('Share the alarm definitions between all the engine '
+                      'instances running in partitioned mode. Each instance '
+                      'evaluates the definitions it owns on a consistent '
+                      'hash ring of the live instances. The partitions of '
+                      'the metrics topic are spread on the same ring: each '
+                      'instance reads its partitions in the shared group, '
+                      'and sends the metrics of the definitions owned by '
+                      'other instances to their own topic, '
+                      '<metrics_topic>_<instance_id>.')),
+    cfg.StrOpt('instance_id',
+               default='',
+               help=('The id of this engine instance in partitioned mode, '
+                     'the host name is used if not set. It has to be unique '
+                     'and stable across restarts.')),
+    cfg.StrOpt('membership_doc_type',
+               default='thresholdengines',
+               help=('The doc_type the heartbeats of the engine instances '
+                     'are saved to.')),
+    cfg.IntOpt('heartbeat_interval',
+               default=10,
+               help=('The time in seconds between two heartbeats of an '
+                     'instance in partitioned mode, the instances sharing '
+                     'the definitions are read again at each one.')),
+    cfg.IntOpt('instance_timeout',
+               default=30,
+               help=('The time in seconds after which an instance without '
+                     'heartbeat is considered gone. It should be a few '
+                     'times heartbeat_interval.')),
 ]
 ALARM_DEFINITION_OPTS = [
     cfg.StrOpt('doc_type', default='alarmdefinitions',
@@ -54,8 +112,23 @@ ALARM_DEFINITION_OPTS = [
                help='The name for query alarm definitions.'),
     cfg.StrOpt('dimensions', default='',
                help='The dimensions for query alarm definitions.'),
+    cfg.StrOpt('events_topic', default='alarmdefinitionevents',
+               help=('The kafka topic the changes of alarm definitions are '
+                     'published to, so the threshold engines apply them '
+                     'right away. Empty to publish nothing.')),
     cfg.IntOpt('check_alarm_def_interval',
-               default=120)
+               default=120,
+               help=('The time in seconds between two reconciliations of '
+                     'the alarm definitions with ElasticSearch. Only the '
+                     'definitions updated since the previous one are '
+                     'read, with the ids of all of them to find the '
+                     'deleted ones.')),
+    cfg.IntOpt('clock_skew',
+               default=60,
+               help=('The time in seconds the clocks of the api and of the '
+                     'threshold engines may differ by. The definitions '
+                     'updated and the events published that much before '
+                     'the last reconciliation are still applied.'))
 ]
 
 
@@ -65,39 +138,376 @@ cfg.CONF.register_opts(ALARM_DEFINITION_OPTS, group="alarmdefinitions")
 LOG = log.getLogger(__name__)
 
 
+class MetricRouter(object):
+    """Index the alarm definitions by the metrics they consume.
+
+    Metric names map to the alarm definitions using them, along with the
+    dimensions each of their sub expressions requires, so a metric is only
+    delivered to the processors which consume it. Definitions whose
+    expression can not be parsed get every metric.
+    """
+    def __init__(self):
+        # metric name -> {alarm def id: [dimensions, ...]}
+        self._by_name = {}
+        # alarm def id -> metric names
+        self._names = {}
+        self._any = frozenset()
+        # the index is replaced rather than changed in place, so metrics
+        # are matched without taking the lock.
+        self._lock = threading.Lock()
+
+    def add(self, aid, matchers):
+        """Register, or register again, the sub expressions of a definition.
+
+        matchers are the SubExprMatcher of the definition expression, None
+        when it can not be parsed.
+        """
+        with self._lock:
+            by_name, any_aids = self._without(aid)
+            if matchers is None:
+                any_aids = any_aids | set([aid])
+            else:
+                for matcher in matchers:
+                    entries = dict(by_name.get(matcher.name, {}))
+                    entries[aid] = (entries.get(aid, []) +
+                                    [matcher.dimensions])
+                    by_name[matcher.name] = entries
+                self._names[aid] = set(matcher.name for matcher in matchers)
+            self._by_name, self._any = by_name, any_aids
+
+    def remove(self, aid):
+        with self._lock:
+            self._by_name, self._any = self._without(aid)
+
+    def _without(self, aid):
+        by_name = dict(self._by_name)
+        for name in self._names.pop(aid, ()):
+            entries = dict(by_name[name])
+            entries.pop(aid, None)
+            if entries:
+                by_name[name] = entries
+            else:
+                del by_name[name]
+        return by_name, self._any - set([aid])
+
+    @staticmethod
+    def _has_dimensions(metric_dimensions, dimensions):
+        for key, value in dimensions:
+            try:
+                if metric_dimensions[key].lower() != value:
+                    return False
+            except (KeyError, AttributeError):
+                return False
+        return True
+
+    def match(self, metric):
+        """Get the ids of the alarm definitions consuming a metric."""
+        by_name = self._by_name
+        aids = set(self._any)
+        try:
+            name = metric['name'].lower()
+            metric_dimensions = metric.get('dimensions') or {}
+        except Exception:
+            return aids
+        for aid, dimensions_list in by_name.get(name, {}).items():
+            for dimensions in dimensions_list:
+                if MetricRouter._has_dimensions(metric_dimensions,
+                                                dimensions):
+                    aids.add(aid)
+                    break
+        return aids
+
+
+class EngineMembership(object):
+    """Track the engine instances sharing the alarm definitions.
+
+    Each instance keeps a heartbeat document in ElasticSearch, the live
+    instances make a consistent hash ring deciding which instance owns
+    which alarm definition.
+    """
+    def __init__(self, es_connection, instance_id):
+        self.instance_id = instance_id
+        self.timeout = cfg.CONF.thresholdengine.instance_timeout
+        self._es_conn = es_connection
+        self.ring = hash_ring.HashRing([instance_id])
+        # the ring only has this instance until the others are read
+        self.refreshed = False
+
+    def heartbeat(self):
+        msg = json.dumps({'id': self.instance_id, 'heartbeat': time.time()})
+        return self._es_conn.put_messages(msg, self.instance_id)
+
+    def get_members(self):
+        """Get the ids of the live instances, None if it failed."""
+        cond = {'query': {'range': {'heartbeat': {
+            'gte': time.time() - self.timeout}}}, 'size': 1000}
+        res = self._es_conn.get_messages(cond)
+        if res and res.status_code == 200:
+            obj = res.json()
+            return [hit['_source']['id'] for hit in obj['hits']['hits']]
+        return None
+
+    def refresh(self):
+        """Send a heartbeat and update the ring.
+
+        Returns True when the instances changed.
+        """
+        try:
+            self.heartbeat()
+            members = self.get_members()
+        except Exception:
+            LOG.exception('Error occurred while refreshing engine instances.')
+            return False
+        if members is None:
+            return False
+        # the heartbeat just sent may not be searchable yet
+        members = set(members) | set([self.instance_id])
+        changed = self.ring.set_nodes(members)
+        self.refreshed = True
+        if changed:
+            LOG.info('Threshold engine instances: %s' % sorted(members))
+        return changed
+
+    def owns(self, aid):
+        return self.ring.get_node(aid) == self.instance_id
+
+
+def get_instance_id():
+    return cfg.CONF.thresholdengine.instance_id or socket.gethostname()
+
+
+class ThresholdShard(object):
+    """Evaluate the alarm definitions of one shard.
+
+    The shard owns the processors of its alarm definitions, only the
+    worker running the shard touches them. Definitions and metrics reach
+    it through its inbox, produced alarms are put in the outbox shared by
+    all the shards.
+
+    Nothing is scanned at fixed intervals: the definitions which got
+    metrics are marked dirty and only their series with new metrics are
+    evaluated, evaluation_delay later. Every series also has a timer on
+    the timer wheel of the shard, for its next period boundary or its
+    expiry, and is evaluated again when it fires.
+    """
+    def __init__(self, index, inbox, outbox):
+        self.index = index
+        self.processors = {}
+        self.inbox = inbox
+        self.outbox = outbox
+        self.dirty = set()
+        self.dirty_since = None
+        # timers of the (aid, series name) to evaluate
+        self.timers = timer_wheel.TimerWheel()
+        self.delay = cfg.CONF.thresholdengine.evaluation_delay
+        self.interval = cfg.CONF.thresholdengine.check_alarm_interval
+
+    def define(self, aid, alarm_def):
+        self.inbox.put(('define', aid, alarm_def))
+
+    def delete(self, aid):
+        self.inbox.put(('delete', aid))
+
+    def send_metrics(self, metric, aids):
+        self.inbox.put(('metrics', metric, aids))
+
+    def stop(self):
+        self.inbox.put(None)
+
+    def _create_processor(self, alarm_def):
+        return driver.DriverManager(
+            namespace.PROCESSOR_NS,
+            cfg.CONF.thresholdengine.processor,
+            invoke_on_load=True,
+            invoke_args=(alarm_def,)).driver
+
+    def mark_dirty(self, aid):
+        if not self.dirty:
+            self.dirty_since = time.time()
+        self.dirty.add(aid)
+
+    def handle(self, item):
+        action = item[0]
+        if action == 'metrics':
+            metric, aids = item[1:]
+            for aid in aids:
+                if aid in self.processors:
+                    self.processors[aid].process_metrics(metric)
+                    self.mark_dirty(aid)
+        elif action == 'define':
+            aid, alarm_def = item[1:]
+            if aid in self.processors:
+                if self.processors[aid].update_thresh_processor(alarm_def):
+                    LOG.debug('alarm definition updates successfully!')
+                else:
+                    LOG.debug('alarm definition update fail!')
+                self.evaluate_series(aid, None, time.time())
+            else:
+                self.processors[aid] = self._create_processor(alarm_def)
+        elif action == 'delete':
+            # the timers of its series are dropped when they fire
+            self.processors.pop(item[1], None)
+            self.dirty.discard(item[1])
+
+    def evaluate_series(self, aid, names, now, early=False):
+        """Evaluate series of a definition, all of them if names is None.
+
+        The timers of the series are set again, to the next time the
+        processor needs them evaluated but no later than interval. Early,
+        the series which got metrics may go to ALARM before the end of
+        the period in progress.
+        """
+        processor = self.processors.get(aid)
+        if processor is None:
+            return
+        if names is None:
+            names = processor.series_names()
+        for alarm in processor.process_alarms(names, early):
+            self.outbox.put(alarm)
+        for name in names:
+            when = processor.next_evaluation(now, name)
+            if when is None:
+                self.timers.cancel((aid, name))
+            else:
+                self.timers.schedule(min(when, now + self.interval),
+                                     (aid, name))
+
+    def evaluate_due(self, now):
+        """Evaluate the series whose timer fired and the dirty ones."""
+        due = {}
+        for aid, name in self.timers.advance(now):
+            due.setdefault(aid, set()).add(name)
+        dirty = {}
+        if self.dirty and now >= self.dirty_since + self.delay:
+            for aid in self.dirty:
+                processor = self.processors.get(aid)
+                if processor is not None:
+                    dirty[aid] = processor.pop_dirty()
+            self.dirty = set()
+        for aid, names in due.items():
+            names = names - dirty.get(aid, set())
+            if names:
+                self.evaluate_series(aid, names, now)
+        for aid, names in dirty.items():
+            self.evaluate_series(aid, names, now, early=True)
+
+    def get_wait(self, now):
+        """Get the time until the next evaluation is due."""
+        wait = self.interval
+        next_due = self.timers.next_due()
+        if next_due is not None:
+            wait = min(wait, next_due - now)
+        if self.dirty:
+            wait = min(wait, self.dirty_since + self.delay - now)
+        return max(wait, 0)
+
+    def process_pending(self):
+        """Handle the items in the inbox without waiting for more."""
+        while True:
+            try:
+                item = self.inbox.get_nowait()
+            except Queue.Empty:
+                return
+            if item is None:
+                return
+            self.handle(item)
+
+    def run(self):
+        while True:
+            try:
+                item = self.inbox.get(timeout=self.get_wait(time.time()))
+            except Queue.Empty:
+                item = False
+            if item is None:
+                break
+            try:
+                if item:
+                    self.handle(item)
+                self.evaluate_due(time.time())
+            except Exception:
+                LOG.exception('Error occurred in threshold shard %s.'
+                              % self.index)
+
+
+class ShardSet(object):
+    """The shards alarm definitions are spread over by id."""
+    def __init__(self, workers=1, worker_type='thread'):
+        self.worker_type = worker_type
+        if worker_type == 'process':
+            queue_class = multiprocessing.Queue
+        else:
+            queue_class = Queue.Queue
+        self.outbox = queue_class()
+        self.shards = [ThresholdShard(i, queue_class(), self.outbox)
+                       for i in range(max(1, workers))]
+        self._workers = []
+
+    def get_shard(self, aid):
+        index = (zlib.crc32(str(aid)) & 0xffffffff) % len(self.shards)
+        return self.shards[index]
+
+    def send_metrics(self, metric, aids):
+        by_shard = {}
+        for aid in aids:
+            by_shard.setdefault(self.get_shard(aid), []).append(aid)
+        for shard, shard_aids in by_shard.items():
+            shard.send_metrics(metric, shard_aids)
+
+    def start(self):
+        for shard in self.shards:
+            if self.worker_type == 'process':
+                worker = multiprocessing.Process(target=shard.run)
+            else:
+                worker = threading.Thread(target=shard.run,
+                                          name='threshold_shard_%s'
+                                               % shard.index)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+        for worker in self._workers:
+            worker.join(1)
+
+
 class AlarmPublisher(threading.Thread):
     """The thread to publish alarm messages.
 
-    This class will periodically call processors to get alarms produced,
-    and send them into kafka
+    This class will send the alarms produced by the shards into kafka,
+    the shards evaluate their alarms as metrics come and time goes.
     """
-    def __init__(self, t_name, tp):
+    def __init__(self, t_name, shards=None):
         threading.Thread.__init__(self, name=t_name)
         # init kafka connection to alarm topic
         self._publish_kafka_conn = None
         topic = cfg.CONF.thresholdengine.alarm_topic
         self._publish_kafka_conn = (
             kafka_conn.KafkaConnection(topic))
-        # set time interval for calling processors to refresh alarms
+        # set time interval to wait for alarms
         self.interval = cfg.CONF.thresholdengine.check_alarm_interval
-        self.threshold_processors = tp
+        self.shards = shards or ShardSet()
 
-    def send_alarm(self):
-        if self._publish_kafka_conn:
-            if lock.acquire():
-                for aid in self.threshold_processors:
-                    # get alarms produced by each processor
-                    for alarm in (self.threshold_processors
-                                  [aid]['processor'].process_alarms()):
-                        LOG.debug(alarm)
-                        self._publish_kafka_conn.send_messages(alarm)
-            lock.release()
+    def publish_alarms(self, timeout=0):
+        """Send the produced alarms, waiting up to timeout for more."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                wait = deadline - time.time()
+                if wait > 0:
+                    alarm = self.shards.outbox.get(timeout=wait)
+                else:
+                    alarm = self.shards.outbox.get_nowait()
+            except Queue.Empty:
+                return
+            LOG.debug(alarm)
+            self._publish_kafka_conn.send_messages(alarm)
 
     def run(self):
         while True:
             try:
-                self.send_alarm()
-                time.sleep(self.interval)
+                self.publish_alarms(self.interval)
             except Exception:
                 LOG.exception(
                     'Error occurred while publishing alarm messages.')
@@ -111,30 +521,129 @@ class MetricsConsumer(threading.Thread):
 
     This class will get metrics messages from kafka,
     and deliver them to processors.
+
+    In partitioned mode, it reads the partitions of the metrics topic the
+    ring assigns to this instance, and sends the metrics of the alarm
+    definitions owned by other instances to their own topic. The metrics
+    sent to the topic of this instance are read too.
     """
-    def __init__(self, t_name, tp):
+    batch_size = 1000
+    batch_timeout = 1.0
+
+    def __init__(self, t_name, router=None, shards=None, membership=None):
         threading.Thread.__init__(self, name=t_name)
         # init kafka connection to metrics topic
         self._consume_kafka_conn = None
         topic = cfg.CONF.thresholdengine.metrics_topic
         self._consume_kafka_conn = kafka_conn.KafkaConnection(topic)
-        self.threshold_processors = tp
+        self.metric_router = router or MetricRouter()
+        self.shards = shards or ShardSet()
+        # the instances sharing the alarm definitions in partitioned mode
+        self.membership = membership
+        self._nodes = None
+        self._owned_kafka_conn = None
+        self._forward_kafka_conns = {}
+        if membership:
+            # nothing is read until the ring assigns the partitions
+            self._consume_kafka_conn.partitions = []
+            # the metrics are forwarded to any partition of the topic
+            self._owned_kafka_conn = kafka_conn.KafkaConnection(
+                MetricsConsumer.get_topic(membership.instance_id),
+                partitions=[])
 
-    def read_metrics(self):
-        def consume_metrics():
-            if lock.acquire():
-                # send metrics to each processor
-                for aid in self.threshold_processors:
-                    processor = self.threshold_processors[aid]['processor']
-                    processor.process_metrics(msg.message.value)
-            lock.release()
+    @staticmethod
+    def get_topic(instance_id):
+        """Get the topic the metrics of an instance are sent to."""
+        return '%s_%s' % (cfg.CONF.thresholdengine.metrics_topic,
+                          instance_id)
+
+    @staticmethod
+    def decode_metrics(value):
+        """Decode a metrics message into a list of metrics.
+
+        A message holds a metric, a list of metrics, or the envelope made by
+        the metric validator: {'metric': ..., 'meta': ...}.
+        """
+        data = json.loads(value)
+        if isinstance(data, dict) and 'metric' in data and 'name' not in data:
+            data = data['metric']
+        if not isinstance(data, list):
+            data = [data]
+        return data
+
+    def assign_partitions(self):
+        """Read the partitions the ring assigns to this instance."""
+        if self._owned_kafka_conn.partitions == []:
+            partition_ids = self._owned_kafka_conn.get_partition_ids()
+            if partition_ids:
+                self._owned_kafka_conn.set_partitions(partition_ids)
+        if not self.membership.refreshed:
+            return
+        nodes = self.membership.ring.nodes
+        if nodes == self._nodes:
+            return
+        partition_ids = self._consume_kafka_conn.get_partition_ids()
+        if partition_ids is None:
+            return
+        ring = self.membership.ring
+        partitions = [p for p in partition_ids
+                      if ring.get_node('partition-%s' % p) ==
+                      self.membership.instance_id]
+        LOG.info('Read the partitions %s of the metrics topic.' % partitions)
+        self._consume_kafka_conn.set_partitions(partitions)
+        self._nodes = nodes
+
+    def forward_metrics(self, owner, metrics):
+        """Send metrics to the topic of the instance owning them."""
+        conn = self._forward_kafka_conns.get(owner)
+        if conn is None:
+            conn = kafka_conn.KafkaConnection(MetricsConsumer.get_topic(owner))
+            self._forward_kafka_conns[owner] = conn
+        if conn.send_messages(json.dumps(metrics)) != 204:
+            LOG.error('Failed to send %s metrics to instance %s.'
+                      % (len(metrics), owner))
+
+    def consume_metrics(self, conn, forward):
+        """Send the metrics read from conn to the shards consuming them.
 
+        The processors get the decoded metrics. With forward, the metrics
+        of the definitions owned by other instances are sent to them.
+        """
+        forwarded = {}
+        for msg in conn.get_message_batch(self.batch_size,
+                                          self.batch_timeout):
+            if not msg or not msg.message:
+                continue
+            LOG.debug(msg.message.value)
+            try:
+                metrics = MetricsConsumer.decode_metrics(msg.message.value)
+            except Exception:
+                LOG.error('Received a wrong format metrics')
+                continue
+            for metric in metrics:
+                aids = self.metric_router.match(metric)
+                if aids and self.membership:
+                    owners = {}
+                    for aid in aids:
+                        owner = self.membership.ring.get_node(aid)
+                        owners.setdefault(owner, set()).add(aid)
+                    aids = owners.pop(self.membership.instance_id, None)
+                    if forward:
+                        for owner in owners:
+                            forwarded.setdefault(owner, []).append(metric)
+                if aids:
+                    self.shards.send_metrics(metric, aids)
+        for owner, metrics in forwarded.items():
+            self.forward_metrics(owner, metrics)
+        conn.commit()
+
+    def read_metrics(self):
+        if self.membership:
+            self.assign_partitions()
         if self._consume_kafka_conn:
-            for msg in self._consume_kafka_conn.get_messages():
-                if msg and msg.message:
-                    LOG.debug(msg.message.value)
-                    consume_metrics()
-            self._consume_kafka_conn.commit()
+            self.consume_metrics(self._consume_kafka_conn, True)
+        if self._owned_kafka_conn:
+            self.consume_metrics(self._owned_kafka_conn, False)
 
     def run(self):
         while True:
@@ -145,16 +654,27 @@ class MetricsConsumer(threading.Thread):
 
     def stop(self):
         self._consume_kafka_conn.close()
+        if self._owned_kafka_conn:
+            self._owned_kafka_conn.close()
+        for conn in self._forward_kafka_conns.values():
+            conn.close()
 
 
 class AlarmDefinitionConsumer(threading.Thread):
     """The thread to process alarm definitions.
 
-    This class will get alarm definition messages from kafka,
-    Then init new processor, update existing processor or delete processor
-    according to the request.
+    This class will get alarm definition events from kafka, route the
+    metrics of each definition and send it to the shard owning it, which
+    creates, updates or deletes its processor. Every
+    check_alarm_def_interval, the definitions are reconciled with
+    ElasticSearch in case events were lost, reading only those updated
+    since the previous reconciliation.
+
+    In partitioned mode, the metrics of all the definitions are routed but
+    only the owned ones are sent to the shards. A heartbeat is sent every
+    heartbeat_interval, and the definitions which changed owner are moved.
     """
-    def __init__(self, t_name, tp):
+    def __init__(self, t_name, tp, router=None, shards=None):
         threading.Thread.__init__(self, name=t_name)
 
         self.doc_type = cfg.CONF.alarmdefinitions.doc_type
@@ -174,11 +694,34 @@ class AlarmDefinitionConsumer(threading.Thread):
             self.doc_type, self.index_strategy, self.index_prefix)
         # get the dict where all processors are indexed
         self.threshold_processors = tp
+        # the index of the metrics consumed by the processors
+        self.metric_router = router or MetricRouter()
+        # the shards evaluating the alarm definitions
+        self.shards = shards or ShardSet()
         # get the time interval to query es
         self.interval = cfg.CONF.alarmdefinitions.check_alarm_def_interval
-        # set the flag, which is used to determine if a processor is expired
-        # each processor will has its flag, if same with self.flag, it's valid
-        self.flag = 0
+        # the definitions are stamped by the clock of the api
+        self.skew = cfg.CONF.alarmdefinitions.clock_skew
+        # the time of the last reconciliation, None until a full one is done
+        self.last_sync = None
+        # the events older than the last full reconciliation are outdated
+        self.last_refresh = None
+        # every instance needs all the alarm definition events
+        self._events_kafka_conn = None
+        if cfg.CONF.alarmdefinitions.events_topic:
+            self._events_kafka_conn = kafka_conn.KafkaConnection(
+                cfg.CONF.alarmdefinitions.events_topic,
+                group='%s_%s' % (cfg.CONF.kafka_opts.group,
+                                 get_instance_id()))
+        # the instances sharing the alarm definitions in partitioned mode
+        self.membership = None
+        self.heartbeat_interval = cfg.CONF.thresholdengine.heartbeat_interval
+        if cfg.CONF.thresholdengine.partitioned:
+            self.membership = EngineMembership(
+                es_conn.ESConnection(
+                    cfg.CONF.thresholdengine.membership_doc_type,
+                    self.index_strategy, self.index_prefix),
+                get_instance_id())
         # setup query params
         self.params = self._build_alarm_definitions_query(
             cfg.CONF.alarmdefinitions.name,
@@ -206,98 +749,246 @@ class AlarmDefinitionConsumer(threading.Thread):
         query = {'query': {'bool': {'must': queries}}}
         return query
 
-    def _get_alarm_definitions_response(self, res):
-        if res and res.status_code == 200:
-            obj = res.json()
-            if obj:
-                return obj.get('hits')
-        return None
+    def _get_query(self, since=None, ids_only=False):
+        """Get the query for the definitions, or their ids only.
+
+        With since, only the definitions updated since then are queried.
+        """
+        query = {'query': {'bool': {
+            'must': list(self.params['query']['bool']['must'])}},
+            'size': self.size}
+        if since is not None:
+            # definitions stored before updated_timestamp was set have
+            # none, they are read every time
+            query['query']['bool']['must'].append({'bool': {'should': [
+                {'range': {'updated_timestamp': {'gte': since}}},
+                {'filtered': {'filter': {
+                    'missing': {'field': 'updated_timestamp'}}}}]}})
+        if ids_only:
+            query['_source'] = ['id']
+        return query
+
+    def get_alarm_definitions(self, since=None, ids_only=False):
+        """Get alarm definitions from es, size of them at a time.
+
+        The definitions are yielded page by page as they are read, so all
+        of them are got however many match, and the definitions of a page
+        are applied before the next one is read.
+        """
+        for hits in self._es_conn.scroll_messages(
+                self._get_query(since, ids_only)):
+            LOG.debug('Query to ElasticSearch returned %s alarm '
+                      'definitions.' % len(hits))
+            yield [hit['_source'] for hit in hits]
+
+    def is_selected(self, alarm_def):
+        """Check a definition against the name and dimensions filters."""
+        name = cfg.CONF.alarmdefinitions.name
+        if name and name.lower() not in alarm_def.get('name', '').lower():
+            return False
+        dimensions = cfg.CONF.alarmdefinitions.dimensions
+        for dimension in (dimensions.split(',') if dimensions else []):
+            key, value = dimension.split(':')
+            if not any(sub.get('dimensions', {}).get(key) == value
+                       for sub in alarm_def.get('expression_data', [])):
+                return False
+        return True
+
+    def is_owned(self, aid):
+        return self.membership is None or self.membership.owns(aid)
+
+    def create_alarm_processor(self, aid, alarm_def):
+        # the processor is built by the shard owning the definition, only
+        # the metrics it consumes are needed here
+        owned = self.is_owned(aid)
+        self.threshold_processors[aid] = {}
+        self.threshold_processors[aid]['json'] = alarm_def
+        self.threshold_processors[aid]['owned'] = owned
+        self.metric_router.add(aid, self.get_matchers(alarm_def))
+        if owned:
+            self.shards.get_shard(aid).define(aid, alarm_def)
 
-    def get_alarm_definitions(self):
-        """Get alarm definitions from es."""
-        es_res = self._es_conn.get_messages(self.params)
-        es_res = self._get_alarm_definitions_response(es_res)
-        if es_res is None:
+    def update_alarm_processor(self, aid, alarm_def):
+        # the shard updates the processor when alarm definition is changed
+        # or builds it when the definition becomes owned
+        if aid in self.threshold_processors:
+            entry = self.threshold_processors[aid]
+            owned = self.is_owned(aid)
+            if alarm_def != entry['json']:
+                entry['json'] = alarm_def
+                self.metric_router.add(aid, self.get_matchers(alarm_def))
+            elif owned == entry['owned']:
+                return
+            if owned:
+                self.shards.get_shard(aid).define(aid, alarm_def)
+            elif entry['owned']:
+                self.shards.get_shard(aid).delete(aid)
+            entry['owned'] = owned
+
+    @staticmethod
+    def get_matchers(alarm_def):
+        """Get the sub expressions of a definition, None if it is invalid."""
+        try:
+            return parser.AlarmExprParser(
+                alarm_def['expression']).sub_expr_matchers
+        except Exception:
             return None
-        LOG.debug('Query to ElasticSearch returned: %s' % es_res)
-        if es_res["hits"]:
-            return es_res["hits"]
+
+    def delete_alarm_processor(self, aid):
+        # delete related processor when an alarm definition is deleted
+        if aid in self.threshold_processors:
+            self.threshold_processors.pop(aid)
+        self.metric_router.remove(aid)
+        self.shards.get_shard(aid).delete(aid)
+
+    def apply_alarm_definition(self, alarm_def):
+        """Create or update the processor of a definition."""
+        aid = alarm_def['id']
+        if aid in self.threshold_processors:
+            # alarm definition is updated, or its owner changed
+            self.update_alarm_processor(aid, alarm_def)
         else:
-            return []
+            # comes a new alarm definition
+            self.create_alarm_processor(aid, alarm_def)
 
-    def refresh_alarm_processors(self):
-        def create_alarm_processor():
-            # make sure received a new alarm definition
-            if aid in self.threshold_processors:
-                LOG.debug('already exsist alarm definition')
-                return
-            # init a processor for this alarm definition
-            temp_processor = (
-                driver.DriverManager(
-                    namespace.PROCESSOR_NS,
-                    cfg.CONF.thresholdengine.processor,
-                    invoke_on_load=True,
-                    invoke_args=(alarm_def,)).driver)
-            # register this new processor
-            self.threshold_processors[aid] = {}
-            self.threshold_processors[aid]['processor'] = (
-                temp_processor)
-            self.threshold_processors[aid]['flag'] = self.flag
-            self.threshold_processors[aid]['json'] = alarm_def
-
-        def update_alarm_processor():
-            # update the processor when alarm definition is changed
-            updated = False
-            if aid in self.threshold_processors:
-                updated = (self.threshold_processors
-                           [aid]['processor']
-                           .update_thresh_processor(alarm_def))
-                self.threshold_processors[aid]['json'] = alarm_def
-            if updated:
-                LOG.debug('alarm definition updates successfully!')
-            else:
-                LOG.debug('alarm definition update fail!')
+    def apply_alarm_definitions(self, since=None):
+        """Apply the definitions read from es, page by page.
 
-        def delete_alarm_processor():
-            # delete related processor when an alarm definition is deleted
-            if aid in self.threshold_processors:
-                self.threshold_processors.pop(aid)
+        Returns the ids of the definitions read, None if the read failed.
+        """
+        aids = set()
+        try:
+            for alarm_defs in self.get_alarm_definitions(since):
+                for alarm_def in alarm_defs:
+                    aids.add(alarm_def['id'])
+                    self.apply_alarm_definition(alarm_def)
+        except Exception:
+            LOG.exception('Error occurred while reading alarm definitions.')
+            return None
+        return aids
 
-        self.flag = 1 - self.flag
+    def get_alarm_definition_ids(self):
+        """Get the ids of all the definitions, None if the read failed."""
+        aids = set()
+        try:
+            for alarm_defs in self.get_alarm_definitions(ids_only=True):
+                aids.update(alarm_def['id'] for alarm_def in alarm_defs)
+        except Exception:
+            LOG.exception('Error occurred while reading alarm definitions.')
+            return None
+        return aids
+
+    def remove_missing_alarm_processors(self, aids):
+        for aid in self.threshold_processors.keys():
+            if aid not in aids:
+                # the alarm definition is deleted
+                self.delete_alarm_processor(aid)
+
+    def refresh_alarm_processors(self):
+        """Reconcile the processors with all the definitions in es."""
+        start = time.time()
         # get all alarm definitions from es to update those in the engine
-        alarm_definitions = self.get_alarm_definitions()
-        # http request fails, do nothing
-        if alarm_definitions is None:
+        aids = self.apply_alarm_definitions()
+        # the read fails, do not drop what could not be read
+        if aids is None:
             return
-        if lock.acquire():
-            for alarm_definition in alarm_definitions:
-                alarm_def = alarm_definition['_source']
-                aid = alarm_def['id']
-                if aid in self.threshold_processors:
-                    # alarm definition is updated
-                    if alarm_def != self.threshold_processors[aid]['json']:
-                        update_alarm_processor()
-                    self.threshold_processors[aid]['flag'] = self.flag
-                else:
-                    # comes a new alarm definition
-                    create_alarm_processor()
-            for aid in self.threshold_processors.keys():
-                if self.threshold_processors[aid]['flag'] != self.flag:
-                    # the alarm definition is expired
-                    delete_alarm_processor()
-        lock.release()
+        self.remove_missing_alarm_processors(aids)
+        self.last_sync = start
+        self.last_refresh = start
+
+    def sync_alarm_processors(self):
+        """Reconcile with the definitions updated since the last time.
+
+        The ids of all the definitions are read to find the deleted ones.
+        A full reconciliation is done first.
+        """
+        if self.last_sync is None:
+            return self.refresh_alarm_processors()
+        start = time.time()
+        # leave time for the changes to be searchable, and for the clock
+        # of the api to be behind
+        if self.apply_alarm_definitions(
+                since=self.last_sync - self.interval - self.skew) is None:
+            return
+        aids = self.get_alarm_definition_ids()
+        if aids is None:
+            return
+        self.remove_missing_alarm_processors(aids)
+        self.last_sync = start
+
+    def refresh_membership(self):
+        """Send a heartbeat and move the definitions if the ring changed.
+
+        The definitions are already known, the ones which changed owner
+        are built or dropped by the shards.
+        """
+        if self.membership.refresh():
+            for aid, entry in self.threshold_processors.items():
+                self.update_alarm_processor(aid, entry['json'])
+
+    def handle_event(self, event):
+        """Apply a created, updated or deleted definition event.
+
+        Events published before the last full reconciliation are ignored,
+        what they changed was read from es already. They are stamped by
+        the clock of the api, so only the ones older by more than the
+        clock skew are.
+        """
+        if (self.last_refresh is not None and event.get('timestamp', 0) <
+                int(self.last_refresh) - self.skew):
+            LOG.debug('Ignore outdated alarm definition event: %s' % event)
+            return
+        aid = event['id']
+        if event['event'] == 'deleted':
+            if aid in self.threshold_processors:
+                self.delete_alarm_processor(aid)
+            return
+        alarm_def = event['alarm_definition']
+        if self.is_selected(alarm_def):
+            self.apply_alarm_definition(alarm_def)
+        elif aid in self.threshold_processors:
+            self.delete_alarm_processor(aid)
+
+    def read_events(self, timeout):
+        """Apply the definition events coming within timeout."""
+        deadline = time.time() + timeout
+        while self._events_kafka_conn:
+            wait = deadline - time.time()
+            if wait <= 0:
+                return
+            for msg in self._events_kafka_conn.get_message_batch(100, wait):
+                try:
+                    self.handle_event(json.loads(msg.message.value))
+                except Exception:
+                    LOG.exception('Received a wrong alarm definition event.')
+            self._events_kafka_conn.commit()
+        time.sleep(timeout)
 
     def run(self):
+        if self._events_kafka_conn:
+            # a new group would replay all the events from the beginning,
+            # the first full reconciliation reads what they changed.
+            self._events_kafka_conn.seek_to_end()
+        next_sync = next_heartbeat = time.time()
         while True:
             try:
-                self.refresh_alarm_processors()
-                time.sleep(self.interval)
+                if self.membership and time.time() >= next_heartbeat:
+                    next_heartbeat = time.time() + self.heartbeat_interval
+                    self.refresh_membership()
+                if time.time() >= next_sync:
+                    next_sync = time.time() + self.interval
+                    self.sync_alarm_processors()
+                wake_up = next_sync
+                if self.membership:
+                    wake_up = min(wake_up, next_heartbeat)
+                self.read_events(max(wake_up - time.time(), 0))
             except Exception:
                 LOG.exception('Error occurred '
                               'while reading alarm definitions.')
 
     def stop(self):
-        pass
+        if self._events_kafka_conn:
+            self._events_kafka_conn.close()
 
 
 class ThresholdEngine(os_service.Service):
@@ -306,28 +997,39 @@ class ThresholdEngine(os_service.Service):
         # dict to index all the processors,
         # key = alarm def id; value = processor
         self.threshold_processors = {}
+        # index of the metrics consumed by each processor
+        self.metric_router = MetricRouter()
+        # the workers evaluating the alarm definitions, the processors of
+        # this dict are only used to route the metrics
+        self.shards = ShardSet(cfg.CONF.thresholdengine.workers,
+                               cfg.CONF.thresholdengine.worker_type)
         # init threads for processing metrics, alarm definition and alarm
         try:
             self.thread_alarm = AlarmPublisher(
                 'alarm_publisher',
-                self.threshold_processors)
+                self.shards)
         except Exception:
             self.thread_alarm = None
         try:
             self.thread_alarm_def = AlarmDefinitionConsumer(
                 'alarm_def_consumer',
-                self.threshold_processors)
+                self.threshold_processors,
+                self.metric_router,
+                self.shards)
         except Exception:
             self.thread_alarm_def = None
         try:
             self.thread_metrics = MetricsConsumer(
                 'metrics_consumer',
-                self.threshold_processors)
+                self.metric_router,
+                self.shards,
+                self.thread_alarm_def and self.thread_alarm_def.membership)
         except Exception:
             self.thread_metrics = None
 
     def start(self):
         try:
+            self.shards.start()
             self.thread_alarm.start()
             self.thread_alarm_def.start()
             self.thread_metrics.start()
@@ -343,6 +1045,7 @@ class ThresholdEngine(os_service.Service):
                 self.thread_alarm_def.stop()
             if self.thread_metrics:
                 self.thread_metrics.stop()
+            self.shards.stop()
         except Exception:
             LOG.debug('Terminate thresh process threads error')
         super(ThresholdEngine, self).stop()
\ No newline at end of file
@@ -13,16 +13,45 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import calendar
 import collections
-import copy
 import json
 from monasca.common import alarm_expr_calculator as calculator
 from monasca.common import alarm_expr_parser as parser
+from monasca.microservice import threshold_window
 from monasca.openstack.common import log
 from monasca.openstack.common import timeutils as tu
+from oslo.config import cfg
 import uuid
 
 
+OPTS = [
+    cfg.IntOpt('series_ttl',
+               default=3600,
+               help=('The time in seconds after which a match_by series '
+                     'without new metrics is dropped. It is never less '
+                     'than twice the time covered by the alarm definition '
+                     'so the alarm can go UNDETERMINED first. 0 keeps the '
+                     'series forever.')),
+    cfg.IntOpt('allowed_lateness',
+               default=60,
+               help=('Metrics are put in periods by their own timestamp. '
+                     'Metrics older by more than that many seconds than '
+                     'the newest metrics seen are dropped as late.')),
+    cfg.IntOpt('allowed_skew',
+               default=60,
+               help=('Metrics stamped more than that many seconds ahead of '
+                     'the clock are dropped, they would push the periods '
+                     'of the series past the current ones.')),
+    cfg.IntOpt('max_series',
+               default=0,
+               help=('The most match_by series kept per alarm definition, '
+                     'the least recently seen are dropped beyond it. 0 '
+                     'means no limit.')),
+]
+
+cfg.CONF.register_opts(OPTS, group="thresholdengine")
+
 LOG = log.getLogger(__name__)
 
 reasons = {'ALARM': 'The alarm threshold(s) have '
@@ -44,7 +73,8 @@ class ThresholdProcessor(object):
     Metrics come in:
     Metrics_A -> 'dimensions': {'hostname': 'A', 'os': 'windows'}
     Metrics_B -> 'dimensions': {'hostname': 'B', 'os': 'unix'}
-    Then, ALL_DATA = {'Awindows': ALARM_DATA, 'Bunix': ALARM_DATA}
+    Then, ALL_DATA = {('A', 'windows'): ALARM_DATA,
+                      ('B', 'unix'): ALARM_DATA}
 
     ALARM_DATA = {'state': #alarm state#,
     'timestamp': #timestamp#, data: SUB_ALARM_DATA, ...}
@@ -55,8 +85,10 @@ class ThresholdProcessor(object):
     For example, alarm expr is 'max(cpu)>10 and avg(memory)<10'
     SUB_ALARM_DATA = {'max(cpu)>10': METRICS, 'avg(memory)<10': METRICS}
 
-    METRICS = {'value': [X, ...], 'timestamp': [T, ...], 'sub_state': S}
-    Other key/values in a metrics will not be stored here.
+    METRICS = {'metrics': WINDOW, 'values': [V, ...], 'state': S}
+    WINDOW is a SlidingWindow holding the count, sum, min and max of the
+    values of the metrics in each period of the sub alarm, other
+    key/values in a metrics will not be stored here.
     The state here is the state of this sub_alarm.
     """
     def __init__(self, alarm_def):
@@ -68,13 +100,22 @@ class ThresholdProcessor(object):
         self.match_by = self.alarm_definition['match_by']
         self.expr_data_queue = {}
         self.related_metrics = {}
+        # match_by names by last time a metrics was seen, oldest first
+        self.last_seen = collections.OrderedDict()
+        # match_by names which got metrics since they were evaluated
+        self.dirty = set()
+        # newest metrics timestamp seen and the time it was seen at
+        self.event_ts = None
+        self.event_seen_at = None
         if len(self.match_by) == 0:
             self.match_by = None
         alarm_parser = parser.AlarmExprParser(self.expression)
         self.parse_result = alarm_parser.parse_result
         self.sub_expr_list = alarm_parser.sub_expr_list
+        self.matchers = alarm_parser.sub_expr_matchers
         self.related_metrics[None] = alarm_parser.related_metrics
         self.sub_alarm_expr = alarm_parser.sub_alarm_expressions
+        self.set_series_ttl()
         LOG.debug('successfully initialize ThresholdProcessor!')
 
     def update_thresh_processor(self, alarm_def):
@@ -92,14 +133,16 @@ class ThresholdProcessor(object):
                     'state_update_timestamp':
                         self.expr_data_queue[name]['state_update_timestamp']
                 }
-                for i in range(0, len(new_sub_expr_list), 1):
-                    expr_old = self.sub_expr_list[i].fmtd_sub_expr_str
-                    expr_new = new_sub_expr_list[i].fmtd_sub_expr_str
+                for i in range(0, len(new_matchers), 1):
+                    expr_old = self.matchers[i].key
+                    expr_new = new_matchers[i].key
+                    window = (self.expr_data_queue[name]['data']
+                              [expr_old]['metrics'].resized(
+                                  new_matchers[i].period,
+                                  new_matchers[i].periods))
                     new_expr_data_queue[name]['data'][expr_new] = {
                         'state': 'UNDETERMINED',
-                        'metrics':
-                            (self.expr_data_queue[name]
-                             ['data'][expr_old]['metrics']),
+                        'metrics': window,
                         'values': []}
 
         LOG.debug('update ThresholdProcessor!')
@@ -107,14 +150,18 @@ class ThresholdProcessor(object):
         new_expression = new_alarm_definition['expression']
         alarm_parser = parser.AlarmExprParser(new_expression)
         new_sub_expr_list = alarm_parser.sub_expr_list
+        new_matchers = alarm_parser.sub_expr_matchers
         new_expr_data_queue = {}
         update_data()
         self.expr_data_queue = new_expr_data_queue
+        self.related_metrics = {None: alarm_parser.related_metrics}
         self.sub_expr_list = new_sub_expr_list
+        self.matchers = new_matchers
         self.sub_alarm_expr = alarm_parser.sub_alarm_expressions
         self.parse_result = alarm_parser.parse_result
         self.alarm_definition = new_alarm_definition
         self.expression = new_expression
+        self.set_series_ttl()
         self.match_by = self.alarm_definition['match_by']
         if '' in self.match_by:
             self.match_by.remove('')
@@ -123,20 +170,102 @@ class ThresholdProcessor(object):
         LOG.debug('successfully update ThresholdProcessor!')
         return True
 
+    def set_series_ttl(self):
+        """Set the idle time after which a series is dropped."""
+        self.series_ttl = cfg.CONF.thresholdengine.series_ttl
+        if self.series_ttl > 0 and self.matchers:
+            span = max(m.period * m.periods for m in self.matchers)
+            self.series_ttl = max(self.series_ttl, 2 * span)
+
+    def touch(self, name):
+        """Record a metrics of a series, dropping the least recent ones.
+
+        Series are dropped while there are more than max_series.
+        """
+        self.last_seen.pop(name, None)
+        self.last_seen[name] = tu.utcnow_ts()
+        max_series = cfg.CONF.thresholdengine.max_series
+        if max_series > 0:
+            while len(self.last_seen) > max_series:
+                self.drop_series(self.last_seen.keys()[0])
+
+    def expire_series(self):
+        """Drop the series which got no metrics for series_ttl."""
+        if self.series_ttl <= 0:
+            return
+        expiry = tu.utcnow_ts() - self.series_ttl
+        while self.last_seen:
+            name, seen = next(self.last_seen.iteritems())
+            if seen >= expiry:
+                break
+            self.drop_series(name)
+
+    def drop_series(self, name):
+        LOG.debug('Alarm def: %s drops series %s',
+                  self.alarm_definition['name'], name)
+        self.last_seen.pop(name, None)
+        self.dirty.discard(name)
+        self.expr_data_queue.pop(name, None)
+        if name is not None:
+            self.related_metrics.pop(name, None)
+
+    def event_time(self, now=None):
+        """Get the current time as told by the metrics timestamps.
+
+        It is the newest timestamp seen plus the time elapsed since, so
+        it follows the metrics when catching up with a backlog and the
+        clock when no metrics come.
+        """
+        if now is None:
+            now = tu.utcnow_ts()
+        if self.event_ts is None:
+            return now
+        return self.event_ts + (now - self.event_seen_at)
+
+    def get_event_ts(self, data, now):
+        """Get the timestamp of a metrics, its arrival time if it has none.
+
+        The timestamp is in seconds or an ISO 8601 string.
+        """
+        ts = data.get('timestamp')
+        if isinstance(ts, basestring):
+            try:
+                return calendar.timegm(tu.parse_isotime(ts).utctimetuple())
+            except ValueError:
+                return now
+        if isinstance(ts, (int, long, float)):
+            return ts
+        return now
+
     def process_metrics(self, metrics):
-        """Add new metrics to matched expr."""
+        """Add new metrics to matched expr.
+
+        The metrics are either decoded already or a json string.
+        """
         try:
-            data = json.loads(metrics)
-            self.add_expr_metrics(data)
+            if isinstance(metrics, basestring):
+                metrics = json.loads(metrics)
+            self.add_expr_metrics(metrics)
         except Exception:
             LOG.exception('Received a wrong format metrics')
 
-    def process_alarms(self):
-        """Called to produce alarms."""
+    def process_alarms(self, names=None, early=False):
+        """Called to produce alarms.
+
+        All the series are evaluated, or only the given ones. Early, the
+        period in progress is also evaluated, see update_state.
+        """
         try:
             alarm_list = []
-            for m in self.expr_data_queue.keys():
-                is_updated = self.update_state(self.expr_data_queue[m])
+            self.expire_series()
+            if names is None:
+                self.dirty = set()
+                names = self.expr_data_queue.keys()
+            for m in names:
+                if m not in self.expr_data_queue:
+                    continue
+                is_updated = self.update_state(self.expr_data_queue[m],
+                                               early)
                 if is_updated:
                     alarm_list.append(self.build_alarm(m))
             return alarm_list
@@ -144,8 +273,49 @@ class ThresholdProcessor(object):
             LOG.exception('process metrics error')
             return []
 
-    def update_state(self, expr_data):
-        """Update the state of each alarm under this alarm definition."""
+    def series_names(self):
+        return self.expr_data_queue.keys()
+
+    def pop_dirty(self):
+        """Get the series which got metrics since they were evaluated."""
+        names = self.dirty
+        self.dirty = set()
+        return names
+
+    def next_evaluation(self, now=None, name=None):
+        """Get the time a series has to be evaluated again.
+
+        The periods of the series move at the next period boundary, so it
+        has to be evaluated then if it has metrics in its periods, and it
+        has to be dropped when it expires. None if neither will happen.
+        Without a series, the next period boundary is returned.
+        """
+        if now is None:
+            now = tu.utcnow_ts()
+        event_now = self.event_time(now)
+        times = []
+        if name is not None:
+            data = self.expr_data_queue.get(name)
+            if data is None:
+                return None
+            if self.series_ttl > 0:
+                times.append(self.last_seen[name] + self.series_ttl)
+        if name is None or any(sub['metrics'].live(event_now)
+                               for sub in data['data'].values()):
+            boundary = min((event_now // m.period + 1) * m.period
+                           for m in self.matchers)
+            times.append(now + boundary - event_now)
+        return min(times) if times else None
+
+    def update_state(self, expr_data, early=False):
+        """Update the state of each alarm under this alarm definition.
+
+        Only completed periods are evaluated, so a series would get to
+        ALARM at the period boundary after its metrics breach. Early, when
+        the series just got metrics, the period in progress is evaluated
+        as the newest one too and the series goes to ALARM right away if
+        it breaches already.
+        """
         def _calc_state(operand):
             if operand.logic_operator:
                 subs = []
@@ -153,11 +323,19 @@ class ThresholdProcessor(object):
                     subs.append(_calc_state(o))
                 return calculator.calc_logic(operand.logic_operator, subs)
             else:
-                return expr_data['data'][operand.fmtd_sub_expr_str]['state']
+                return expr_data['data'][operand.matcher.key]['state']
 
-        for sub_expr in self.sub_expr_list:
-            self.update_sub_expr_state(sub_expr, expr_data)
+        for matcher in self.matchers:
+            self.update_sub_expr_state(matcher, expr_data)
         state_new = _calc_state(self.parse_result)
+        if early and state_new != 'ALARM':
+            for matcher in self.matchers:
+                self.update_sub_expr_state(matcher, expr_data, early=True)
+            if _calc_state(self.parse_result) == 'ALARM':
+                state_new = 'ALARM'
+            else:
+                for matcher in self.matchers:
+                    self.update_sub_expr_state(matcher, expr_data)
         if state_new != expr_data['state']:
             expr_data['state_update_timestamp'] = tu.utcnow_ts()
             expr_data['update_timestamp'] = tu.utcnow_ts()
@@ -166,104 +344,92 @@ class ThresholdProcessor(object):
         else:
             return False
 
-    def update_sub_expr_state(self, expr, expr_data):
-        def _update_metrics():
-            """Delete metrics not in period."""
-            data_list = expr_data['data'][expr.fmtd_sub_expr_str]['metrics']
-            start_time = t_now - (float(expr.period)) * int(expr.periods)
-            while (len(data_list) != 0
-                   and data_list[0]['timestamp'] < start_time):
-                data_list.popleft()
-
-        def _update_state():
-            """Update state of a sub expr."""
-            data_sub = expr_data['data'][expr.fmtd_sub_expr_str]
-            data_list = data_sub['metrics']
-            period = float(expr.period)
-            periods = int(expr.periods)
-            right = t_now
-            left = right - period
-            temp_data = []
-            value_in_periods = []
-            i = len(data_list) - 1
-            while i >= 0:
-                if data_list[i]['timestamp'] >= left:
-                    temp_data.append(float(data_list[i]['value']))
-                else:
-                    value = calculator.calc_value(
-                        expr.normalized_func, temp_data)
-                    value_in_periods.append(value)
-                    right = left
-                    left = right - period
-                    temp_data = []
-                    i += 1
-                i -= 1
-            value = calculator.calc_value(
-                expr.normalized_func, temp_data)
-            value_in_periods.append(value)
-            for i in range(len(value_in_periods), periods, 1):
-                value_in_periods.append(
-                    calculator.calc_value(expr.normalized_func, []))
-            expr_data['data'][expr.fmtd_sub_expr_str]['values'] = (
-                value_in_periods)
-            expr_data['data'][expr.fmtd_sub_expr_str]['state'] = (
-                calculator.compare_thresh(
-                    value_in_periods,
-                    expr.normalized_operator,
-                    float(expr.threshold)))
-
-        t_now = tu.utcnow_ts()
-        _update_metrics()
-        _update_state()
+    def update_sub_expr_state(self, matcher, expr_data, early=False):
+        """Update state of a sub expr.
 
-    def add_expr_metrics(self, data):
-        """Add new metrics to matched place."""
-        for sub_expr in self.sub_expr_list:
-            self.add_sub_expr_metrics(sub_expr, data)
-
-    def add_sub_expr_metrics(self, expr, data):
-        """Add new metrics to sub expr place."""
-        def _has_match_expr():
-            if (data['name'].lower() != expr.normalized_metric_name):
-                return False
-            metrics_dimensions = {}
-            if 'dimensions' in data:
-                metrics_dimensions = data['dimensions']
-            def_dimensions = expr.dimensions_as_dict
-            for dimension_key in def_dimensions.keys():
-                if dimension_key in metrics_dimensions:
-                    if (metrics_dimensions[dimension_key].lower()
-                            != def_dimensions[dimension_key].lower()):
-                        return False
-                else:
-                    return False
-            return True
+        The value of each period is read from the buckets of the window.
+        Early, the period in progress is the newest period and the state
+        only changes to ALARM. A count or a sum of a period in progress
+        is still growing, they can not tell it is below the threshold.
+        """
+        data_sub = expr_data['data'][matcher.key]
+        if early and (matcher.func in ('COUNT', 'SUM') and
+                      matcher.operator in ('LT', 'LTE')):
+            return
+        value_in_periods = data_sub['metrics'].values(
+            self.event_time(), matcher.func, include_current=early)
+        state = matcher.compare(value_in_periods)
+        if early and state != 'ALARM':
+            return
+        data_sub['values'] = value_in_periods
+        data_sub['state'] = state
 
-        def _add_metrics():
-            temp = None
-            if self.match_by:
-                q_name = self.get_matched_data_queue_name(data)
-                if q_name:
-                    temp = self.expr_data_queue[q_name]
-            else:
-                if None not in self.expr_data_queue:
-                    self.create_data_item(None)
-                temp = self.expr_data_queue[None]
-            if temp:
-                data_list = temp['data'][expr.fmtd_sub_expr_str]
-                data_list['metrics'].append(
-                    {'value': float(data['value']),
-                     'timestamp': tu.utcnow_ts()})
-                return True
-            else:
-                return False
+    def add_expr_metrics(self, data):
+        """Add new metrics to matched place.
 
-        if _has_match_expr() and _add_metrics():
-            LOG.debug("Alarm def: %s consumes the metrics!"
-                      % self.alarm_definition['name'])
+        The name and dimension values of the metrics are lower-cased
+        once, then checked against the compiled sub expressions.
+        """
+        name = data['name'].lower()
+        dimensions = {}
+        for key, value in data.get('dimensions', {}).items():
+            dimensions[key] = value.lower()
+        temp = False
+        ts = None
+        for matcher in self.matchers:
+            if not matcher.matches(name, dimensions):
+                continue
+            if temp is False:
+                ts = self.get_watermarked_ts(data)
+                temp = ts is not None and self.get_data_item(data)
+            if not temp:
+                break
+            temp['data'][matcher.key]['metrics'].add(
+                ts, float(data['value']))
+        if temp:
+            LOG.debug("Alarm def: %s consumes the metrics!",
+                      self.alarm_definition['name'])
         else:
-            LOG.debug("Alarm def: %s don't need the metrics!"
-                      % self.alarm_definition['name'])
+            LOG.debug("Alarm def: %s don't need the metrics!",
+                      self.alarm_definition['name'])
+
+    def get_watermarked_ts(self, data):
+        """Get the timestamp of a metrics, None if it is too late or early.
+
+        The newest timestamp seen moves the event time forward, but not
+        past the clock so that a host with a clock ahead does not make
+        the metrics of the others late.
+        """
+        now = tu.utcnow_ts()
+        ts = self.get_event_ts(data, now)
+        if ts > now + cfg.CONF.thresholdengine.allowed_skew:
+            LOG.debug('Alarm def: %s drops metrics ahead of the clock at %s',
+                      self.alarm_definition['name'], ts)
+            return None
+        if self.event_ts is not None:
+            event_now = self.event_time(now)
+            if ts < event_now - cfg.CONF.thresholdengine.allowed_lateness:
+                LOG.debug('Alarm def: %s drops late metrics at %s',
+                          self.alarm_definition['name'], ts)
+                return None
+            if min(ts, now) <= event_now:
+                return ts
+        self.event_ts = min(ts, now)
+        self.event_seen_at = now
+        return ts
+
+    def get_data_item(self, data):
+        """Get the entry storing the metrics values, None if no match_up."""
+        q_name = None
+        if self.match_by:
+            q_name = self.get_matched_data_queue_name(data)
+            if q_name is None:
+                return None
+        elif None not in self.expr_data_queue:
+            self.create_data_item(None)
+        self.touch(q_name)
+        self.dirty.add(q_name)
+        return self.expr_data_queue[q_name]
 
     def create_data_item(self, name):
         """If new match_up tuple, create new entry to store metrics value."""
@@ -274,31 +440,39 @@ class ThresholdProcessor(object):
             'create_timestamp': ts,
             'update_timestamp': ts,
             'state_update_timestamp': ts}
-        for expr in self.sub_expr_list:
-            self.expr_data_queue[name]['data'][expr.fmtd_sub_expr_str] = {
+        for matcher in self.matchers:
+            self.expr_data_queue[name]['data'][matcher.key] = {
                 'state': 'UNDETERMINED',
-                'metrics': collections.deque(),
+                'metrics': threshold_window.SlidingWindow(matcher.period,
+                                                          matcher.periods),
                 'values': []}
 
     def get_matched_data_queue_name(self, data):
-        """Use dimensions in match_up to generate a name."""
-        name = ''
-        for m in self.match_by:
-            if m in data['dimensions']:
-                name = name + data['dimensions'][m] + ','
-            else:
-                return None
-        if name in self.expr_data_queue:
-            return name
-        else:
-            self.related_metrics[name] = []
-            for m in self.related_metrics[None]:
-                temp = copy.deepcopy(m)
-                for match in self.match_by:
-                    temp['dimensions'][match] = data['dimensions'][match]
-                self.related_metrics[name].append(temp)
+        """Use dimensions in match_up to generate a name.
+
+        The name is the tuple of the match_up dimension values.
+        """
+        dimensions = data['dimensions']
+        try:
+            name = tuple(dimensions[m] for m in self.match_by)
+        except KeyError:
+            return None
+        if name not in self.expr_data_queue:
             self.create_data_item(name)
-            return name
+        return name
+
+    def get_related_metrics(self, name):
+        """Get the metrics of an alarm, built when it is first raised."""
+        related_metrics = self.related_metrics.get(name)
+        if related_metrics is None:
+            related_metrics = []
+            for m in self.related_metrics[None]:
+                dimensions = dict(m['dimensions'])
+                dimensions.update(zip(self.match_by, name))
+                related_metrics.append({'name': m['name'],
+                                        'dimensions': dimensions})
+            self.related_metrics[name] = related_metrics
+        return related_metrics
 
     def build_alarm(self, name):
         """Build alarm json."""
@@ -306,18 +480,17 @@ class ThresholdProcessor(object):
         id = str(uuid.uuid4())
         alarm['id'] = id
         alarm['alarm_definition'] = self.alarm_definition
-        alarm['metrics'] = self.related_metrics[name]
+        alarm['metrics'] = self.get_related_metrics(name)
         alarm['state'] = self.expr_data_queue[name]['state']
         alarm['reason'] = reasons[alarm['state']]
         alarm['reason_data'] = {}
         sub_alarms = []
         dt = self.expr_data_queue[name]['data']
-        for expr in self.sub_expr_list:
+        for matcher in self.matchers:
             sub_alarms.append({
-                'sub_alarm_expression':
-                    self.sub_alarm_expr[expr.fmtd_sub_expr_str],
-                'sub_alarm_state': dt[expr.fmtd_sub_expr_str]['state'],
-                'current_values': dt[expr.fmtd_sub_expr_str]['values']
+                'sub_alarm_expression': self.sub_alarm_expr[matcher.key],
+                'sub_alarm_state': dt[matcher.key]['state'],
+                'current_values': dt[matcher.key]['values']
             })
         alarm['sub_alarms'] = sub_alarms
         ct = self.expr_data_queue[name]['create_timestamp']
@@ -0,0 +1,131 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import array
+
+
+class SlidingWindow(object):
+    """Aggregates of the metrics of the last periods periods.
+
+    Periods are aligned on multiples of the period: a sample is folded
+    straight into the bucket of its period, which keeps the count, sum,
+    min and max of the samples and nothing else. Only completed periods
+    are evaluated: bucket 0 is the last period which ended before the
+    evaluation time, bucket k the period k periods earlier.
+
+    periods + 1 buckets are kept in parallel arrays used as a ring, the
+    extra one filling with the samples of the period in progress, so
+    memory per series does not depend on the sample rate and evaluation
+    is O(periods).
+    """
+    def __init__(self, period, periods):
+        self.period = float(period)
+        self.periods = int(periods)
+        size = self.periods + 1
+        self.indices = array.array('l', [-1]) * size
+        self.counts = array.array('l', [0]) * size
+        self.sums = array.array('d', [0.0]) * size
+        self.mins = array.array('d', [0.0]) * size
+        self.maxs = array.array('d', [0.0]) * size
+        self.newest = None
+
+    def _slot(self, index):
+        return index % len(self.indices)
+
+    def add(self, timestamp, value):
+        """Fold a sample into the bucket of its period.
+
+        Returns False if the sample is older than all the buckets.
+        """
+        return self.merge(int(timestamp // self.period), 1, value, value,
+                          value)
+
+    def merge(self, index, count, total, low, high):
+        """Fold the aggregates of some samples of a period into its bucket.
+
+        Returns False if the period is older than all the buckets.
+        """
+        if self.newest is None or index > self.newest:
+            self.newest = index
+        elif index < self.newest - self.periods:
+            return False
+        slot = self._slot(index)
+        if self.indices[slot] != index:
+            # the slot still holds an expired period
+            self.indices[slot] = index
+            self.counts[slot] = count
+            self.sums[slot] = total
+            self.mins[slot] = low
+            self.maxs[slot] = high
+            return True
+        self.counts[slot] += count
+        self.sums[slot] += total
+        if low < self.mins[slot]:
+            self.mins[slot] = low
+        if high > self.maxs[slot]:
+            self.maxs[slot] = high
+        return True
+
+    def buckets(self):
+        """Get the live buckets as (index, count, sum, min, max)."""
+        for slot, index in enumerate(self.indices):
+            if index >= 0:
+                yield (index, self.counts[slot], self.sums[slot],
+                       self.mins[slot], self.maxs[slot])
+
+    def value(self, index, func):
+        """Get the aggregate of a period, as calc_value would do."""
+        slot = self._slot(index)
+        count = self.counts[slot] if self.indices[slot] == index else 0
+        if func == 'COUNT':
+            return count
+        if not count:
+            return None
+        if func == 'SUM':
+            return self.sums[slot]
+        if func == 'AVG':
+            return self.sums[slot] / count
+        if func == 'MAX':
+            return self.maxs[slot]
+        if func == 'MIN':
+            return self.mins[slot]
+        return None
+
+    def live(self, now):
+        """Check if periods evaluated at time now or later have metrics."""
+        oldest = int(now // self.period) - self.periods
+        return any(index >= oldest for index in self.indices)
+
+    def values(self, now, func, include_current=False):
+        """Get the aggregate of every completed period, newest first.
+
+        With include_current, the period in progress is the newest one,
+        its aggregate may still change.
+        """
+        newest = int(now // self.period)
+        if not include_current:
+            newest -= 1
+        return [self.value(newest - k, func) for k in range(self.periods)]
+
+    def resized(self, period, periods):
+        """Get a window for other periods, keeping what can be kept.
+
+        Buckets can not be split, so nothing is kept when the period
+        changes.
+        """
+        window = SlidingWindow(period, periods)
+        if window.period == self.period:
+            for bucket in sorted(self.buckets()):
+                window.merge(*bucket)
+        return window
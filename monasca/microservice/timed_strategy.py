@@ -62,51 +62,149 @@ class TimedStrategy(object):
 
     def __init__(self):
         self.time_unit = cfg.CONF.timed_strategy.time_unit
-        self.frequency = cfg.CONF.timed_strategy.frequency
+        self.frequency = max(1, cfg.CONF.timed_strategy.frequency)
         self.start_date = dparser.parse(cfg.CONF.timed_strategy.start_date,
                                         fuzzy=True)
         self.now = None
+        # the index of the current time range and when that range ends
+        self._index = None
+        self._index_expires = 0
+        # the last time range looked up by get_index_for
+        self._last_range = (0, 0, None)
         LOG.debug('TimedStrategy initialized successfully!')
 
     def set_time(self, a_date):
         self.now = a_date
 
-    def get_index(self):
-        # Right now, only support frequency of 1.
-        # To support any frequency greater than 1, we need more work.
-        if self.now:
-            a_date = self.now
+    @staticmethod
+    def _to_datetime(a_date):
+        if isinstance(a_date, (int, long, float)):
+            return datetime.datetime.fromtimestamp(a_date)
+        elif isinstance(a_date, datetime.datetime):
+            return a_date
         else:
-            a_date = datetime.datetime.now()
-        if isinstance(a_date, long) or isinstance(a_date, int):
+            return dparser.parse(a_date, fuzzy=True)
+
+    @staticmethod
+    def _week_start(a_date):
+        # weeks start on Sunday
+        a_date = datetime.datetime(a_date.year, a_date.month, a_date.day)
+        return a_date - datetime.timedelta(days=(a_date.weekday() + 1) % 7)
+
+    def _range_start(self, a_date):
+        """Get the start of the time range a date belongs to.
+
+        Time ranges are frequency time units long and aligned on
+        start_date.
+        """
+        start = self.start_date
+        freq = self.frequency
+        if self.time_unit == 'y':
+            years = (a_date.year - start.year) // freq * freq
+            return datetime.datetime(start.year + years, 1, 1)
+        if self.time_unit == 'm':
+            first = start.year * 12 + start.month - 1
+            months = (a_date.year * 12 + a_date.month - 1 - first)
+            month = first + months // freq * freq
+            return datetime.datetime(month // 12, month % 12 + 1, 1)
+        if self.time_unit == 'w':
+            first = TimedStrategy._week_start(start)
+            weeks = (TimedStrategy._week_start(a_date) - first).days // 7
+            return first + datetime.timedelta(weeks=weeks // freq * freq)
+
+        first = datetime.datetime(start.year, start.month, start.day)
+        if self.time_unit == 'd':
+            days = (a_date - first).days
+            return first + datetime.timedelta(days=days // freq * freq)
+        if self.time_unit == 'h':
+            delta = a_date - first
+            hours = delta.days * 24 + delta.seconds // 3600
+            return first + datetime.timedelta(hours=hours // freq * freq)
+
+    def _range_end(self, range_start):
+        """Get the start of the time range following the given one."""
+        freq = self.frequency
+        if self.time_unit == 'y':
+            return datetime.datetime(range_start.year + freq, 1, 1)
+        if self.time_unit == 'm':
+            month = range_start.year * 12 + range_start.month - 1 + freq
+            return datetime.datetime(month // 12, month % 12 + 1, 1)
+        if self.time_unit == 'w':
+            return range_start + datetime.timedelta(weeks=freq)
+        if self.time_unit == 'd':
+            return range_start + datetime.timedelta(days=freq)
+        if self.time_unit == 'h':
+            return range_start + datetime.timedelta(hours=freq)
+
+    @staticmethod
+    def _format(range_start):
+        return "%04i%02i%02i%02i0000" % (range_start.year, range_start.month,
+                                         range_start.day, range_start.hour)
+
+    def get_index_for(self, a_date):
+        """Get the index of a datetime, timestamp or date string."""
+        if isinstance(a_date, (int, long, float)):
+            # messages mostly come in time order, most of them fall in the
+            # time range of the previous one
+            range_start, range_end, index = self._last_range
+            if range_start <= a_date < range_end:
+                return index
             try:
                 a_date = datetime.datetime.fromtimestamp(a_date)
             except Exception:
                 return
-        elif isinstance(a_date, datetime.datetime):
-            pass
-        else:
-            try:
-                a_date = dparser.parse(a_date, fuzzy=True)
-            except Exception:
+            range_start = self._range_start(a_date)
+            if not range_start:
                 return
+            index = TimedStrategy._format(range_start)
+            self._last_range = (
+                time.mktime(range_start.timetuple()),
+                time.mktime(self._range_end(range_start).timetuple()),
+                index)
+            return index
 
-        if self.time_unit is 'y':
-            return "%04i0101000000" % a_date.year
-        if self.time_unit is 'm':
-            return "%04i%02i01000000" % (a_date.year, a_date.month)
-        if self.time_unit is 'd':
-            return "%04i%02i%02i000000" % (a_date.year, a_date.month,
-                                           a_date.day)
-        if self.time_unit is 'h':
-            return "%04i%02i%02i%02i0000" % (a_date.year, a_date.month,
-                                             a_date.day, a_date.hour)
-        if self.time_unit is 'w':
-            year, week, day = a_date.isocalendar()
-            if day == 7:
-                day_str = "%04i %i 0" % (year, week)
-            else:
-                day_str = "%04i %i 0" % (year, week - 1)
-            day = time.strptime(day_str, '%Y %U %w')
-            return "%04i%02i%02i000000" % (day.tm_year, day.tm_mon,
-                                           day.tm_mday)
\ No newline at end of file
+        try:
+            a_date = TimedStrategy._to_datetime(a_date)
+        except Exception:
+            return
+        range_start = self._range_start(a_date)
+        if range_start:
+            return TimedStrategy._format(range_start)
+
+    def get_indices(self, start, end, limit=None):
+        """Get the indices of the time ranges overlapping start..end.
+
+        Returns None when the dates are not valid or when there are more
+        than limit indices.
+        """
+        try:
+            start = TimedStrategy._to_datetime(start)
+            end = TimedStrategy._to_datetime(end)
+        except Exception:
+            return
+        range_start = self._range_start(start)
+        if not range_start:
+            return
+        indices = []
+        while range_start <= end:
+            if limit and len(indices) >= limit:
+                return
+            indices.append(TimedStrategy._format(range_start))
+            range_start = self._range_end(range_start)
+        return indices
+
+    def get_index(self):
+        if self.now:
+            return self.get_index_for(self.now)
+
+        # the index only changes when the current time range is over
+        now = time.time()
+        if now >= self._index_expires:
+            range_start = self._range_start(
+                datetime.datetime.fromtimestamp(now))
+            if not range_start:
+                return
+            self._index = TimedStrategy._format(range_start)
+            self._index_expires = time.mktime(
+                self._range_end(range_start).timetuple())
+        return self._index
@@ -201,3 +201,33 @@ class TestAlarmExprParser(tests.BaseTestCase):
         sub_expr_list = (alarm_expr_parser.AlarmExprParser(self.expr8).
                          sub_expr_list)
         self.assertEqual(None, sub_expr_list)
+
+    def test_sub_expr_matchers(self):
+        matchers = (alarm_expr_parser.AlarmExprParser(
+            "max(Foo{hostname=Mini-Mon,千=千}, 120) > 100.5 times 2"
+            .decode('utf8')).sub_expr_matchers)
+        self.assertEqual(1, len(matchers))
+        m = matchers[0]
+        self.assertEqual('foo', m.name)
+        self.assertEqual(((u'hostname', u'mini-mon'),
+                          ('千'.decode('utf8'), '千'.decode('utf8'))),
+                         m.dimensions)
+        self.assertEqual(('MAX', 'GT', 100.5, 120.0, 2),
+                         (m.func, m.operator, m.threshold, m.period,
+                          m.periods))
+        self.assertTrue(m.matches('foo', {'hostname': 'mini-mon',
+                                          '千'.decode('utf8'):
+                                          '千'.decode('utf8'),
+                                          'os': 'linux'}))
+        self.assertFalse(m.matches('foo', {'hostname': 'mini-mon'}))
+        self.assertFalse(m.matches('bar', {'hostname': 'mini-mon'}))
+        self.assertEqual('ALARM', m.compare([101, 200]))
+        self.assertEqual('OK', m.compare([101, 100]))
+        self.assertRaises(AttributeError, setattr, m, 'name', 'bar')
+
+    def test_sub_expr_matcher_built_once(self):
+        expr = alarm_expr_parser.AlarmExprParser(self.expr2).parse_result
+        self.assertIs(expr.matcher, expr.matcher)
+        self.assertEqual(expr.fmtd_sub_expr_str, expr.matcher.key)
+        self.assertIsNone(alarm_expr_parser.AlarmExprParser(self.expr8).
+                          sub_expr_matchers)
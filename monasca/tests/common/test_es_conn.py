@@ -23,6 +23,7 @@ from monasca import tests
 import json
 import mock
 import requests
+import time
 
 LOG = log.getLogger(__name__)
 
@@ -42,9 +43,10 @@ class TestESConnection(tests.BaseTestCase):
         req_result = mock.Mock()
         req_result.status_code = 204
         msg = {'id': 'whatever'}
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             conn.send_messages(json.dumps(msg))
-            self.assertTrue(requests.post.called)
+            self.assertTrue(requests.Session.post.called)
 
     def test_send_messages_without_id(self):
         self.CONF.set_override('id_field', 'id', group='es_conn')
@@ -55,7 +57,282 @@ class TestESConnection(tests.BaseTestCase):
         req_result = mock.Mock()
         req_result.status_code = 204
         msg = {'not_id': 'whatever'}
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             res = conn.send_messages(json.dumps(msg))
-            self.assertFalse(requests.post.called)
-            self.assertEqual(res, 400)
\ No newline at end of file
+            self.assertFalse(requests.Session.post.called)
+            self.assertEqual(res, 400)
+
+    def test_send_messages_routed_by_time(self):
+        self.CONF.set_override('time_id', 'timestamp', group='es_conn')
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        self.CONF.set_override('time_unit', 'd', group='timed_strategy')
+        strategy = timed_strategy.TimedStrategy()
+        conn = es_conn.ESConnection('metrics', strategy, 'pre_')
+        req_result = mock.Mock()
+        req_result.status_code = 204
+        timestamp = time.mktime((2014, 7, 10, 12, 0, 0, 0, 0, -1))
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
+            conn.send_messages(json.dumps({'timestamp': timestamp}))
+            args, kwargs = requests.Session.post.call_args
+        self.assertEqual('http://fake/pre_20140710000000/metrics/', args[0])
+
+    def test_make_bulk_item_routed_by_time(self):
+        self.CONF.set_override('time_id', 'timestamp', group='es_conn')
+        self.CONF.set_override('id_field', 'id', group='es_conn')
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        self.CONF.set_override('time_unit', 'd', group='timed_strategy')
+        strategy = timed_strategy.TimedStrategy()
+        conn = es_conn.ESConnection('metrics', strategy, 'pre_')
+        day1 = time.mktime((2014, 7, 10, 23, 59, 0, 0, 0, -1))
+        day2 = day1 + 120
+        actions = []
+        for msg in [{'id': '1', 'timestamp': day1},
+                    {'id': '2', 'timestamp': day2}]:
+            item = conn.make_bulk_item(json.dumps(msg))
+            actions.append(json.loads(item.split('\n')[0]))
+        self.assertEqual({'index': {'_id': '1',
+                                    '_index': 'pre_20140710000000'}},
+                         actions[0])
+        self.assertEqual({'index': {'_id': '2',
+                                    '_index': 'pre_20140711000000'}},
+                         actions[1])
+
+        # messages without time go to the current index
+        strategy.set_time(day1)
+        self.assertEqual('pre_20140710000000', conn.index_for_msg({}))
+
+    def test_send_bulk_messages_partial_failure(self):
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        self.CONF.set_override('time_unit', 'h', group='timed_strategy')
+        strategy = timed_strategy.TimedStrategy()
+        conn = es_conn.ESConnection('metrics', strategy, 'pre_')
+        req_result = mock.Mock()
+        req_result.status_code = 200
+        req_result.json.return_value = {
+            'errors': True,
+            'items': [{'index': {'_id': '1', 'status': 201}},
+                      {'index': {'_id': '2', 'status': 400,
+                                 'error': 'MapperParsingException'}}]}
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
+            code, errors = conn.send_bulk_messages('whatever')
+            self.assertTrue(requests.Session.post.call_args[0][0].endswith(
+                '/metrics/_bulk'))
+        self.assertEqual(200, code)
+        self.assertEqual(1, len(errors))
+        self.assertEqual('2', errors[0]['_id'])
+
+    def test_shared_session(self):
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        self.CONF.set_override('timeout', 5.0, group='es_conn')
+        conn = es_conn.ESConnection('alarms', None, 'pre_')
+        other = es_conn.ESConnection('metrics', None, 'pre_')
+        self.assertIs(conn._session, other._session)
+        req_result = mock.Mock()
+        req_result.status_code = 200
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_result):
+            conn.get_message_by_id('whatever')
+            args, kwargs = requests.Session.get.call_args
+        self.assertEqual('http://fake/pre_*/alarms/_search?q=_id:whatever',
+                         args[0])
+        self.assertEqual(5.0, kwargs['timeout'])
+
+    def test_session_not_shared_after_fork(self):
+        session = es_conn.get_session()
+        self.assertIs(session, es_conn.get_session())
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(session, es_conn.get_session())
+
+    def test_request_fails_over(self):
+        self.CONF.set_override('uri', 'http://node1:9200,http://node2:9200',
+                               group='es_conn')
+        conn = es_conn.ESConnection('metrics', None, 'pre_')
+        self.assertEqual('http://node1:9200/', conn.uri)
+        req_result = mock.Mock()
+        req_result.status_code = 200
+
+        def _side_effect(url, **kwargs):
+            if url.startswith('http://node1:9200/'):
+                raise requests.ConnectionError()
+            return req_result
+
+        with mock.patch.object(requests.Session, 'post',
+                               side_effect=_side_effect):
+            for i in range(3):
+                res = conn.get_messages({})
+                self.assertEqual(200, res.status_code)
+            urls = [args[0][0] for args in
+                    requests.Session.post.call_args_list]
+        # node1 is only tried once, then it is left out while it is dead
+        self.assertEqual(1, len([url for url in urls if 'node1' in url]))
+        self.assertEqual(3, len([url for url in urls if 'node2' in url]))
+
+    def test_sniff_nodes(self):
+        self.CONF.set_override('uri', 'http://seed:9200', group='es_conn')
+        self.CONF.set_override('sniff', True, group='es_conn')
+        conn = es_conn.ESConnection('metrics', None, 'pre_')
+        req_result = mock.Mock()
+        req_result.status_code = 200
+        req_result.json.return_value = {'nodes': {
+            'a': {'http_address': 'inet[/10.0.0.1:9200]'},
+            'b': {'http': {'publish_address': '10.0.0.2:9200'}}}}
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_result):
+            conn.get_message_by_id('whatever')
+        self.assertEqual(['http://10.0.0.1:9200/', 'http://10.0.0.2:9200/'],
+                         conn._node_pool.nodes)
+
+    def test_scroll_messages(self):
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        conn = es_conn.ESConnection('alarmdefinitions', None, 'pre_')
+        pages = [[{'_id': 1}, {'_id': 2}], [{'_id': 3}, {'_id': 4}],
+                 [{'_id': 5}]]
+        responses = []
+        for page in pages:
+            res = mock.Mock()
+            res.status_code = 200
+            res.json.return_value = {'_scroll_id': 'sid',
+                                     'hits': {'hits': page}}
+            responses.append(res)
+        with mock.patch.object(requests.Session, 'post',
+                               side_effect=responses):
+            with mock.patch.object(requests.Session, 'delete'):
+                self.assertEqual(pages,
+                                 list(conn.scroll_messages({'size': 2})))
+                urls = [args[0][0] for args in
+                        requests.Session.post.call_args_list]
+                # the scroll is cleared once the last page is read
+                self.assertEqual(1, requests.Session.delete.call_count)
+        self.assertEqual('http://fake/pre_*/alarmdefinitions/_search'
+                         '?scroll=1m', urls[0])
+        self.assertEqual(['http://fake/_search/scroll?scroll=1m'] * 2,
+                         urls[1:])
+
+    def test_scroll_messages_failure(self):
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        conn = es_conn.ESConnection('alarmdefinitions', None, 'pre_')
+        first = mock.Mock()
+        first.status_code = 200
+        first.json.return_value = {'_scroll_id': 'sid',
+                                   'hits': {'hits': [{'_id': 1}]}}
+        failed = mock.Mock()
+        failed.status_code = 500
+        with mock.patch.object(requests.Session, 'post',
+                               side_effect=[first, failed]):
+            with mock.patch.object(requests.Session, 'delete'):
+                pages = conn.scroll_messages({'size': 1})
+                self.assertEqual([{'_id': 1}], next(pages))
+                self.assertRaisesRegexp(Exception, 'response code 500',
+                                        next, pages)
+                self.assertEqual(1, requests.Session.delete.call_count)
+
+
+class TestESNodePool(tests.BaseTestCase):
+
+    def setUp(self):
+        super(TestESNodePool, self).setUp()
+        self.CONF = self.useFixture(config.Config()).conf
+
+    def test_round_robin(self):
+        pool = es_conn.ESNodePool(['a/', 'b/', 'c/'])
+        nodes = [pool.get_node() for i in range(6)]
+        self.assertEqual(2, nodes.count('a/'))
+        self.assertEqual(2, nodes.count('b/'))
+        self.assertEqual(2, nodes.count('c/'))
+
+    def test_least_outstanding(self):
+        self.CONF.set_override('load_balancer', 'least_outstanding',
+                               group='es_conn')
+        pool = es_conn.ESNodePool(['a/', 'b/'])
+        first = pool.get_node()
+        second = pool.get_node()
+        self.assertNotEqual(first, second)
+        pool.release(first)
+        self.assertEqual(first, pool.get_node())
+
+    def test_dead_node_back_off(self):
+        self.CONF.set_override('dead_timeout', 10.0, group='es_conn')
+        self.CONF.set_override('max_dead_timeout', 30.0, group='es_conn')
+        pool = es_conn.ESNodePool(['a/', 'b/'])
+        with mock.patch.object(time, 'time', return_value=1000.0):
+            pool.mark_dead('a/')
+            self.assertEqual(1010.0, pool._dead_until['a/'])
+            self.assertEqual(['b/', 'b/'],
+                             [pool.get_node(), pool.get_node()])
+            pool.mark_dead('a/')
+            self.assertEqual(1020.0, pool._dead_until['a/'])
+            pool.mark_dead('a/')
+            self.assertEqual(1030.0, pool._dead_until['a/'])
+        with mock.patch.object(time, 'time', return_value=1030.0):
+            self.assertIn('a/', [pool.get_node(), pool.get_node()])
+            pool.mark_live('a/')
+        self.assertNotIn('a/', pool._dead_until)
+
+
+class TestESBulkWriter(tests.BaseTestCase):
+
+    def setUp(self):
+        super(TestESBulkWriter, self).setUp()
+        self.CONF = self.useFixture(config.Config()).conf
+        self.CONF.set_override('uri', 'http://fake', group='es_conn')
+        self.CONF.set_override('time_unit', 'h', group='timed_strategy')
+        self.strategy = timed_strategy.TimedStrategy()
+
+    def test_flush_on_max_docs(self):
+        self.CONF.set_override('bulk_max_docs', 3, group='es_conn')
+        conn = es_conn.ESConnection('metrics', self.strategy, 'pre_')
+        writer = es_conn.ESBulkWriter(conn)
+        with mock.patch.object(conn, 'send_bulk_messages',
+                               return_value=(200, [])):
+            self.assertIsNone(writer.add_bulk('{"index":{}}\n{"a":1}\n', 1))
+            self.assertIsNone(writer.add('{"b":2}'))
+            self.assertFalse(conn.send_bulk_messages.called)
+            self.assertEqual((200, []), writer.add('{"c":3}'))
+            body = conn.send_bulk_messages.call_args[0][0]
+        self.assertEqual('{"index":{}}\n{"a":1}\n'
+                         '{"index":{}}\n{"b":2}\n'
+                         '{"index":{}}\n{"c":3}\n', body)
+
+    def test_add_raw_documents(self):
+        conn = es_conn.ESConnection('metrics', self.strategy, 'pre_')
+        writer = es_conn.ESBulkWriter(conn)
+        with mock.patch.object(conn, 'send_bulk_messages',
+                               return_value=(200, [])):
+            writer.add('{"index":"a"}')
+            writer.add('{\n  "b": "x\\ny"\n}\n')
+            writer.add_bulk('{"index":{}}\n{"c":3}\n{"index":{}}\n{"d":4}\n',
+                            2)
+            self.assertEqual(4, writer._docs)
+            writer.flush()
+            body = conn.send_bulk_messages.call_args[0][0]
+        lines = body.splitlines()
+        self.assertEqual(8, len(lines))
+        self.assertEqual({'index': 'a'}, json.loads(lines[1]))
+        self.assertEqual({'b': 'x\ny'}, json.loads(lines[3]))
+
+    def test_flush_on_max_linger(self):
+        self.CONF.set_override('bulk_max_linger', 0.0, group='es_conn')
+        conn = es_conn.ESConnection('metrics', self.strategy, 'pre_')
+        writer = es_conn.ESBulkWriter(conn)
+        self.assertIsNone(writer.flush_if_due())
+        with mock.patch.object(conn, 'send_bulk_messages',
+                               return_value=(200, [])):
+            self.assertEqual((200, []), writer.add('{"a":1}'))
+        self.assertFalse(writer.is_due())
+
+    def test_add_with_id_field(self):
+        self.CONF.set_override('id_field', 'id', group='es_conn')
+        conn = es_conn.ESConnection('alarms', self.strategy, 'pre_')
+        writer = es_conn.ESBulkWriter(conn)
+        with mock.patch.object(conn, 'send_bulk_messages',
+                               return_value=(200, [])):
+            writer.add(json.dumps({'not_id': 'whatever'}))
+            writer.add(json.dumps({'id': 'whatever'}))
+            writer.flush()
+            body = conn.send_bulk_messages.call_args[0][0]
+        lines = body.splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual({'index': {'_id': 'whatever'}}, json.loads(lines[0]))
@@ -0,0 +1,55 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from monasca.common import hash_ring
+from monasca import tests
+
+
+class TestHashRing(tests.BaseTestCase):
+
+    def setUp(self):
+        super(TestHashRing, self).setUp()
+        self.keys = ['alarm_def_%s' % i for i in range(1000)]
+
+    def _owners(self, ring):
+        return dict((key, ring.get_node(key)) for key in self.keys)
+
+    def test_empty_ring(self):
+        ring = hash_ring.HashRing()
+        self.assertIsNone(ring.get_node('alarm_def_1'))
+
+    def test_deterministic(self):
+        ring = hash_ring.HashRing(['e1', 'e2', 'e3'])
+        other = hash_ring.HashRing(['e3', 'e1', 'e2'])
+        self.assertEqual(self._owners(ring), self._owners(other))
+
+    def test_balanced(self):
+        ring = hash_ring.HashRing(['e1', 'e2', 'e3'])
+        owners = self._owners(ring).values()
+        for node in ['e1', 'e2', 'e3']:
+            self.assertTrue(200 < owners.count(node) < 470)
+
+    def test_node_join_and_leave(self):
+        ring = hash_ring.HashRing(['e1', 'e2', 'e3'])
+        before = self._owners(ring)
+        self.assertTrue(ring.set_nodes(['e1', 'e2', 'e3', 'e4']))
+        after = self._owners(ring)
+        # only keys taken by the new node move
+        for key in self.keys:
+            if before[key] != after[key]:
+                self.assertEqual('e4', after[key])
+
+        self.assertTrue(ring.set_nodes(['e1', 'e2', 'e3']))
+        self.assertEqual(before, self._owners(ring))
+        self.assertFalse(ring.set_nodes(['e3', 'e2', 'e1']))
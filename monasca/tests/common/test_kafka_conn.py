@@ -0,0 +1,42 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from monasca.common import kafka_conn
+from monasca.openstack.common.fixture import config
+from monasca import tests
+
+import mock
+
+
+class TestKafkaConnection(tests.BaseTestCase):
+
+    def setUp(self):
+        super(TestKafkaConnection, self).setUp()
+        self.CONF = self.useFixture(config.Config()).conf
+        self.CONF.set_override('uri', 'fake_url', group='kafka_opts')
+
+    def _commit(self, conn):
+        conn._consumer = mock.Mock()
+        conn.commit()
+        return conn._consumer.commit.called
+
+    def test_commit_with_configured_auto_commit(self):
+        self.assertTrue(self._commit(kafka_conn.KafkaConnection('topic')))
+        self.CONF.set_override('auto_commit', False, group='kafka_opts')
+        self.assertFalse(self._commit(kafka_conn.KafkaConnection('topic')))
+
+    def test_commit_with_manual_commit(self):
+        conn = kafka_conn.KafkaConnection('topic', auto_commit=False)
+        self.assertTrue(conn.manual_commit)
+        self.assertTrue(self._commit(conn))
@@ -0,0 +1,81 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import threading
+
+from monasca.common import series_cache
+from monasca import tests
+
+
+class TestSeriesCache(tests.BaseTestCase):
+
+    def setUp(self):
+        super(TestSeriesCache, self).setUp()
+        self.cache = series_cache.SeriesCache(2)
+
+    def test_dimensions_hash(self):
+        dims = {'hostname': 'h1', 'service': 'monitoring'}
+        expected = hashlib.md5('{"hostname":"h1","service":"monitoring"}'
+                               ).hexdigest()
+        self.assertEqual(expected, self.cache.get_dimensions_hash(dims))
+        self.assertEqual(expected, self.cache.get_dimensions_hash(dims))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1},
+                         self.cache.stats())
+
+    def test_series_id(self):
+        dims = {'hostname': 'h1'}
+        key_str = json.dumps({'name': 'cpu', 'dimensions': dims},
+                             sort_keys=True, separators=(',', ':'))
+        series_id = self.cache.get_series_id('cpu', dims)
+        self.assertEqual(hashlib.md5(key_str).hexdigest(), series_id)
+        self.assertNotEqual(series_id, self.cache.get_series_id('mem', dims))
+        self.assertNotEqual(series_id, self.cache.get_dimensions_hash(dims))
+
+    def test_lru(self):
+        for host in ['h1', 'h2', 'h1', 'h3']:
+            self.cache.get_dimensions_hash({'hostname': host})
+        self.assertEqual([(None, (('hostname', 'h1'),)),
+                          (None, (('hostname', 'h3'),))],
+                         list(self.cache._entries.keys()))
+        self.assertEqual({'size': 2, 'hits': 1, 'misses': 3},
+                         self.cache.stats())
+
+    def test_unhashable_dimensions(self):
+        dims = {'hostname': ['h1', 'h2']}
+        self.assertEqual(series_cache.dimensions_hash(dims),
+                         self.cache.get_dimensions_hash(dims))
+        self.assertEqual({'size': 0, 'hits': 0, 'misses': 0},
+                         self.cache.stats())
+
+    def test_thread_safe(self):
+        cache = series_cache.SeriesCache(50)
+
+        def lookup():
+            for i in range(1000):
+                cache.get_dimensions_hash({'hostname': 'h%d' % (i % 100)})
+
+        threads = [threading.Thread(target=lookup) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        self.assertEqual(50, stats['size'])
+        self.assertEqual(4000, stats['hits'] + stats['misses'])
+
+    def test_shared_cache(self):
+        self.assertIs(series_cache.get_series_cache(),
+                      series_cache.get_series_cache())
@@ -0,0 +1,76 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import random
+
+from monasca.common import timer_wheel
+from monasca import tests
+
+
+class TestTimerWheel(tests.BaseTestCase):
+
+    def test_fire_when_due(self):
+        wheel = timer_wheel.TimerWheel(slots=4, levels=3, now=100)
+        wheel.schedule(101, 'a')
+        wheel.schedule(102.5, 'b')
+        wheel.schedule(150, 'c')
+        self.assertEqual(3, len(wheel))
+        self.assertEqual([], wheel.advance(100.9))
+        self.assertEqual(['a'], wheel.advance(101))
+        # never fired before its time
+        self.assertEqual([], wheel.advance(102.9))
+        self.assertEqual(['b'], wheel.advance(103))
+        self.assertEqual([], wheel.advance(149))
+        self.assertEqual(['c'], wheel.advance(150))
+        self.assertEqual(0, len(wheel))
+        self.assertIsNone(wheel.next_due())
+
+    def test_past_time_fires_next_tick(self):
+        wheel = timer_wheel.TimerWheel(now=100)
+        wheel.schedule(50, 'a')
+        self.assertEqual(101, wheel.next_due())
+        self.assertEqual(['a'], wheel.advance(101))
+
+    def test_reschedule_and_cancel(self):
+        wheel = timer_wheel.TimerWheel(slots=4, levels=2, now=0)
+        wheel.schedule(3, 'a')
+        wheel.schedule(30, 'a')
+        wheel.schedule(5, 'b')
+        wheel.cancel('b')
+        self.assertEqual([], wheel.advance(29))
+        self.assertEqual(['a'], wheel.advance(30))
+        self.assertEqual([], wheel.advance(100))
+
+    def test_beyond_horizon(self):
+        wheel = timer_wheel.TimerWheel(slots=4, levels=2, now=0)
+        wheel.schedule(1000, 'a')
+        self.assertEqual([], wheel.advance(999))
+        self.assertEqual(['a'], wheel.advance(1000))
+
+    def test_random_timers(self):
+        wheel = timer_wheel.TimerWheel(slots=8, levels=3, now=0)
+        rand = random.Random(42)
+        due = {}
+        for i in range(500):
+            due[i] = rand.uniform(0, 2000)
+            wheel.schedule(due[i], i)
+        fired = {}
+        now = 0
+        while wheel.next_due() is not None:
+            now = wheel.next_due()
+            for key in wheel.advance(now):
+                fired[key] = now
+        self.assertEqual(sorted(due), sorted(fired))
+        for key in due:
+            self.assertTrue(due[key] <= fired[key] < due[key] + 1)
@@ -0,0 +1,195 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+from monasca.common import es_conn
+from monasca.common import kafka_conn
+from monasca.microservice import es_persister
+from oslo.config import fixture as fixture_config
+from oslotest import base
+
+
+class TestESPersisterWorker(base.BaseTestCase):
+    def setUp(self):
+        self.CONF = self.useFixture(fixture_config.Config()).conf
+        self.CONF.kafka_opts.uri = 'fake_url'
+        self.CONF.kafka_opts.wait_time = 0
+        self.CONF.es_conn.uri = 'fake_es_url'
+        self.CONF.es_persister.topic = 'fake_topic'
+        self.CONF.es_persister.doc_type = 'fake_doc_type'
+        self.CONF.es_persister.index_strategy = ''
+        self.CONF.es_persister.processor = ''
+        self.CONF.es_persister.batch_size = 10
+        super(TestESPersisterWorker, self).setUp()
+        self.persister = es_persister.ESPersisterWorker()
+
+    def _messages(self, *values):
+        msgs = []
+        for value in values:
+            msg = mock.Mock()
+            msg.message.value = value
+            msgs.append(msg)
+        return msgs
+
+    def test_initialization(self):
+        self.assertFalse(self.persister._kafka_conn.auto_commit)
+        self.assertEqual(10, self.persister.batch_size)
+        self.assertEqual(1.0, self.persister.batch_timeout)
+
+    def test_offsets_always_committed_by_batch(self):
+        # there is no auto commit mode which could lose buffered messages
+        self.CONF.es_persister.batch_size = 0
+        worker = es_persister.ESPersisterWorker()
+        self.assertFalse(worker._kafka_conn.auto_commit)
+        self.assertEqual(1, worker.batch_size)
+
+    def test_index_router(self):
+        self.CONF.es_conn.time_id = 'timestamp'
+        self.CONF.es_persister.processor = 'metrics_msg_fixer'
+        worker = es_persister.ESPersisterWorker()
+        self.assertEqual(worker._es_conn.index_for_msg,
+                         worker.msg_processor._index_router)
+
+    def test_consume_batch_acked(self):
+        msgs = self._messages('{"a":1}', '{"a":2}')
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=msgs):
+            with mock.patch.object(kafka_conn.KafkaConnection,
+                                   'commit') as commit:
+                with mock.patch.object(es_conn.ESConnection,
+                                       'send_bulk_messages',
+                                       return_value=(200, [])) as send:
+                    self.persister.consume_batch()
+
+        self.assertEqual(1, send.call_count)
+        self.assertEqual('{"index":{}}\n{"a":1}\n{"index":{}}\n{"a":2}\n',
+                         send.call_args[0][0])
+        commit.assert_called_once_with()
+
+    def test_consume_batch_processed(self):
+        self.persister.msg_processor = mock.Mock()
+        self.persister.msg_processor.process_msg.return_value = (
+            '{"index":{}}\n{"a":1}\n{"index":{}}\n{"a":2}\n')
+        msgs = self._messages('[{"a":1},{"a":2}]')
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=msgs):
+            with mock.patch.object(kafka_conn.KafkaConnection, 'commit'):
+                with mock.patch.object(es_conn.ESBulkWriter,
+                                       'add_bulk') as add_bulk:
+                    self.persister.consume_batch()
+
+        add_bulk.assert_called_once_with(
+            '{"index":{}}\n{"a":1}\n{"index":{}}\n{"a":2}\n', 2)
+
+    def test_consume_batch_rejected_docs_acked(self):
+        msgs = self._messages('{"a":1}')
+        errors = [{'status': 400, 'error': 'MapperParsingException'}]
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=msgs):
+            with mock.patch.object(kafka_conn.KafkaConnection,
+                                   'commit') as commit:
+                with mock.patch.object(es_conn.ESConnection,
+                                       'send_bulk_messages',
+                                       return_value=(200, errors)):
+                    self.persister.consume_batch()
+
+        commit.assert_called_once_with()
+
+    def test_consume_batch_not_acked(self):
+        msgs = self._messages('{"a":1}')
+        errors = [{'status': 429, 'error': 'EsRejectedExecutionException'}]
+        for result in [(200, errors), (503, []), (200, [{'error': 'x'}])]:
+            with mock.patch.object(kafka_conn.KafkaConnection,
+                                   'get_message_batch', return_value=msgs):
+                with mock.patch.object(kafka_conn.KafkaConnection,
+                                       'commit') as commit:
+                    with mock.patch.object(kafka_conn.KafkaConnection,
+                                           'rewind') as rewind:
+                        with mock.patch.object(es_conn.ESConnection,
+                                               'send_bulk_messages',
+                                               return_value=result):
+                            self.persister.consume_batch()
+
+            self.assertFalse(commit.called)
+            rewind.assert_called_once_with()
+
+    def test_consume_batch_exception(self):
+        msgs = self._messages('{"a":1}')
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=msgs):
+            with mock.patch.object(kafka_conn.KafkaConnection,
+                                   'commit') as commit:
+                with mock.patch.object(kafka_conn.KafkaConnection,
+                                       'rewind') as rewind:
+                    with mock.patch.object(es_conn.ESConnection,
+                                           'send_bulk_messages',
+                                           side_effect=Exception('down')):
+                        self.persister.consume_batch()
+
+        self.assertFalse(commit.called)
+        rewind.assert_called_once_with()
+        self.assertEqual([], self.persister._bulk_writer._buffer)
+
+    def test_consume_batch_empty(self):
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=[]):
+            with mock.patch.object(kafka_conn.KafkaConnection,
+                                   'commit') as commit:
+                self.persister.consume_batch()
+
+        self.assertFalse(commit.called)
+
+
+class TestESPersister(base.BaseTestCase):
+    def setUp(self):
+        self.CONF = self.useFixture(fixture_config.Config()).conf
+        self.CONF.kafka_opts.uri = 'fake_url'
+        self.CONF.kafka_opts.partitions = [0, 1, 2]
+        self.CONF.es_conn.uri = 'fake_es_url'
+        self.CONF.es_persister.index_strategy = ''
+        super(TestESPersister, self).setUp()
+
+    def test_single_worker(self):
+        self.CONF.es_persister.workers = 1
+        persister = es_persister.ESPersister()
+        self.assertEqual([[0, 1, 2]], persister.worker_partitions)
+        self.assertEqual([0, 1, 2], persister._worker._kafka_conn.partitions)
+
+    def test_worker_per_partition(self):
+        self.CONF.es_persister.workers = 0
+        persister = es_persister.ESPersister()
+        self.assertEqual([[0], [1], [2]], persister.worker_partitions)
+        self.assertIsNone(persister._worker)
+
+    def test_workers_share_partitions(self):
+        self.CONF.es_persister.workers = 2
+        persister = es_persister.ESPersister()
+        self.assertEqual([[0, 2], [1]], persister.worker_partitions)
+
+        self.CONF.es_persister.workers = 5
+        persister = es_persister.ESPersister()
+        self.assertEqual([[0], [1], [2]], persister.worker_partitions)
+
+    def test_start_worker_processes(self):
+        self.CONF.es_persister.workers = 2
+        persister = es_persister.ESPersister()
+        with mock.patch('multiprocessing.Process') as process:
+            persister.start()
+
+        self.assertEqual(
+            [mock.call(target=es_persister.run_worker, args=([0, 2],)),
+             mock.call(target=es_persister.run_worker, args=([1],))],
+            process.call_args_list)
+        self.assertEqual(2, process.return_value.start.call_count)
+        self.assertEqual(2, process.return_value.join.call_count)
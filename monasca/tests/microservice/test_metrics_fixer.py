@@ -14,10 +14,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import json
 import time
 
 
+from monasca.common import series_cache
 from monasca.microservice import metrics_fixer
 from monasca.openstack.common import log
 from monasca import tests
@@ -31,15 +33,16 @@ class TestMetricsFixer(tests.BaseTestCase):
         super(TestMetricsFixer, self).setUp()
 
     def test__add_hash(self):
+        fixer = metrics_fixer.MetricsFixer()
         item = {'name': 'name1', 'dimensions': {'name1': 'value1'},
                 'timestamp': time.time()}
-        result = metrics_fixer.MetricsFixer._add_hash(item)
+        result = fixer._add_hash(item)
         data = json.loads(result)
         self.assertTrue(data.get('dimensions_hash'))
         self.assertTrue(data['timestamp'])
 
         item = {'name': 'name1', 'timestamp': time.time()}
-        result = metrics_fixer.MetricsFixer._add_hash(item)
+        result = fixer._add_hash(item)
         data = json.loads(result)
         self.assertFalse(data.get('dimensions_hash'))
         self.assertTrue(data['timestamp'])
@@ -59,3 +62,62 @@ class TestMetricsFixer(tests.BaseTestCase):
         fixer = metrics_fixer.MetricsFixer()
         result = fixer.process_msg(json.dumps(items))
         self.assertTrue(isinstance(result, str))
+
+    def test_dimensions_hash_unchanged(self):
+        dims = {'hostname': 'h1', 'service': 'monitoring', 'id': 3}
+        key_str = json.dumps(dims, sort_keys=True, indent=None,
+                             separators=(',', ':'))
+        fixer = metrics_fixer.MetricsFixer()
+        for i in range(2):
+            data = json.loads(fixer._add_hash({'dimensions': dict(dims),
+                                               'timestamp': 1}))
+            self.assertEqual(hashlib.md5(key_str).hexdigest(),
+                             data['dimensions_hash'])
+
+    def test_dimensions_hash_cached(self):
+        fixer = metrics_fixer.MetricsFixer()
+        fixer._series_cache = series_cache.SeriesCache(10)
+        for host in ['h1', 'h2', 'h1', 'h1']:
+            fixer._add_hash({'dimensions': {'hostname': host},
+                             'timestamp': 1})
+        self.assertEqual({'size': 2, 'hits': 2, 'misses': 2},
+                         fixer._series_cache.stats())
+
+    def test_process_msg_bulk_body(self):
+        items = [{'name': 'name1', 'dimensions': {'name1': 'value1'},
+                  'timestamp': 1}, {'name': 'name2', 'timestamp': 2}]
+        fixer = metrics_fixer.MetricsFixer()
+        lines = fixer.process_msg(json.dumps(items)).split('\n')
+        self.assertEqual(5, len(lines))
+        self.assertEqual('{"index":{}}', lines[0])
+        self.assertEqual('name1', json.loads(lines[1])['name'])
+        self.assertEqual('{"index":{}}', lines[2])
+        self.assertEqual('name2', json.loads(lines[3])['name'])
+        self.assertEqual('', lines[4])
+
+    def test_process_msg_index_router(self):
+        items = [{'name': 'name1', 'timestamp': 1},
+                 {'name': 'name2', 'timestamp': 2}]
+        fixer = metrics_fixer.MetricsFixer()
+        fixer.set_index_router(lambda item: 'data_%s' % item['timestamp'])
+        lines = fixer.process_msg(json.dumps(items)).split('\n')
+        self.assertEqual('{"index":{"_index":"data_1"}}', lines[0])
+        self.assertEqual('{"index":{"_index":"data_2"}}', lines[2])
+
+    def test_process_msg_keeps_float_precision(self):
+        items = [{'name': 'name1', 'value': 1.23456789012345e-12,
+                  'timestamp': 1.4251234567891234e9}]
+        fixer = metrics_fixer.MetricsFixer()
+        lines = fixer.process_msg(json.dumps(items)).split('\n')
+        data = json.loads(lines[1])
+        self.assertEqual(1.23456789012345e-12, data['value'])
+        self.assertEqual(1.4251234567891234e9, data['timestamp'])
+
+    def test_process_msg_round_trip(self):
+        msg = ('{"name":"name1","value":0.00010041366152291396,'
+               '"timestamp":1425123456.789}')
+        fixer = metrics_fixer.MetricsFixer()
+        lines = fixer.process_msg(msg).split('\n')
+        self.assertIn('"value":0.00010041366152291396', lines[1])
+        self.assertEqual(0.00010041366152291396,
+                         json.loads(lines[1])['value'])
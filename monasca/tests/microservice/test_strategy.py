@@ -15,6 +15,7 @@
 # under the License.
 
 import dateutil.parser as dparser
+import mock
 import time
 
 from monasca.microservice import timed_strategy
@@ -147,3 +148,85 @@ class TestStrategy(tests.BaseTestCase):
         self.strategy.set_time('Nov 15, 2014')
         self.assertEqual('20140101000000',
                          self.strategy.get_index())
+
+    def test_week_across_years(self):
+        self.CONF.set_override('time_unit', 'w', group='timed_strategy')
+        self.strategy = timed_strategy.TimedStrategy()
+        self.assertEqual('20131229000000',
+                         self.strategy.get_index_for('2014-01-01'))
+        self.assertEqual('20150104000000',
+                         self.strategy.get_index_for('2015-01-10'))
+
+    def test_frequency(self):
+        self.CONF.set_override('frequency', 2, group='timed_strategy')
+        self.CONF.set_override('start_date', '2014-01-01',
+                               group='timed_strategy')
+        cases = [('y', '2017-05-01', '20160101000000'),
+                 ('m', '2014-04-15', '20140301000000'),
+                 ('m', '2015-01-15', '20150101000000'),
+                 ('w', '2014-01-10', '20131229000000'),
+                 ('w', '2014-01-12', '20140112000000'),
+                 ('d', '2014-01-12', '20140111000000'),
+                 ('h', '2014-07-10 13:10:00', '20140710120000')]
+        for time_unit, a_date, index in cases:
+            self.CONF.set_override('time_unit', time_unit,
+                                   group='timed_strategy')
+            self.strategy = timed_strategy.TimedStrategy()
+            self.assertEqual(index, self.strategy.get_index_for(a_date))
+
+    def test_float_timestamp(self):
+        self.CONF.set_override('time_unit', 'd', group='timed_strategy')
+        self.strategy = timed_strategy.TimedStrategy()
+        day = dparser.parse('2014-07-10 12:34:56', fuzzy=True)
+        self.assertEqual('20140710000000', self.strategy.get_index_for(
+            time.mktime(day.timetuple()) + 0.5))
+        self.assertIsNone(self.strategy.get_index_for('not a date'))
+
+    def test_current_index_cached(self):
+        self.CONF.set_override('time_unit', 'h', group='timed_strategy')
+        self.strategy = timed_strategy.TimedStrategy()
+        day = dparser.parse('2014-07-10 12:34:56', fuzzy=True)
+        now = time.mktime(day.timetuple())
+        with mock.patch.object(time, 'time', return_value=now):
+            self.assertEqual('20140710120000', self.strategy.get_index())
+            with mock.patch.object(self.strategy, '_range_start') as start:
+                self.assertEqual('20140710120000', self.strategy.get_index())
+                self.assertFalse(start.called)
+
+        # the cached index expires with its time range
+        with mock.patch.object(time, 'time', return_value=now + 3600):
+            self.assertEqual('20140710130000', self.strategy.get_index())
+
+    def test_index_for_last_range(self):
+        self.CONF.set_override('time_unit', 'd', group='timed_strategy')
+        self.strategy = timed_strategy.TimedStrategy()
+        day = dparser.parse('2014-07-10 12:34:56', fuzzy=True)
+        timestamp = time.mktime(day.timetuple())
+        self.assertEqual('20140710000000',
+                         self.strategy.get_index_for(timestamp))
+        with mock.patch.object(self.strategy, '_range_start') as start:
+            self.assertEqual('20140710000000',
+                             self.strategy.get_index_for(timestamp + 3600))
+            self.assertFalse(start.called)
+        self.assertEqual('20140711000000',
+                         self.strategy.get_index_for(timestamp + 86400))
+        self.assertEqual('20140710000000',
+                         self.strategy.get_index_for(timestamp))
+
+    def test_get_indices(self):
+        self.CONF.set_override('time_unit', 'd', group='timed_strategy')
+        self.strategy = timed_strategy.TimedStrategy()
+        start = time.mktime((2014, 7, 10, 12, 0, 0, 0, 0, -1))
+        end = start + 2 * 86400
+        self.assertEqual(['20140710000000', '20140711000000',
+                          '20140712000000'],
+                         self.strategy.get_indices(start, end))
+        self.assertEqual(['20140710000000'],
+                         self.strategy.get_indices(start, start + 60))
+        self.assertIsNone(self.strategy.get_indices(start, end, limit=2))
+        self.assertEqual(['20140701000000', '20140801000000'],
+                         self._month_indices('2014-07-10', '2014-08-02'))
+
+    def _month_indices(self, start, end):
+        self.CONF.set_override('time_unit', 'm', group='timed_strategy')
+        return timed_strategy.TimedStrategy().get_indices(start, end)
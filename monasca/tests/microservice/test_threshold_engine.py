@@ -15,10 +15,16 @@
 # under the License.
 
 
+import json
 import mock
+from monasca.common import alarm_expr_parser as parser
 from monasca.common import es_conn
+from monasca.common import hash_ring
 from monasca.common import kafka_conn
+from monasca.common import timer_wheel
 from monasca.microservice import threshold_engine as engine
+from monasca.microservice import threshold_processor
+from monasca.openstack.common import timeutils as tu
 from oslo.config import fixture as fixture_config
 from oslotest import base
 from stevedore import driver
@@ -85,15 +91,10 @@ class TestThresholdEngine(base.BaseTestCase):
         res.status_code = 200
         response_json = self.get_response_str(ad)
         res.json.return_value = response_json
-        processor = mock.Mock()
-        with mock.patch.object(driver.DriverManager, '__init__',
-                               return_value=None):
-            with mock.patch.object(driver.DriverManager, 'driver',
-                                   return_value=processor):
-                with mock.patch.object(es_conn.ESConnection, 'get_messages',
-                                       return_value=res):
-                    (self.thresh_engine.thread_alarm_def.
-                     refresh_alarm_processors())
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            (self.thresh_engine.thread_alarm_def.
+             refresh_alarm_processors())
         print (self.thresh_engine.thread_alarm_def.threshold_processors)
         tp = self.thresh_engine.thread_alarm_def.threshold_processors
         self.assertEqual(3, len(tp))
@@ -108,15 +109,10 @@ class TestThresholdEngine(base.BaseTestCase):
         res.status_code = 200
         response_json = self.get_response_str(ad)
         res.json.return_value = response_json
-        processor = mock.Mock()
-        with mock.patch.object(driver.DriverManager, '__init__',
-                               return_value=None):
-            with mock.patch.object(driver.DriverManager, 'driver',
-                                   return_value=processor):
-                with mock.patch.object(es_conn.ESConnection, 'get_messages',
-                                       return_value=res):
-                    (self.thresh_engine.thread_alarm_def.
-                     refresh_alarm_processors())
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            (self.thresh_engine.thread_alarm_def.
+             refresh_alarm_processors())
         print (self.thresh_engine.thread_alarm_def.threshold_processors)
         tp = self.thresh_engine.thread_alarm_def.threshold_processors
         self.assertEqual(3, len(tp))
@@ -132,19 +128,136 @@ class TestThresholdEngine(base.BaseTestCase):
         res.status_code = 201
         response_json = self.get_response_str(ad)
         res.json.return_value = response_json
-        processor = mock.Mock()
-        with mock.patch.object(driver.DriverManager, '__init__',
-                               return_value=None):
-            with mock.patch.object(driver.DriverManager, 'driver',
-                                   return_value=processor):
-                with mock.patch.object(es_conn.ESConnection, 'get_messages',
-                                       return_value=res):
-                    (self.thresh_engine.thread_alarm_def.
-                     refresh_alarm_processors())
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            (self.thresh_engine.thread_alarm_def.
+             refresh_alarm_processors())
         print (self.thresh_engine.thread_alarm_def.threshold_processors)
         tp = self.thresh_engine.thread_alarm_def.threshold_processors
         self.assertEqual(3, len(tp))
 
+    def test_refresh_alarm_definitions_by_page(self):
+        thread = self.thresh_engine.thread_alarm_def
+        thread.threshold_processors['fake_id_0'] = {'json': {}}
+        pages = [[{'_source': {'id': 'fake_id_1'}}],
+                 [{'_source': {'id': 'fake_id_2'}}]]
+
+        def scroll(cond):
+            self.assertEqual(1000, cond['size'])
+            for page in pages:
+                # the definitions of a page are applied before the next one
+                self.assertEqual(pages.index(page) + 1,
+                                 len(thread.threshold_processors))
+                yield page
+            if failed:
+                raise Exception('Scroll request failed')
+
+        with mock.patch.object(es_conn.ESConnection,
+                               'scroll_messages',
+                               side_effect=scroll):
+            # nothing is dropped when a page fails to be read
+            failed = True
+            thread.refresh_alarm_processors()
+            self.assertEqual(['fake_id_0', 'fake_id_1', 'fake_id_2'],
+                             sorted(thread.threshold_processors))
+            self.assertIsNone(thread.last_sync)
+            failed = False
+            del thread.threshold_processors['fake_id_1']
+            del thread.threshold_processors['fake_id_2']
+            thread.refresh_alarm_processors()
+        self.assertEqual(['fake_id_1', 'fake_id_2'],
+                         sorted(thread.threshold_processors))
+
+    def test_get_matchers(self):
+        get_matchers = engine.AlarmDefinitionConsumer.get_matchers
+        matchers = get_matchers({'expression': 'max(CPU{os=Linux})>10'})
+        self.assertEqual([('cpu', (('os', 'linux'),))],
+                         [(m.name, m.dimensions) for m in matchers])
+        self.assertIsNone(get_matchers({'expression': 'fake_expr'}))
+        self.assertIsNone(get_matchers({}))
+
+    def test_alarm_definition_events(self):
+        thread = self.thresh_engine.thread_alarm_def
+        ad = {'id': 'fake_id_0', 'name': 'Fake_Name_CPU',
+              'expression_data': [{'dimensions': {'fake_key': 'fake_value'}}]}
+        thread.handle_event({'event': 'created', 'id': 'fake_id_0',
+                             'alarm_definition': ad})
+        self.assertIn('fake_id_0', thread.threshold_processors)
+        # the name and dimensions filters apply to the events
+        other = dict(ad, id='fake_id_1', name='other')
+        thread.handle_event({'event': 'created', 'id': 'fake_id_1',
+                             'alarm_definition': other})
+        self.assertNotIn('fake_id_1', thread.threshold_processors)
+        updated = dict(ad, expression_data=[])
+        thread.handle_event({'event': 'updated', 'id': 'fake_id_0',
+                             'alarm_definition': updated})
+        self.assertNotIn('fake_id_0', thread.threshold_processors)
+        thread.handle_event({'event': 'updated', 'id': 'fake_id_0',
+                             'alarm_definition': ad})
+        self.assertIn('fake_id_0', thread.threshold_processors)
+        thread.handle_event({'event': 'deleted', 'id': 'fake_id_0'})
+        self.assertNotIn('fake_id_0', thread.threshold_processors)
+
+    def test_outdated_alarm_definition_events_ignored(self):
+        thread = self.thresh_engine.thread_alarm_def
+        thread.last_refresh = 1000.5
+        ad = {'id': 'fake_id_0', 'name': 'fake_name',
+              'expression_data': [{'dimensions': {'fake_key': 'fake_value'}}]}
+        # replayed from before the last full reconciliation
+        thread.handle_event({'event': 'created', 'id': 'fake_id_0',
+                             'alarm_definition': ad,
+                             'timestamp': 939})
+        self.assertNotIn('fake_id_0', thread.threshold_processors)
+        # stamped by an api whose clock is behind
+        thread.handle_event({'event': 'created', 'id': 'fake_id_0',
+                             'alarm_definition': ad,
+                             'timestamp': 940})
+        self.assertIn('fake_id_0', thread.threshold_processors)
+
+    def test_sync_alarm_definitions(self):
+        thread = self.thresh_engine.thread_alarm_def
+        ad = [{'id': 'fake_id_0', 'expression': 'fake_expr_0'},
+              {'id': 'fake_id_1', 'expression': 'fake_expr_1'}]
+
+        def respond(*hits):
+            responses = []
+            for h in hits:
+                res = mock.Mock()
+                res.status_code = 200
+                res.json.return_value = self.get_response_str(h)
+                responses.append(res)
+            return responses
+
+        with mock.patch.object(engine.time, 'time',
+                               return_value=1000):
+            with mock.patch.object(es_conn.ESConnection,
+                                   'get_messages',
+                                   side_effect=respond(ad)) as get:
+                # the first reconciliation reads everything
+                thread.sync_alarm_processors()
+        self.assertEqual(1000, thread.last_sync)
+        self.assertNotIn('range', json.dumps(get.call_args[0][0]))
+        updated = [{'id': 'fake_id_1', 'expression': 'fake_expr_2'}]
+        ids = [{'id': 'fake_id_1'}]
+        with mock.patch.object(engine.time, 'time',
+                               return_value=1200):
+            with mock.patch.object(es_conn.ESConnection,
+                                   'get_messages',
+                                   side_effect=respond(updated, ids)
+                                   ) as get:
+                thread.sync_alarm_processors()
+        self.assertEqual(1200, thread.last_sync)
+        since, ids_only = [c[0][0] for c in get.call_args_list]
+        self.assertIn({'bool': {'should': [
+            {'range': {'updated_timestamp': {'gte': 820}}},
+            {'filtered': {'filter': {
+                'missing': {'field': 'updated_timestamp'}}}}]}},
+            since['query']['bool']['must'])
+        self.assertEqual(['id'], ids_only['_source'])
+        tp = thread.threshold_processors
+        self.assertEqual(['fake_id_1'], tp.keys())
+        self.assertEqual('fake_expr_2', tp['fake_id_1']['json']['expression'])
+
     def test_consume_metrics(self):
         # test consume received metrics
         raw_metrics = [
@@ -160,58 +273,391 @@ class TestThresholdEngine(base.BaseTestCase):
         metrics = [mock.Mock(), mock.Mock(), mock.Mock()]
         for i in range(len(raw_metrics)):
             metrics[i].message.value = raw_metrics[i]
-        pre = self.thresh_engine.thread_metrics.threshold_processors.copy()
-        with mock.patch.object(kafka_conn.KafkaConnection, 'get_messages',
-                               return_value=metrics):
+        pre = self.thresh_engine.threshold_processors.copy()
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=metrics):
             self.thresh_engine.thread_metrics.read_metrics()
-        self.assertEqual(pre,
-                         self.thresh_engine.thread_metrics.
-                         threshold_processors)
+        self.assertEqual(pre, self.thresh_engine.threshold_processors)
 
         # read one alarm definition and test consume metrics again
-        processor = mock.Mock()
         res = mock.Mock()
         res.status_code = 200
         response_json = self.get_response_str([{'id': 'fake_id_1'}])
         res.json.return_value = response_json
-        with mock.patch.object(driver.DriverManager, '__init__',
-                               return_value=None):
-            with mock.patch.object(driver.DriverManager, 'driver',
-                                   return_value=processor):
-                with mock.patch.object(es_conn.ESConnection, 'get_messages',
-                                       return_value=res):
-                    (self.thresh_engine.thread_alarm_def.
-                     refresh_alarm_processors())
-        pre = self.thresh_engine.thread_metrics.threshold_processors.copy()
-        with mock.patch.object(kafka_conn.KafkaConnection, 'get_messages',
-                               return_value=metrics):
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            (self.thresh_engine.thread_alarm_def.
+             refresh_alarm_processors())
+        pre = self.thresh_engine.threshold_processors.copy()
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=metrics):
             self.thresh_engine.thread_metrics.read_metrics()
-        self.assertEqual(pre,
-                         self.thresh_engine.thread_metrics.
-                         threshold_processors)
-        print (self.thresh_engine.thread_metrics.threshold_processors)
+        self.assertEqual(pre, self.thresh_engine.threshold_processors)
+        print (self.thresh_engine.threshold_processors)
 
-    def test_publish_alarms(self):
-        # read one alarm definition
-        processor = mock.Mock()
+    def test_consume_metrics_routed_by_name(self):
+        cpu = mock.Mock()
+        mem = mock.Mock()
+        consumer = self.thresh_engine.thread_metrics
+        shard = self.thresh_engine.shards.shards[0]
+        for aid, processor, expr in [
+                ('cpu_id', cpu, 'max(cpu{hostname=h1})>1'),
+                ('mem_id', mem, 'max(mem)>1')]:
+            shard.processors[aid] = processor
+            self.thresh_engine.metric_router.add(
+                aid, parser.AlarmExprParser(expr).sub_expr_matchers)
+
+        raw_metrics = ['{"name": "CPU", "value": 1, '
+                       '"dimensions": {"hostname": "H1"}}',
+                       '{"name": "cpu", "value": 1, '
+                       '"dimensions": {"hostname": "h2"}}',
+                       'not json']
+        metrics = [mock.Mock(), mock.Mock(), mock.Mock()]
+        for i in range(len(raw_metrics)):
+            metrics[i].message.value = raw_metrics[i]
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_message_batch', return_value=metrics):
+            consumer.read_metrics()
+        shard.process_pending()
+        cpu.process_metrics.assert_called_once_with(
+            {'name': 'CPU', 'value': 1, 'dimensions': {'hostname': 'H1'}})
+        self.assertFalse(mem.process_metrics.called)
+
+    def test_decode_metrics(self):
+        metric = {'name': 'cpu', 'value': 1}
+        decode = engine.MetricsConsumer.decode_metrics
+        self.assertEqual([metric], decode(json.dumps(metric)))
+        self.assertEqual([metric, metric],
+                         decode(json.dumps([metric, metric])))
+        envelope = {'metric': metric, 'meta': {'tenantId': 't1'},
+                    'creation_time': 1}
+        self.assertEqual([metric], decode(json.dumps(envelope)))
+        envelope['metric'] = [metric, metric]
+        self.assertEqual([metric, metric], decode(json.dumps(envelope)))
+        self.assertRaises(ValueError, decode, 'not json')
+
+    def test_shards_own_processors(self):
+        self.CONF.thresholdengine.workers = 4
+        thresh_engine = engine.ThresholdEngine()
+        shards = thresh_engine.shards
+        self.assertEqual(4, len(shards.shards))
+        ad = [{'id': 'fake_id_%s' % i, 'expression': 'fake_expr'}
+              for i in range(20)]
         res = mock.Mock()
         res.status_code = 200
-        response_json = self.get_response_str([{'id': 'fake_id_1'}])
-        res.json.return_value = response_json
+        res.json.return_value = self.get_response_str(ad)
         with mock.patch.object(driver.DriverManager, '__init__',
                                return_value=None):
-            with mock.patch.object(driver.DriverManager, 'driver',
-                                   return_value=processor):
+            with mock.patch.object(driver.DriverManager, 'driver'):
                 with mock.patch.object(es_conn.ESConnection, 'get_messages',
                                        return_value=res):
-                    (self.thresh_engine.thread_alarm_def.
+                    (thresh_engine.thread_alarm_def.
                      refresh_alarm_processors())
+                for shard in shards.shards:
+                    shard.process_pending()
 
-        # test send alarms
-        pre = self.thresh_engine.thread_alarm.threshold_processors.copy()
-        with mock.patch.object(kafka_conn.KafkaConnection, 'send_messages',
-                               return_value=None):
-            self.thresh_engine.thread_alarm.send_alarm()
-        self.assertEqual(pre,
-                         self.thresh_engine.thread_alarm.
-                         threshold_processors)
+        owned = []
+        for shard in shards.shards:
+            for aid in shard.processors:
+                self.assertIs(shard, shards.get_shard(aid))
+                owned.append(aid)
+        self.assertEqual(sorted(a['id'] for a in ad), sorted(owned))
+        self.assertTrue(all(shard.processors for shard in shards.shards))
+
+        # deleted definitions leave their shard
+        res.json.return_value = self.get_response_str(ad[1:])
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            thresh_engine.thread_alarm_def.refresh_alarm_processors()
+        shard = shards.get_shard('fake_id_0')
+        shard.process_pending()
+        self.assertNotIn('fake_id_0', shard.processors)
+
+    def test_publish_shard_alarms(self):
+        shard = self.thresh_engine.shards.shards[0]
+        processor = mock.Mock()
+        processor.process_alarms.return_value = ['alarm_1', 'alarm_2']
+        processor.series_names.return_value = []
+        shard.processors['fake_id_1'] = processor
+        publisher = self.thresh_engine.thread_alarm
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'send_messages') as send:
+            shard.evaluate_series('fake_id_1', None, 1000)
+            publisher.publish_alarms()
+        self.assertEqual([mock.call('alarm_1'), mock.call('alarm_2')],
+                         send.call_args_list)
+
+    def _shard_with_processor(self):
+        shard = self.thresh_engine.shards.shards[0]
+        shard.interval = 600
+        shard.timers = timer_wheel.TimerWheel(now=1000)
+        processor = mock.Mock()
+        processor.process_alarms.return_value = ['alarm']
+        processor.series_names.return_value = ['s1', 's2']
+        processor.pop_dirty.return_value = set(['s1'])
+        processor.next_evaluation.side_effect = (
+            lambda now, name: None if name == 's2' else now + 60)
+        shard.processors['fake_id_1'] = processor
+        return shard, processor
+
+    def test_shard_evaluates_dirty_after_delay(self):
+        shard, processor = self._shard_with_processor()
+        with mock.patch.object(engine.time, 'time', return_value=1001):
+            shard.handle(('metrics', {'name': 'cpu'}, ['fake_id_1']))
+        self.assertEqual(set(['fake_id_1']), shard.dirty)
+        self.assertEqual(0.5, shard.get_wait(1001))
+        shard.evaluate_due(1001.2)
+        self.assertFalse(processor.process_alarms.called)
+        shard.evaluate_due(1001.5)
+        processor.process_alarms.assert_called_once_with(set(['s1']), True)
+        self.assertEqual(set(), shard.dirty)
+        self.assertEqual({('fake_id_1', 's1'): 1062}, shard.timers.timers)
+        # the wheel wakes up when its upper slots move down at 1024
+        self.assertEqual(22.5, shard.get_wait(1001.5))
+        self.assertEqual('alarm', shard.outbox.get_nowait())
+
+    def test_shard_alarms_before_period_ends(self):
+        shard = self.thresh_engine.shards.shards[0]
+        ad = {'id': 'fake_id_1', 'name': 'cpu', 'match_by': [],
+              'expression': 'max(cpu)>10'}
+        shard.processors['fake_id_1'] = (
+            threshold_processor.ThresholdProcessor(ad))
+        start = 6000
+        metric = {'name': 'cpu', 'value': 20, 'timestamp': start + 10}
+        with mock.patch.object(tu, 'utcnow_ts', return_value=start + 10):
+            with mock.patch.object(engine.time, 'time',
+                                   return_value=start + 10):
+                shard.handle(('metrics', metric, ['fake_id_1']))
+            # the breaching metrics get the series to ALARM once the
+            # evaluation delay is over, not at the end of the period
+            shard.evaluate_due(start + 10.5)
+        alarm = json.loads(shard.outbox.get_nowait())
+        self.assertEqual('ALARM', alarm['state'])
+
+    def test_shard_evaluates_series_timers(self):
+        shard, processor = self._shard_with_processor()
+        shard.evaluate_series('fake_id_1', None, 1000)
+        processor.process_alarms.assert_called_once_with(['s1', 's2'], False)
+        self.assertEqual({('fake_id_1', 's1'): 1060}, shard.timers.timers)
+        shard.evaluate_due(1059)
+        self.assertEqual(1, processor.process_alarms.call_count)
+        shard.evaluate_due(1060)
+        processor.process_alarms.assert_called_with(set(['s1']), False)
+        self.assertEqual({('fake_id_1', 's1'): 1120}, shard.timers.timers)
+        # no later than check_alarm_interval
+        shard.interval = 10
+        shard.evaluate_due(1120)
+        self.assertEqual({('fake_id_1', 's1'): 1130}, shard.timers.timers)
+        # the timers of deleted definitions are dropped
+        shard.handle(('delete', 'fake_id_1'))
+        shard.evaluate_due(1130)
+        self.assertEqual(3, processor.process_alarms.call_count)
+        self.assertEqual(0, len(shard.timers))
+
+
+class TestPartitionedEngine(base.BaseTestCase):
+    def setUp(self):
+        self.CONF = self.useFixture(fixture_config.Config()).conf
+        self.CONF.kafka_opts.uri = 'fake_url'
+        self.CONF.kafka_opts.group = 'fake_group'
+        self.CONF.thresholdengine.partitioned = True
+        self.CONF.thresholdengine.instance_id = 'e1'
+        self.CONF.alarmdefinitions.index_strategy = ''
+        self.CONF.es_conn.uri = 'fake_es_url'
+        super(TestPartitionedEngine, self).setUp()
+        self.thresh_engine = engine.ThresholdEngine()
+
+    def _refresh_membership(self, members):
+        thread = self.thresh_engine.thread_alarm_def
+        with mock.patch.object(thread.membership, 'heartbeat'):
+            with mock.patch.object(thread.membership, 'get_members',
+                                   return_value=members):
+                thread.refresh_membership()
+
+    def _owned(self):
+        return set(aid for aid, entry in
+                   self.thresh_engine.threshold_processors.items()
+                   if entry['owned'])
+
+    def _refresh(self, ad, members):
+        res = mock.Mock()
+        res.status_code = 200
+        res.json.return_value = {'hits': {'hits': [{'_source': d}
+                                                   for d in ad]}}
+        self._refresh_membership(members)
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            (self.thresh_engine.thread_alarm_def.
+             refresh_alarm_processors())
+        return self._owned()
+
+    def test_initialization(self):
+        consumer = self.thresh_engine.thread_metrics
+        self.assertEqual('fake_group', consumer._consume_kafka_conn.group)
+        self.assertEqual([], consumer._consume_kafka_conn.partitions)
+        self.assertEqual('metrics_e1', consumer._owned_kafka_conn.topic)
+        membership = self.thresh_engine.thread_alarm_def.membership
+        self.assertEqual('e1', membership.instance_id)
+        self.assertIs(membership, consumer.membership)
+
+    def test_rebalance(self):
+        ad = [{'id': 'fake_id_%s' % i} for i in range(50)]
+        all_ids = set(d['id'] for d in ad)
+        ring = hash_ring.HashRing(['e1', 'e2'])
+        owned = self._refresh(ad, ['e2'])
+        self.assertEqual(set(aid for aid in all_ids
+                             if ring.get_node(aid) == 'e1'), owned)
+        self.assertTrue(0 < len(owned) < len(ad))
+        # the metrics of all the definitions are routed
+        self.assertEqual(all_ids, set(self.thresh_engine.threshold_processors))
+
+        # the other instance is gone
+        self.assertEqual(all_ids, self._refresh(ad, ['e1']))
+        # it is back
+        self.assertEqual(owned, self._refresh(ad, ['e1', 'e2']))
+
+    def test_heartbeat_moves_definitions(self):
+        ad = [{'id': 'fake_id_%s' % i} for i in range(20)]
+        owned = self._refresh(ad, ['e1', 'e2'])
+        shard = self.thresh_engine.shards.shards[0]
+        with mock.patch.object(shard, 'define') as define:
+            with mock.patch.object(es_conn.ESConnection,
+                                   'get_messages') as get:
+                self._refresh_membership(['e1'])
+        # the definitions are not read again, the new ones are built
+        self.assertFalse(get.called)
+        self.assertEqual(len(ad) - len(owned), define.call_count)
+        self.assertEqual(set(d['id'] for d in ad), self._owned())
+
+        with mock.patch.object(shard, 'delete') as delete:
+            self._refresh_membership(['e1', 'e2'])
+        self.assertEqual(len(ad) - len(owned), delete.call_count)
+        self.assertEqual(owned, self._owned())
+
+    def test_run_sends_heartbeats(self):
+        thread = self.thresh_engine.thread_alarm_def
+        thread.interval = 60
+        thread.heartbeat_interval = 0
+        calls = []
+
+        def read_events(timeout):
+            calls.append(timeout)
+            if len(calls) == 3:
+                raise KeyboardInterrupt()
+        with mock.patch.object(thread, 'refresh_membership') as refresh:
+            with mock.patch.object(thread,
+                                   'sync_alarm_processors') as sync:
+                with mock.patch.object(thread, 'read_events',
+                                       side_effect=read_events):
+                    with mock.patch.object(kafka_conn.KafkaConnection,
+                                           'seek_to_end'):
+                        self.assertRaises(KeyboardInterrupt, thread.run)
+        self.assertEqual(3, refresh.call_count)
+        sync.assert_called_once_with()
+        self.assertEqual(0, calls[-1])
+
+    def test_assign_partitions(self):
+        consumer = self.thresh_engine.thread_metrics
+        membership = consumer.membership
+        conn = consumer._consume_kafka_conn
+        owned_conn = consumer._owned_kafka_conn
+        ring = hash_ring.HashRing(['e1', 'e2'])
+        with mock.patch.object(kafka_conn.KafkaConnection,
+                               'get_partition_ids', return_value=range(8)):
+            with mock.patch.object(conn, 'set_partitions') as set_parts:
+                # nothing is read until the instances are known
+                consumer.assign_partitions()
+                self.assertFalse(set_parts.called)
+                self.assertEqual(range(8), owned_conn.partitions)
+
+                membership.ring.set_nodes(['e1', 'e2'])
+                membership.refreshed = True
+                consumer.assign_partitions()
+                consumer.assign_partitions()
+        set_parts.assert_called_once_with(
+            [p for p in range(8)
+             if ring.get_node('partition-%s' % p) == 'e1'])
+
+    def test_forward_metrics(self):
+        consumer = self.thresh_engine.thread_metrics
+        consumer.membership.ring.set_nodes(['e1', 'e2'])
+        ring = consumer.membership.ring
+        aids = ['fake_id_%s' % i for i in range(20)]
+        local = set(aid for aid in aids if ring.get_node(aid) == 'e1')
+        for aid in aids:
+            self.thresh_engine.metric_router.add(aid, None)
+        msg = mock.Mock()
+        msg.message.value = '{"name": "cpu", "value": 1}'
+        conn = consumer._consume_kafka_conn
+        with mock.patch.object(conn, 'get_message_batch',
+                               return_value=[msg]):
+            with mock.patch.object(consumer, 'forward_metrics') as forward:
+                with mock.patch.object(consumer.shards,
+                                       'send_metrics') as send:
+                    consumer.consume_metrics(conn, True)
+                    forward.assert_called_once_with(
+                        'e2', [{'name': 'cpu', 'value': 1}])
+                    send.assert_called_once_with(
+                        {'name': 'cpu', 'value': 1}, local)
+
+                    # the metrics forwarded to this instance stay here
+                    forward.reset_mock()
+                    consumer.consume_metrics(conn, False)
+                    self.assertFalse(forward.called)
+                    self.assertEqual(2, send.call_count)
+
+    def test_get_members(self):
+        membership = self.thresh_engine.thread_alarm_def.membership
+        res = mock.Mock()
+        res.status_code = 200
+        res.json.return_value = {'hits': {'hits': [
+            {'_source': {'id': 'e1', 'heartbeat': 1}},
+            {'_source': {'id': 'e2', 'heartbeat': 1}}]}}
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res) as get:
+            self.assertEqual(['e1', 'e2'], membership.get_members())
+        self.assertIn('range', get.call_args[0][0]['query'])
+
+        res.status_code = 500
+        with mock.patch.object(es_conn.ESConnection, 'get_messages',
+                               return_value=res):
+            self.assertIsNone(membership.get_members())
+            with mock.patch.object(membership, 'heartbeat'):
+                self.assertFalse(membership.refresh())
+        self.assertEqual(frozenset(['e1']), membership.ring.nodes)
+
+
+class TestMetricRouter(base.BaseTestCase):
+    def setUp(self):
+        super(TestMetricRouter, self).setUp()
+        self.router = engine.MetricRouter()
+
+    def _matchers(self, expr):
+        return parser.AlarmExprParser(expr).sub_expr_matchers
+
+    def test_match(self):
+        self.router.add('a1', self._matchers(
+            'max(cpu{hostname=h1})>1 or max(mem)>1'))
+        self.router.add('a2', self._matchers('max(cpu)>1'))
+        self.assertEqual(set(['a1', 'a2']), self.router.match(
+            {'name': 'Cpu', 'dimensions': {'hostname': 'H1', 'os': 'l'}}))
+        self.assertEqual(set(['a2']), self.router.match(
+            {'name': 'cpu', 'dimensions': {'hostname': 'h2'}}))
+        self.assertEqual(set(['a1']), self.router.match({'name': 'mem'}))
+        self.assertEqual(set(), self.router.match({'name': 'disk'}))
+        self.assertEqual(set(), self.router.match(['not', 'a', 'metric']))
+
+    def test_update_and_remove(self):
+        self.router.add('a1', self._matchers('max(cpu)>1'))
+        self.router.add('a1', self._matchers('max(mem)>1'))
+        self.assertEqual(set(), self.router.match({'name': 'cpu'}))
+        self.assertEqual(set(['a1']), self.router.match({'name': 'mem'}))
+        self.router.remove('a1')
+        self.assertEqual(set(), self.router.match({'name': 'mem'}))
+        self.assertEqual({}, self.router._by_name)
+
+    def test_unknown_matchers(self):
+        self.router.add('a1', None)
+        self.assertEqual(set(['a1']), self.router.match({'name': 'cpu'}))
+        self.router.remove('a1')
+        self.assertEqual(set(), self.router.match({'name': 'cpu'}))
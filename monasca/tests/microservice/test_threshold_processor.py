@@ -21,6 +21,8 @@ from monasca.openstack.common import log
 from monasca.openstack.common import timeutils as tu
 from monasca import tests
 import os
+from oslo.config import fixture as fixture_config
+import time
 
 LOG = log.getLogger(__name__)
 
@@ -41,15 +43,22 @@ class TestCaseUtil():
     def get_metrics(self, name):
         ts = self.test_cases["metrics"][name]
         for t in ts:
+            # the offsets are from the end of the period which just ended
             o = t["time_offset"]
-            t["timestamp"] = tu.utcnow_ts() + o
+            t["timestamp"] = tu.utcnow_ts() - 1 + o
             yield json.dumps(t)
 
 
 class TestThresholdProcessor(tests.BaseTestCase):
     def setUp(self):
         super(TestThresholdProcessor, self).setUp()
+        self.CONF = self.useFixture(fixture_config.Config()).conf
         self.util = TestCaseUtil()
+        # evaluate at a period boundary, as the engine does
+        now = int(time.time()) // 60 * 60
+        patcher = mock.patch.object(tu, 'utcnow_ts', return_value=now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test__init_(self):
         """Test processor _init_.
@@ -85,6 +94,19 @@ class TestThresholdProcessor(tests.BaseTestCase):
             tp = None
         self.assertIsNone(tp)
 
+    def _process_metrics(self, tp, name):
+        for metrics in self.util.get_metrics(name):
+            metrics = json.loads(metrics)
+            with mock.patch.object(tu, 'utcnow_ts',
+                                   return_value=metrics['timestamp']):
+                tp.process_metrics(metrics)
+
+    def test_process_decoded_metrics(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        self._process_metrics(tp, "metrics_match_by")
+        self.assertEqual(3, len(tp.process_alarms()))
+
     def test_process_alarms(self):
         """Test if alarm is correctly produced."""
 
@@ -149,9 +171,9 @@ class TestThresholdProcessor(tests.BaseTestCase):
                 tp.process_metrics(metrics)
         alarms = tp.process_alarms()
         self.assertEqual(3, len(alarms))
-        self.assertEqual('ALARM', tp.expr_data_queue['h1,']['state'])
-        self.assertEqual('ALARM', tp.expr_data_queue['h2,']['state'])
-        self.assertEqual('OK', tp.expr_data_queue['h3,']['state'])
+        self.assertEqual('ALARM', tp.expr_data_queue[('h1',)]['state'])
+        self.assertEqual('ALARM', tp.expr_data_queue[('h2',)]['state'])
+        self.assertEqual('OK', tp.expr_data_queue[('h3',)]['state'])
 
         # test alarms with multiple match_ups
         ad = self.util.get_alarm_def("alarm_def_multi_match_by")
@@ -221,9 +243,7 @@ class TestThresholdProcessor(tests.BaseTestCase):
         ad = self.util.get_alarm_def("alarm_def_match_by")
         tp = processor.ThresholdProcessor(ad)
         alarms = tp.process_alarms()
-        metrics_list = self.util.get_metrics("metrics_not_match")
-        for metrics in metrics_list:
-            tp.process_metrics(metrics)
+        self._process_metrics(tp, "metrics_not_match")
         alarms = tp.process_alarms()
         self.assertEqual('OK', json.loads(alarms[0])['state'])
 
@@ -247,3 +267,164 @@ class TestThresholdProcessor(tests.BaseTestCase):
         ad = self.util.get_alarm_def("alarm_def_periods_update")
         re = tp.update_thresh_processor(ad)
         self.assertEqual(True, re)
+
+    def test_related_metrics_built_on_alarm(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        self._process_metrics(tp, "metrics_match_by")
+        self.assertEqual([None], list(tp.related_metrics))
+        alarms = tp.process_alarms()
+        self.assertEqual(4, len(tp.related_metrics))
+        metrics = dict((json.loads(a)['metrics'][0]['dimensions']['hostname'],
+                        json.loads(a)['metrics'][0]) for a in alarms)
+        self.assertEqual({'name': 'biz',
+                          'dimensions': {'key2': 'value2',
+                                         'hostname': 'h1'}},
+                         metrics['h1'])
+        self.assertNotIn('hostname',
+                         tp.related_metrics[None][0]['dimensions'])
+
+    def _send_hosts(self, tp, hosts, now):
+        for host in hosts:
+            metrics = {'name': 'biz', 'value': 1500,
+                       'dimensions': {'key2': 'value2', 'hostname': host}}
+            with mock.patch.object(tu, 'utcnow_ts', return_value=now):
+                tp.process_metrics(metrics)
+
+    def test_idle_series_expire(self):
+        self.CONF.thresholdengine.series_ttl = 60
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        # never less than twice the 60 seconds window
+        self.assertEqual(120, tp.series_ttl)
+        now = tu.utcnow_ts()
+        self._send_hosts(tp, ['h1', 'h2'], now - 200)
+        self._send_hosts(tp, ['h3'], now - 100)
+        self._send_hosts(tp, ['h1'], now - 10)
+        self.assertEqual(1, len(tp.process_alarms()))
+        self.assertEqual([('h3',), ('h1',)], tp.last_seen.keys())
+        self.assertEqual(set([('h3',), ('h1',)]),
+                         set(tp.expr_data_queue))
+        self.assertNotIn(('h2',), tp.related_metrics)
+
+    def test_least_recent_series_evicted(self):
+        self.CONF.thresholdengine.max_series = 2
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        self._send_hosts(tp, ['h1', 'h2', 'h1', 'h3'], now)
+        self.assertEqual(set([('h1',), ('h3',)]), set(tp.expr_data_queue))
+
+    def _send_at(self, tp, timestamp, value, now, host='h1'):
+        metrics = {'name': 'biz', 'value': value, 'timestamp': timestamp,
+                   'dimensions': {'key2': 'value2', 'hostname': host}}
+        with mock.patch.object(tu, 'utcnow_ts', return_value=now):
+            tp.process_metrics(metrics)
+
+    def _values(self, tp, now):
+        with mock.patch.object(tu, 'utcnow_ts', return_value=now):
+            tp.process_alarms()
+        data = tp.expr_data_queue[('h1',)]['data']
+        return data[tp.matchers[0].key]['values']
+
+    def test_metrics_in_event_time(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        # a backlog of an hour ago read all at once
+        for offset, value in [(-3600, 1500), (-3590, 1000), (-3530, 1600)]:
+            self._send_at(tp, now + offset, value, now)
+        # the period of the newest metrics is still in progress
+        self.assertEqual([1500], self._values(tp, now))
+        self.assertEqual(now - 3530, tp.event_time(now))
+        self.assertEqual([None], self._values(tp, now + 120))
+
+    def test_late_metrics_dropped(self):
+        self.CONF.thresholdengine.allowed_lateness = 30
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        self._send_at(tp, now, 1000, now)
+        self._send_at(tp, now - 20, 1500, now)
+        self._send_at(tp, now - 40, 2000, now)
+        self.assertEqual([1500], self._values(tp, now))
+
+    def test_metrics_ahead_do_not_move_event_time(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        self._send_at(tp, tu.iso8601_from_timestamp(now - 10), 1500, now)
+        self._send_at(tp, now + 30, 1000, now, host='h2')
+        self.assertEqual(now, tp.event_time(now))
+        self.assertEqual([1500], self._values(tp, now))
+
+    def test_metrics_ahead_of_clock_dropped(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        self._send_at(tp, now + 3600, 2000, now)
+        self._send_at(tp, now, 1500, now)
+        self.assertEqual([1500], self._values(tp, now + 60))
+        # a little ahead is kept for the period it belongs to
+        self._send_at(tp, now + 30, 1800, now)
+        self.assertEqual([1800], self._values(tp, now + 60))
+
+    def test_dirty_series(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        self._send_hosts(tp, ['h1', 'h2'], now)
+        self.assertEqual(set([('h1',), ('h2',)]), tp.pop_dirty())
+        self.assertEqual(set(), tp.pop_dirty())
+        self._send_hosts(tp, ['h1'], now)
+        with mock.patch.object(tp, 'update_state',
+                               return_value=False) as update:
+            tp.process_alarms(tp.pop_dirty(), early=True)
+        update.assert_called_once_with(tp.expr_data_queue[('h1',)], True)
+
+    def test_breaching_metrics_alarm_early(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        self._send_at(tp, now + 10, 1000, now + 10)
+        self._send_at(tp, now + 20, 1500, now + 20)
+        with mock.patch.object(tu, 'utcnow_ts', return_value=now + 20):
+            # the period in progress is only evaluated early
+            self.assertEqual([], tp.process_alarms([('h1',)]))
+            alarms = [json.loads(a) for a in
+                      tp.process_alarms(tp.pop_dirty(), early=True)]
+        self.assertEqual(['ALARM'], [a['state'] for a in alarms])
+        self.assertEqual([1500], alarms[0]['sub_alarms'][0]['current_values'])
+        # the completed period confirms it at the boundary
+        with mock.patch.object(tu, 'utcnow_ts', return_value=now + 60):
+            self.assertEqual([], tp.process_alarms())
+        self.assertEqual('ALARM', tp.expr_data_queue[('h1',)]['state'])
+
+    def test_metrics_not_breaching_yet_wait(self):
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        now = tu.utcnow_ts()
+        for expr in ['max(biz{key2=value2})<1400',
+                     'sum(biz{key2=value2})<2000']:
+            tp = processor.ThresholdProcessor(dict(ad, expression=expr))
+            self._send_at(tp, now + 10, 1500, now + 10)
+            with mock.patch.object(tu, 'utcnow_ts', return_value=now + 10):
+                self.assertEqual(
+                    [], tp.process_alarms(tp.pop_dirty(), early=True))
+            self.assertEqual('UNDETERMINED',
+                             tp.expr_data_queue[('h1',)]['state'])
+
+    def test_next_evaluation(self):
+        self.CONF.thresholdengine.series_ttl = 300
+        ad = self.util.get_alarm_def("alarm_def_match_by")
+        tp = processor.ThresholdProcessor(ad)
+        now = tu.utcnow_ts()
+        # the tests evaluate at a period boundary
+        self.assertEqual(now + 60, tp.next_evaluation(now))
+        self._send_at(tp, now, 1000, now)
+        self.assertEqual(now + 60, tp.next_evaluation(now, ('h1',)))
+        self.assertEqual(now + 60, tp.next_evaluation(now + 0.5, ('h1',)))
+        # the period of the metrics is evaluated until the next boundary
+        self.assertEqual(now + 120, tp.next_evaluation(now + 90, ('h1',)))
+        # no metrics in the periods any more, only the expiry is left
+        self.assertEqual(now + 300, tp.next_evaluation(now + 150, ('h1',)))
+        self.assertIsNone(tp.next_evaluation(now, ('h2',)))
@@ -0,0 +1,98 @@
+# Copyright 2015 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from monasca.common import alarm_expr_calculator as calculator
+from monasca.microservice import threshold_window
+from monasca import tests
+
+
+class TestSlidingWindow(tests.BaseTestCase):
+
+    def setUp(self):
+        super(TestSlidingWindow, self).setUp()
+        self.now = 1030
+        self.samples = [(self.now + offset, value) for offset, value in
+                        [(-170, 5.0), (-150, 1.0), (-100, 7.0), (-90, 3.0),
+                         (-61, 9.0), (-30, 2.0), (-10, 8.0), (0, 4.0)]]
+
+    def _expected(self, func, now):
+        values = []
+        for k in range(3):
+            left = (now // 60 - 1 - k) * 60
+            values.append(calculator.calc_value(
+                func, [v for t, v in self.samples if left <= t < left + 60]))
+        return values
+
+    def test_values_match_calculator(self):
+        for func in ['SUM', 'AVG', 'MAX', 'MIN', 'COUNT']:
+            window = threshold_window.SlidingWindow(60, 3)
+            for t, v in self.samples:
+                window.add(t, v)
+            for now in range(self.now, self.now + 200, 15):
+                self.assertEqual(self._expected(func, now),
+                                 window.values(now, func))
+
+    def test_old_samples_dropped(self):
+        window = threshold_window.SlidingWindow(60, 2)
+        for t, v in self.samples:
+            window.add(t, v)
+        self.assertFalse(window.add(self.now - 300, 1.0))
+        self.assertEqual([2, 2, 2], sorted(
+            count for index, count, s, low, high in window.buckets()))
+        self.assertEqual([0, 2], window.values(self.now + 120, 'COUNT'))
+        self.assertEqual([0, 0], window.values(self.now + 180, 'COUNT'))
+
+    def test_period_in_progress_not_evaluated(self):
+        window = threshold_window.SlidingWindow(60, 2)
+        for t, v in self.samples:
+            window.add(t, v)
+        self.assertEqual([9.0, 7.0], window.values(self.now, 'MAX'))
+        self.assertTrue(window.add(self.now + 60, 6.0))
+        self.assertEqual([8.0, 9.0], window.values(self.now + 60, 'MAX'))
+        self.assertEqual([6.0, 8.0], window.values(self.now + 120, 'MAX'))
+
+    def test_steady_stream_at_period_boundaries(self):
+        window = threshold_window.SlidingWindow(60, 1)
+        for t in range(0, 600, 10):
+            window.add(t, 5.0)
+            if t >= 60 and t % 60 == 0:
+                # the period which just started is still empty
+                self.assertEqual([5.0], window.values(t, 'MAX'))
+                self.assertTrue(window.live(t))
+
+    def test_constant_size(self):
+        window = threshold_window.SlidingWindow(10, 2)
+        for t in range(1000):
+            window.add(t, float(t))
+        self.assertEqual(3, len(window.indices))
+        self.assertEqual([float(sum(range(990, 1000))),
+                          float(sum(range(980, 990)))],
+                         window.values(1000, 'SUM'))
+
+    def test_resized(self):
+        window = threshold_window.SlidingWindow(60, 3)
+        for t, v in self.samples:
+            window.add(t, v)
+        other = window.resized(60, 2)
+        self.assertEqual(window.values(self.now, 'AVG')[:2],
+                         other.values(self.now, 'AVG'))
+        other = window.resized(30, 3)
+        self.assertEqual([0, 0, 0], other.values(self.now, 'COUNT'))
+
+    def test_period_in_progress_included(self):
+        window = threshold_window.SlidingWindow(60, 2)
+        for t, v in self.samples:
+            window.add(t, v)
+        self.assertEqual([8.0, 9.0], window.values(self.now, 'MAX', True))
+        self.assertEqual([9.0, 7.0], window.values(self.now, 'MAX'))
@@ -137,7 +137,8 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_result.json.return_value = self.data
         req_result.status_code = 200
 
-        with mock.patch.object(requests, 'get', return_value=req_result):
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_result):
             self.dispatcher_get_by_id.do_get_alarm_definitions_by_id(
                 req, res, id="72df5ccb-ec6a-4bb4-a15c-939467ccdde0")
 
@@ -165,7 +166,8 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_result = mock.Mock()
         req_result.status_code = 201
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             with mock.patch.object(req.stream, 'read',
                                    return_value="{ 'name': 'CPU usage test', "
                                                 "'alarm_actions': "
@@ -199,8 +201,10 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_get_result.json.return_value = self.data
         req_get_result.status_code = 200
 
-        with mock.patch.object(requests, 'get', return_value=req_get_result):
-            with mock.patch.object(requests, 'put', return_value=req_result):
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_get_result):
+            with mock.patch.object(requests.Session, 'put',
+                                   return_value=req_result):
                 with mock.patch.object(
                         req.stream, 'read',
                         return_value="{ 'name': 'CPU usage test', "
@@ -233,6 +237,19 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
                 mock.Mock(), res, id="72df5ccb-ec6a-4bb4-a15c-939467ccdde0")
             self.assertEqual(res.status, getattr(falcon, 'HTTP_200'))
 
+    def test_do_delete_alarm_definitions_publishes_event(self):
+        self.dispatcher_delete._kafka_conn = mock.Mock()
+        with mock.patch.object(es_conn.ESConnection, 'del_messages',
+                               return_value=200):
+            with mock.patch.object(alarmdefinitions.tu, 'utcnow_ts',
+                                   return_value=1000):
+                self.dispatcher_delete.do_delete_alarm_definitions(
+                    mock.Mock(), mock.Mock(), id="fake_id")
+        send = self.dispatcher_delete._kafka_conn.send_messages
+        self.assertEqual({'event': 'deleted', 'id': 'fake_id',
+                          'timestamp': 1000},
+                         json.loads(send.call_args[0][0]))
+
     def test_do_delete_alarm_definitions_exception(self):
         with mock.patch.object(es_conn.ESConnection, 'del_messages',
                                return_value=0,
@@ -263,7 +280,8 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_result = mock.Mock()
         req_result.status_code = 201
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             with mock.patch.object(req.stream, 'read',
                                    return_value="{ 'name': 'CPU usage test', "
                                                 "'alarm_actions': "
@@ -297,7 +315,8 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_result = mock.Mock()
         req_result.status_code = 201
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             with mock.patch.object(req.stream, 'read',
                                    return_value="{ 'name': 'CPU usage test', "
                                                 "'alarm_actions': "
@@ -341,8 +360,10 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_get_result.json.return_value = self.data
         req_get_result.status_code = 200
 
-        with mock.patch.object(requests, 'get', return_value=req_get_result):
-            with mock.patch.object(requests, 'put', return_value=req_result):
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_get_result):
+            with mock.patch.object(requests.Session, 'put',
+                                   return_value=req_result):
                 with mock.patch.object(
                         req.stream, 'read',
                         return_value="{ 'name': 'CPU usage test', "
@@ -387,8 +408,10 @@ class TestAlarmDefinitionDispatcher(base.BaseTestCase):
         req_get_result.json.return_value = self.data
         req_get_result.status_code = 200
 
-        with mock.patch.object(requests, 'get', return_value=req_get_result):
-            with mock.patch.object(requests, 'put', return_value=req_result):
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_get_result):
+            with mock.patch.object(requests.Session, 'put',
+                                   return_value=req_result):
                 with mock.patch.object(
                         req.stream, 'read',
                         return_value="{ 'name': 'CPU usage test', "
@@ -19,6 +19,7 @@ import mock
 from oslo.config import fixture as fixture_config
 from oslotest import base
 import requests
+import time
 
 from monasca.common import kafka_conn
 from monasca.v2.elasticsearch import metrics
@@ -93,7 +94,7 @@ class TestMetricDispatcher(base.BaseTestCase):
                 "name": {"type": "string", "index": "not_analyzed"},
                 "timestamp": {"type": "string", "index": "not_analyzed"},
                 "value": {"type": "double"}}}}}}
-        with mock.patch.object(requests, 'get',
+        with mock.patch.object(requests.Session, 'get',
                                return_value=res):
             self.dispatcher = metrics.MetricDispatcher({})
 
@@ -110,9 +111,9 @@ class TestMetricDispatcher(base.BaseTestCase):
 
         self.assertEqual(self.dispatcher._es_conn.uri, 'fake_es_uri/')
 
-        # test that the query url is correctly formed
-        self.assertEqual(self.dispatcher._query_url, (
-            'fake_es_uri/also_fake*/fake/_search?search_type=count'))
+        # test that the query path is correctly formed
+        self.assertEqual('also_fake*/fake/_search?search_type=count',
+                         self.dispatcher._get_query_path([]))
 
     def test_post_data(self):
         with mock.patch.object(kafka_conn.KafkaConnection, 'send_messages',
@@ -160,7 +161,8 @@ class TestMetricDispatcher(base.BaseTestCase):
         req_result.json.return_value = json.loads(response_str)
         req_result.status_code = 200
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             self.dispatcher.do_get_metrics(req, res)
 
         # test that the response code is 200
@@ -170,6 +172,34 @@ class TestMetricDispatcher(base.BaseTestCase):
         self.assertEqual(obj[0]['dimensions']['key2'], 'NVITDU')
         self.assertEqual(len(obj), 2)
 
+    def test_query_path_pruned_by_time(self):
+        self.CONF.set_override('index_strategy', 'timed', group='metrics')
+        self.CONF.set_override('time_unit', 'd', group='timed_strategy')
+        self.CONF.set_override('max_indices', 3, group='metrics')
+        dispatcher = metrics.MetricDispatcher({})
+        start = time.mktime((2015, 1, 31, 13, 35, 0, 0, 0, -1))
+        query = [{'range': {'timestamp': {'gte': start,
+                                          'lt': start + 86400}}}]
+        self.assertEqual('also_fake20150131000000,also_fake20150201000000'
+                         '/fake/_search?search_type=count'
+                         '&ignore_unavailable=true',
+                         dispatcher._get_query_path(query))
+
+        # too many indices, search them all
+        query = [{'range': {'timestamp': {'gte': start,
+                                          'lt': start + 10 * 86400}}}]
+        self.assertEqual(dispatcher._query_path,
+                         dispatcher._get_query_path(query))
+
+        # no time range, search them all
+        self.assertEqual(dispatcher._query_path,
+                         dispatcher._get_query_path([]))
+
+    def test_query_path_fixed_strategy(self):
+        query = [{'range': {'timestamp': {'gte': 0, 'lt': 86400}}}]
+        self.assertEqual('also_fake*/fake/_search?search_type=count',
+                         self.dispatcher._get_query_path(query))
+
     def test_do_post_metrics(self):
         with mock.patch.object(kafka_conn.KafkaConnection, 'send_messages',
                                return_value=204):
@@ -259,7 +289,8 @@ class TestMetricDispatcher(base.BaseTestCase):
 
         req_result.status_code = 200
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             self.dispatcher.do_get_measurements(req, res)
 
         # test that the response code is 200
@@ -329,7 +360,8 @@ class TestMetricDispatcher(base.BaseTestCase):
 
         req_result.status_code = 200
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             self.dispatcher.do_get_statistics(req, res)
 
         # test that the response code is 200
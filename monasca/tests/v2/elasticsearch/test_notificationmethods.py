@@ -90,23 +90,23 @@ class TestNotificationMethodDispatcher(base.BaseTestCase):
             "type": "EMAIL",
             "address": "john.doe@hp.com"
         }
-        with mock.patch.object(requests, 'get',
+        with mock.patch.object(requests.Session, 'get',
                                return_value=res):
             self.dispatcher_get = (
                 notificationmethods.NotificationMethodDispatcher({}))
 
         res.json.return_value = {}
-        with mock.patch.object(requests, 'post',
+        with mock.patch.object(requests.Session, 'post',
                                return_value=res):
             self.dispatcher_post = (
                 notificationmethods.NotificationMethodDispatcher({}))
 
-        with mock.patch.object(requests, 'put',
+        with mock.patch.object(requests.Session, 'put',
                                return_value=res):
             self.dispatcher_put = (
                 notificationmethods.NotificationMethodDispatcher({}))
 
-        with mock.patch.object(requests, 'delete',
+        with mock.patch.object(requests.Session, 'delete',
                                return_value=res):
             self.dispatcher_delete = (
                 notificationmethods.NotificationMethodDispatcher({}))
@@ -162,7 +162,8 @@ class TestNotificationMethodDispatcher(base.BaseTestCase):
         req_result.json.return_value = json.loads(response_str)
         req_result.status_code = 200
 
-        with mock.patch.object(requests, 'post', return_value=req_result):
+        with mock.patch.object(requests.Session, 'post',
+                               return_value=req_result):
             self.dispatcher_get.do_get_notification_methods(req, res)
 
         # test that the response code is 200
@@ -182,7 +183,8 @@ class TestNotificationMethodDispatcher(base.BaseTestCase):
         req_result.json.return_value = json.loads(response_str)
         req_result.status_code = 200
 
-        with mock.patch.object(requests, 'get', return_value=req_result):
+        with mock.patch.object(requests.Session, 'get',
+                               return_value=req_result):
             (self.dispatcher_get.
                 do_get_notification_method_by_id(
                     req, res,
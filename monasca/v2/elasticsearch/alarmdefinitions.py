@@ -24,9 +24,11 @@ import uuid
 from monasca.common import alarm_expr_parser
 from monasca.common import alarm_expr_validator
 from monasca.common import es_conn
+from monasca.common import kafka_conn
 from monasca.common import namespace
 from monasca.common import resource_api
 from monasca.openstack.common import log
+from monasca.openstack.common import timeutils as tu
 
 
 try:
@@ -45,6 +47,10 @@ alarmdefinitions_opts = [
     cfg.IntOpt('size', default=1000,
                help=('The query result limit. Any result set more than '
                      'the limit will be discarded.')),
+    cfg.StrOpt('events_topic', default='alarmdefinitionevents',
+               help=('The kafka topic the changes of alarm definitions are '
+                     'published to, so the threshold engines apply them '
+                     'right away. Empty to publish nothing.')),
 ]
 
 
@@ -95,6 +101,32 @@ class AlarmDefinitionDispatcher(object):
         self._es_conn = es_conn.ESConnection(
             self.doc_type, self.index_strategy, self.index_prefix)
 
+        self._kafka_conn = None
+        if cfg.CONF.alarmdefinitions.events_topic:
+            try:
+                self._kafka_conn = kafka_conn.KafkaConnection(
+                    cfg.CONF.alarmdefinitions.events_topic)
+            except Exception:
+                LOG.exception('Alarm definition events will not be '
+                              'published.')
+
+    def _publish_event(self, event, id, alarm_definition=None):
+        """Tell the threshold engines an alarm definition changed.
+
+        The engines also reconcile their definitions with ElasticSearch
+        periodically, so a lost event is only applied later.
+        """
+        if not self._kafka_conn:
+            return
+        msg = {'event': event, 'id': id, 'timestamp': tu.utcnow_ts()}
+        if alarm_definition is not None:
+            msg['alarm_definition'] = alarm_definition
+        try:
+            self._kafka_conn.send_messages(json.dumps(msg))
+        except Exception:
+            LOG.exception('Error occurred while publishing the %s event '
+                          'of alarm definition %s.' % (event, id))
+
     def _get_alarm_definitions_response(self, res):
         if res and res.status_code == 200:
             obj = res.json()
@@ -168,12 +200,15 @@ class AlarmDefinitionDispatcher(object):
                 for temp in expression_data:
                     expression_data_list.append(expression_data[temp])
                 post_msg["expression_data"] = expression_data_list
+                post_msg["updated_timestamp"] = tu.utcnow_ts()
                 LOG.debug(post_msg)
 
                 es_res = self._es_conn.post_messages(json.dumps(post_msg), id)
                 LOG.debug('Query to ElasticSearch returned Status: %s' %
                           es_res)
                 res.status = getattr(falcon, 'HTTP_%s' % es_res)
+                if es_res in (200, 201):
+                    self._publish_event('created', id, post_msg)
             except Exception:
                 LOG.exception('Error occurred while handling '
                               'Alarm Definition Post Request.')
@@ -261,6 +296,8 @@ class AlarmDefinitionDispatcher(object):
             for temp in expression_data:
                 expression_data_list.append(expression_data[temp])
             put_msg["expression_data"] = expression_data_list
+            put_msg["id"] = id
+            put_msg["updated_timestamp"] = tu.utcnow_ts()
 
             put_msg_json = json.dumps(put_msg)
             LOG.debug("Alarm Definition Put Data: %s" % put_msg_json)
@@ -271,6 +308,8 @@ class AlarmDefinitionDispatcher(object):
                 LOG.debug('Query to ElasticSearch returned Status: %s' %
                           es_res)
                 res.status = getattr(falcon, 'HTTP_%s' % es_res)
+                if es_res in (200, 201):
+                    self._publish_event('updated', id, put_msg)
             else:
                 res.status = getattr(falcon, 'HTTP_400')
                 LOG.debug("Validating Alarm Definition Failed !!")
@@ -287,6 +326,8 @@ class AlarmDefinitionDispatcher(object):
             LOG.debug('Query to ElasticSearch returned Status: %s' %
                       es_res)
             res.status = getattr(falcon, 'HTTP_%s' % es_res)
+            if es_res == 200:
+                self._publish_event('deleted', id)
         except Exception:
             res.status = getattr(falcon, 'HTTP_400')
             LOG.exception('Error occurred while handling Alarm '
@@ -17,7 +17,6 @@
 import datetime
 import falcon
 from oslo.config import cfg
-import requests
 from stevedore import driver
 import time
 
@@ -48,6 +47,11 @@ METRICS_OPTS = [
                      'the limit will be discarded. To see all the matching '
                      'result, narrow your search by using a small time '
                      'window or strong matching name')),
+    cfg.IntOpt('max_indices', default=100,
+               help=('The maximum number of indices a query is sent to by '
+                     'name. When the index strategy can tell the indices of '
+                     'the queried time range, only those are searched, '
+                     'unless there are more than that. 0 means no limit.')),
 ]
 
 cfg.CONF.register_opts(METRICS_OPTS, group="metrics")
@@ -137,6 +141,7 @@ class MetricDispatcher(object):
         self.topic = cfg.CONF.metrics.topic
         self.doc_type = cfg.CONF.metrics.doc_type
         self.size = cfg.CONF.metrics.size
+        self.max_indices = cfg.CONF.metrics.max_indices
         self._kafka_conn = kafka_conn.KafkaConnection(self.topic)
 
         # load index strategy
@@ -164,20 +169,14 @@ class MetricDispatcher(object):
         self._stats_body = {}
         self._sort_clause = []
 
-        # Setup the get metrics query url, the url should be similar to this:
-        # http://host:port/data_20141201/metrics/_search
-        # the url should be made of es_conn uri, the index prefix, metrics
-        # dispatcher topic, then add the key word _search.
-        self._query_url = ''.join([self._es_conn.uri,
-                                  self._es_conn.index_prefix, '*/',
-                                  cfg.CONF.metrics.topic,
-                                  '/_search?search_type=count'])
-
-        # the url to get all the properties of metrics
-        self._query_mapping_url = ''.join([self._es_conn.uri,
-                                           self._es_conn.index_prefix,
-                                           '*/_mappings/',
-                                           cfg.CONF.metrics.topic])
+        # Setup the get metrics query path, the path should be similar to
+        # this: data_*/metrics/_search
+        # the path should be made of the index prefix, metrics dispatcher
+        # topic, then add the key word _search. Requests are sent with the
+        # path relative to the uri through the es connection.
+        self._query_path = ''.join([self._es_conn.index_prefix, '*/',
+                                    cfg.CONF.metrics.topic,
+                                    '/_search?search_type=count'])
 
         # Setup metrics query aggregation command. To see the structure of
         # the aggregation, copy and paste it to a json formatter.
@@ -215,6 +214,24 @@ class MetricDispatcher(object):
         code = self._kafka_conn.send_messages(msg)
         res.status = getattr(falcon, 'HTTP_' + str(code))
 
+    def _get_query_path(self, query):
+        """Get the search path covering the queried time range only."""
+        if not hasattr(self.index_strategy, 'get_indices'):
+            return self._query_path
+        for cond in query:
+            if 'range' in cond:
+                time_range = cond['range']['timestamp']
+                indices = self.index_strategy.get_indices(
+                    time_range['gte'], time_range['lt'], self.max_indices)
+                if indices:
+                    # indices with no metrics in them may not exist
+                    return ''.join([
+                        ','.join(self.index_prefix + index
+                                 for index in indices),
+                        '/', cfg.CONF.metrics.topic,
+                        '/_search?search_type=count&ignore_unavailable=true'])
+        return self._query_path
+
     def _get_agg_response(self, res):
         if res and res.status_code == 200:
             obj = res.json()
@@ -239,9 +256,10 @@ class MetricDispatcher(object):
         else:
             body = '{"aggs":' + _metrics_ag + '}'
 
+        path = self._get_query_path(query)
         LOG.debug('Request body:' + body)
-        LOG.debug('Request url:' + self._query_url)
-        es_res = requests.post(self._query_url, data=body)
+        LOG.debug('Request path:' + path)
+        es_res = self._es_conn.request('post', path, data=body)
         res.status = getattr(falcon, 'HTTP_%s' % es_res.status_code)
 
         LOG.debug('Query to ElasticSearch returned: %s' % es_res.status_code)
@@ -291,7 +309,8 @@ class MetricDispatcher(object):
             body = '{"aggs":' + _measure_ag + '}'
 
         LOG.debug('Request body:' + body)
-        es_res = requests.post(self._query_url, data=body)
+        es_res = self._es_conn.request('post', self._get_query_path(query),
+                                       data=body)
         res.status = getattr(falcon, 'HTTP_%s' % es_res.status_code)
 
         LOG.debug('Query to ElasticSearch returned: %s' % es_res.status_code)
@@ -352,7 +371,8 @@ class MetricDispatcher(object):
         else:
             body = '{"aggs":' + _stats_ag + '}'
 
-        es_res = requests.post(self._query_url, data=body)
+        es_res = self._es_conn.request('post', self._get_query_path(query),
+                                       data=body)
         res.status = getattr(falcon, 'HTTP_%s' % es_res.status_code)
 
         LOG.debug('Query to ElasticSearch returned: %s' % es_res.status_code)